@@ -1,20 +1,25 @@
 from __future__ import print_function
-import numpy as np, networkx as nx, argparse
-from numba import jit
+import numpy as np, argparse
+from numba import jit, vectorize
 from glob import glob
 from ete3 import Tree
 from subprocess import Popen, PIPE
-import sys, os, tempfile, platform, re, tempfile, psutil
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import sys, os, tempfile, platform, re, tempfile, psutil, atexit, heapq, shutil, threading, time
 import sysconfig
+from contextlib import contextmanager
 
 base_dir = os.path.join(sysconfig.get_paths()["purelib"], "grapetree")
 
+# Default parameters. They are not changed by the tree builds; see TreeEngine for per-tree parameters.
 params = dict(method='MSTreeV2', # MSTree , NJ
               matrix_type='symmetric',
               heuristic = 'eBurst',
               handle_missing = 'pair_delete', # complete_delete , absolute_distance , as_allele
               branch_recraft=False,
               wgMLST = False,
+              packed_presence = False, # bit-packed presence masks for symmetric pair_delete / absolute_distance
               n_proc = 5,
               checkEnv = False,
               NJ_Windows = os.path.join(base_dir, 'binaries', 'fastme.exe'),
@@ -32,20 +37,20 @@ params = dict(method='MSTreeV2', # MSTree , NJ
               ninja_Windows = os.path.join(base_dir, 'binaries', 'Ninja.jar'),
              )
 
-@jit(nopython=True)
-def contemporary(a,b,c, n_loci) :
-    a[0], a[1] = max(min(a[0], n_loci-0.5), 0.5), max(min(a[1], n_loci-0.5), 0.5);
+@vectorize(['b1(f8, f8, f8, f8, f8)'], cache=True)
+def contemporary(a0, a1, b, c, n_loci) :
+    a0, a1 = max(min(a0, n_loci-0.5), 0.5), max(min(a1, n_loci-0.5), 0.5);
     b, c = max(min(b, n_loci-0.5), 0.5), max(min(c, n_loci-0.5), 0.5)
-    if b >= a[0] + c and b >= a[1] + c :
+    if b >= a0 + c and b >= a1 + c :
         return False
     elif b == c :
         return True
-    s11, s12 = np.sqrt(1-a[0]/n_loci), (2*n_loci - b - c)/2/np.sqrt(n_loci*(n_loci-a[0]))
-    v = 1-((n_loci-a[1])*(n_loci-c)/n_loci+(n_loci-b))/2/n_loci
-    s21, s22 = 1+a[1]*v/(b-2*n_loci*v), 1+c*v/(b-2*n_loci*v)
+    s11, s12 = np.sqrt(1-a0/n_loci), (2*n_loci - b - c)/2/np.sqrt(n_loci*(n_loci-a0))
+    v = 1-((n_loci-a1)*(n_loci-c)/n_loci+(n_loci-b))/2/n_loci
+    s21, s22 = 1+a1*v/(b-2*n_loci*v), 1+c*v/(b-2*n_loci*v)
 
-    p1 = a[0]*np.log(1-s11*s11) + (n_loci-a[0])*np.log(s11*s11) + (b+c)*np.log(1-s11*s12) + (2*n_loci-b-c)*np.log(s11*s12)
-    p2 = a[1]*np.log(1-s21) + (n_loci-a[1])*np.log(s21) + b*np.log(1-s21*s22) + (n_loci-b)*np.log(s21*s22) + c*np.log(1-s22) + (n_loci-c)*np.log(s22)
+    p1 = a0*np.log(1-s11*s11) + (n_loci-a0)*np.log(s11*s11) + (b+c)*np.log(1-s11*s12) + (2*n_loci-b-c)*np.log(s11*s12)
+    p2 = a1*np.log(1-s21) + (n_loci-a1)*np.log(s21) + b*np.log(1-s21*s22) + (n_loci-b)*np.log(s21*s22) + c*np.log(1-s22) + (n_loci-c)*np.log(s22)
     return p1 >= p2
 
 def add_args() :
@@ -56,6 +61,7 @@ def add_args() :
     parser.add_argument('--recraft', '-r', dest='branch_recraft', help='Triggers local branch recrafting. [DEFAULT: MSTreeV2]. ', default=False, action="store_true")
     parser.add_argument('--missing', '-y', dest='handler', help='ONLY FOR symmetric DISTANCE MATRIX. \n0: [DEFAULT] ignore missing data in pairwise comparison. \n1: Remove column with missing data. \n2: treat data as an allele. \n3: Absolute number of allelic differences. ', default=0, type=int)
     parser.add_argument('--wgMLST', '-w', help='[EXPERIMENTAL] a better support of wgMLST schemes.', default=False, action="store_true")
+    parser.add_argument('--packed', '-k', dest='packed_presence', help='Use bit-packed presence masks for the symmetric distance matrix with -y 0 or -y 3. \nSame distances with a smaller working set per pair of profiles. ', default=False, action="store_true")
     parser.add_argument('--heuristic', '-t', dest='heuristic', help='Tiebreak heuristic used only in MSTree and MSTreeV2\n"eBurst" [DEFAULT: MSTree]\n"harmonic" [DEFAULT: MSTreeV2]', default='eBurst')
     parser.add_argument('--n_proc', '-n',  dest='number_of_processes', help='Number of CPU processes in parallel use. [DEFAULT]: 5. ', type=int, default=5)
     parser.add_argument('--check', '-c', dest='checkEnv', help='Only calculate the expected time/memory requirements. ', default=False, action="store_true")
@@ -80,127 +86,753 @@ def add_args() :
         args.branch_recraft = True
     return args.__dict__
 
+_pools, _pool_lock = {}, threading.Lock()
+
+def get_pool(n_proc) :
+    '''
+    Process pool for distance calculations, kept between tree jobs.
+    There is one pool per number of processes, so trees built at the same time in
+    threads can share a pool without closing the pool another tree is using.
+    '''
+    with _pool_lock :
+        if n_proc not in _pools :
+            # forking a process with other threads running (tree threads, heartbeats) is unsafe, so start the workers from a clean server process
+            context = get_context('spawn' if platform.system() == 'Windows' else 'forkserver')
+            _pools[n_proc] = context.Pool(n_proc)
+        return _pools[n_proc]
+
+@atexit.register
+def close_pool() :
+    with _pool_lock :
+        for pool in _pools.values() :
+            pool.close()
+            pool.join()
+        _pools.clear()
+
+def peak_rss() :
+    '''
+    Largest resident memory of this process so far, in bytes.
+    On Linux ru_maxrss is kept over exec, so a spawned process would report its parent's peak; VmHWM is its own.
+    '''
+    try :
+        with open('/proc/self/status') as fin :
+            for line in fin :
+                if line.startswith('VmHWM:') :
+                    return int(line.split()[1]) * 1024
+    except OSError :
+        pass
+    try :
+        import resource
+    except ImportError :
+        return psutil.Process().memory_info().peak_wset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+class Stages(object) :
+    '''
+    Wall time, CPU time and process peak resident memory of the stages of a tree, in the order they ran.
+    CPU time and memory are those of this process, so the distance pool processes are not included.
+    process_peak_rss is the high-water mark of the whole process up to the end of the stage, so in a
+    long-running process it includes earlier trees and any trees built at the same time.
+    '''
+    def __init__(self) :
+        self.spans = []
+
+    @contextmanager
+    def __call__(self, name) :
+        wall, cpu = time.perf_counter(), time.process_time()
+        try :
+            yield
+        finally :
+            self.spans.append(dict(stage=name, wall=time.perf_counter() - wall, cpu=time.process_time() - cpu, process_peak_rss=peak_rss()))
+
+def _attach_array(shm_info) :
+    name, shape, dtype = shm_info
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _output_args(func, outputs, index_range, start, counts) :
+    '''
+    The output arguments of a distance function for the columns in index_range,
+    given the output arrays of get_columns, which hold the columns [start, n).
+    '''
+    a, b = index_range[0] - start, index_range[1] - start
+    if not counts :
+        return dict(distances=outputs[0][:, a:b])
+    if func == 'asymmetric' :
+        return dict(counts=(outputs[0][:, a:b], outputs[1][a:b]))
+    # the pairs of a column are not contiguous in condensed order, so the kernel gets the whole arrays
+    return dict(counts=tuple(outputs))
+
 def parallel_distance(callup) :
-    func, prof_file, sub_prefix, handle_missing, index_range = callup
-    profiles = np.load(prof_file)
-    res = eval('distance_matrix.'+func)(profiles, handle_missing, index_range)
-    subfile = sub_prefix.format(index_range[0])
-    np.save(subfile, res)
-    return subfile
+    func, prof_info, out_infos, handle_missing, index_range, start, counts = callup
+    prof_shm, profiles = _attach_array(prof_info)
+    out_shms, outputs = zip(*[_attach_array(info) for info in out_infos])
+    try :
+        getattr(distance_matrix, func)(profiles, handle_missing, index_range, **_output_args(func, outputs, index_range, start, counts))
+    finally :
+        del profiles, outputs
+        prof_shm.close()
+        for shm in out_shms :
+            shm.close()
+    return index_range
+
+def chunk_ranges(func, start, n_profile, n_chunk) :
+    '''
+    Split the columns [start, n_profile) into ranges of about equal work.
+    'symmetric' compares each profile only with the ones before it, so column i costs ~i
+    and the ranges get narrower towards the end.
+    '''
+    steps = np.arange(n_chunk + 1, dtype=float) / n_chunk
+    if func in ('symmetric', 'symmetric_packed') :
+        bounds = np.sqrt(start*start + (n_profile*n_profile - start*start) * steps)
+    else :
+        bounds = start + (n_profile - start) * steps
+    bounds = np.unique(np.round(bounds).astype(int))
+    return [[s, e] for s, e in zip(bounds[:-1], bounds[1:])]
+
+
+@jit(nopython=True, cache=True)
+def _block_sum(values, lo, n) :
+    if n < 8 :
+        res = 0.
+        for i in range(lo, lo+n) :
+            res += values[i]
+        return res
+    r0, r1, r2, r3 = values[lo], values[lo+1], values[lo+2], values[lo+3]
+    r4, r5, r6, r7 = values[lo+4], values[lo+5], values[lo+6], values[lo+7]
+    i = 8
+    while i < n - (n % 8) :
+        r0 += values[lo+i]; r1 += values[lo+i+1]; r2 += values[lo+i+2]; r3 += values[lo+i+3]
+        r4 += values[lo+i+4]; r5 += values[lo+i+5]; r6 += values[lo+i+6]; r7 += values[lo+i+7]
+        i += 8
+    res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+    while i < n :
+        res += values[lo+i]
+        i += 1
+    return res
+
+@jit(nopython=True, cache=True)
+def _pairwise_sum(values, stack, partial) :
+    '''
+    Sum in the same order as numpy's recursive pairwise summation, so results match
+    np.sum(..., axis=1) exactly. The recursion is unrolled onto 'stack' (k x 3 int64)
+    and 'partial' (k float64), which the caller allocates once.
+    '''
+    n_task, n_partial = 1, 0
+    stack[0, 0], stack[0, 1], stack[0, 2] = 0, values.size, 0
+    while n_task > 0 :
+        n_task -= 1
+        lo, n, combine = stack[n_task, 0], stack[n_task, 1], stack[n_task, 2]
+        if combine :
+            n_partial -= 1
+            partial[n_partial-1] += partial[n_partial]
+        elif n <= 128 :
+            partial[n_partial] = _block_sum(values, lo, n)
+            n_partial += 1
+        else :
+            n2 = n // 2
+            n2 -= n2 % 8
+            stack[n_task, 0], stack[n_task, 1], stack[n_task, 2] = lo, n, 1
+            stack[n_task+1, 0], stack[n_task+1, 1], stack[n_task+1, 2] = lo+n2, n-n2, 0
+            stack[n_task+2, 0], stack[n_task+2, 1], stack[n_task+2, 2] = lo, n2, 0
+            n_task += 3
+    return partial[0]
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _store_pair(n_diff, n_comparable, scaled, n_loci, n_profile, j, id, start, distances, diffs, comparable) :
+    '''
+    Stores the comparison of profiles j < id: its distance in the columns 'distances', which start at
+    column 'start', or if 'distances' is empty, its counts at the pair's condensed index in 'diffs'
+    and 'comparable' (see SymmetricDistances). 'comparable' is empty when it is not needed.
+    '''
+    if distances.shape[0] == 0 :
+        # the rows of the upper triangle before row j hold j*(2n-j-1)/2 pairs
+        k = j * (2 * n_profile - j - 1) // 2 + id - j - 1
+        diffs[k] = n_diff
+        if comparable.shape[0] > 0 :
+            comparable[k] = n_comparable
+        return
+    if scaled :
+        d = float(n_diff) * n_loci / n_comparable
+    else :
+        d = float(n_diff)
+    distances[j, id - start] = d
+    if j >= start :
+        distances[id, j - start] = d
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _symmetric_kernel(profiles, presences, scaled, start, stop, distances, diffs, comparable) :
+    (n_profile, n_loci), n_col = profiles.shape, stop - start
+    for i2 in range(n_col) :
+        id = start + i2
+        for j in range(id) :
+            n_diff, n_comparable = 0, 0
+            for l in range(n_loci) :
+                if presences[j, l] and presences[id, l] :
+                    n_comparable += 1
+                    if profiles[j, l] != profiles[id, l] :
+                        n_diff += 1
+            _store_pair(n_diff, n_comparable, scaled, n_loci, n_profile, j, id, start, distances, diffs, comparable)
+
+@jit(nopython=True, nogil=True, cache=True)
+def _popcount(x) :
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return np.int64((x * np.uint64(0x0101010101010101)) >> np.uint64(56))
+
+def pack_presences(presences) :
+    '''Presence masks as 64 loci per uint64 word, locus l in bit l % 64 of word l // 64.'''
+    n_word = (presences.shape[1] + 63) // 64
+    packed = np.zeros((presences.shape[0], n_word * 8), dtype=np.uint8)
+    packed[:, :(presences.shape[1] + 7) // 8] = np.packbits(presences, axis=1, bitorder='little')
+    return packed.view('<u8').astype(np.uint64)
+
+def narrow_profiles(profiles) :
+    '''Profiles in the smallest unsigned integer type that holds all allele codes.'''
+    if profiles.size == 0 or profiles.dtype.kind not in 'iu' or profiles.min() < 0 :
+        return profiles
+    return profiles.astype(np.min_scalar_type(profiles.max()), copy=False)
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _symmetric_packed_kernel(profiles, packed, scaled, start, stop, distances, diffs, comparable) :
+    (n_profile, n_loci), n_col, n_word = profiles.shape, stop - start, packed.shape[1]
+    for i2 in range(n_col) :
+        id = start + i2
+        for j in range(id) :
+            n_comparable, n_single = 0, 0
+            for w in range(n_word) :
+                n_comparable += _popcount(packed[j, w] & packed[id, w])
+                n_single += _popcount(packed[j, w] ^ packed[id, w])
+            # missing alleles are 0, so a locus present in only one of the profiles always differs,
+            # and one missing in both never does. Those are removed from the raw count instead of
+            # testing presence per locus.
+            n_diff = 0
+            for l in range(n_loci) :
+                if profiles[j, l] != profiles[id, l] :
+                    n_diff += 1
+            n_diff -= n_single
+            _store_pair(n_diff, n_comparable, scaled, n_loci, n_profile, j, id, start, distances, diffs, comparable)
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _asymmetric_kernel(profiles, presences, scaled, start, distances, present) :
+    '''
+    Columns of the asymmetric distances, or if 'present' is not empty, the differences in
+    'distances' and the number of present loci of each column in 'present'.
+    '''
+    n_profile, n_col, n_loci = profiles.shape[0], distances.shape[1], profiles.shape[1]
+    counts = present.shape[0] > 0
+    for i2 in range(n_col) :
+        id = start + i2
+        n_present = 0
+        for l in range(n_loci) :
+            if presences[id, l] :
+                n_present += 1
+        if counts :
+            present[i2] = n_present
+        for j in range(n_profile) :
+            n_diff = 0
+            for l in range(n_loci) :
+                if presences[id, l] and profiles[j, l] != profiles[id, l] :
+                    n_diff += 1
+            if counts :
+                distances[j, i2] = n_diff
+            elif scaled :
+                distances[j, i2] = float(n_diff) * n_loci / n_present
+            else :
+                distances[j, i2] = float(n_diff)
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _asymmetric_wgMLST_kernel(profiles, presences, pp, start, distances) :
+    n_profile, n_col, n_loci = profiles.shape[0], distances.shape[1], profiles.shape[1]
+    for i2 in range(n_col) :
+        id = start + i2
+        n_present = 0
+        for l in range(n_loci) :
+            if presences[id, l] :
+                n_present += 1
+        terms, stack, partial = np.empty(n_loci), np.empty((128, 3), dtype=np.int64), np.empty(128)
+        for j in range(n_profile) :
+            for l in range(n_loci) :
+                terms[l] = 0.
+                if presences[j, l] and presences[id, l] and profiles[j, l] != profiles[id, l] :
+                    terms[l] = 1.
+                if presences[j, l] < presences[id, l] :
+                    terms[l] += pp[l]
+            distances[j, i2] = _pairwise_sum(terms, stack, partial) * float(n_loci) / n_present
+
+@jit(nopython=True, nogil=True, cache=True)
+def _blockwise_kernel(profiles, penalty, start, distances) :
+    n_profile, n_col, n_loci = profiles.shape[0], distances.shape[1], profiles.shape[1]
+    for i2 in range(n_col) :
+        id = start + i2
+        for j in range(n_profile) :
+            # d1: differences that start a block of differences, d2: the rest
+            d1, n_diff, previous = 0, 0, 0
+            for l in range(n_loci) :
+                current = np.int64(profiles[j, l]) - np.int64(profiles[id, l])
+                if current != 0 :
+                    n_diff += 1
+                    if current != previous :
+                        d1 += 1
+                previous = current
+            distances[j, i2] = d1 + (n_diff - d1) * penalty
+
+
+@jit(nopython=True, cache=True)
+def _edge_less(w1, s1, t1, w2, s2, t2) :
+    # edges (s < t) are ordered by weight, then by end points
+    return w1 < w2 or (w1 == w2 and (s1 < s2 or (s1 == s2 and t1 < t2)))
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _minimum_spanning_tree(values, comparable, n_loci, weight) :
+    '''
+    Dense Prim's algorithm in O(n^2) time and O(n) extra memory, on the condensed distances of
+    SymmetricDistances ('comparable' is empty when the values are the distances). The edge (u, v)
+    weighs round(d) + min(weight[u], weight[v]), the smaller of its two directions in methods._symmetric.
+    Ties in weight are broken by the end points, which makes the tree unique and equal to
+    the one Kruskal's algorithm gives when edges are sorted by (weight, source, target).
+    Zero weights between different nodes are not edges, as in networkx.Graph(dist),
+    so the result can be a forest.
+    Returns an (m, 2) array of edges with source < target, and their weights.
+    '''
+    n_node = weight.shape[0]
+    in_tree = np.zeros(n_node, dtype=np.bool_)
+    # the best known edge from the tree to each node
+    best_w, best_s, best_t = np.full(n_node, np.inf), np.full(n_node, -1), np.full(n_node, -1)
+    edges, weights = np.empty((max(n_node - 1, 0), 2), dtype=np.int64), np.empty(max(n_node - 1, 0))
+    n_edge = 0
+    for _ in range(n_node) :
+        u = -1
+        for v in range(n_node) :
+            if in_tree[v] or best_s[v] < 0 :
+                continue
+            if u < 0 or _edge_less(best_w[v], best_s[v], best_t[v], best_w[u], best_s[u], best_t[u]) :
+                u = v
+        if u < 0 :
+            # no edge leaves the tree, start a new component at the first node left
+            for v in range(n_node) :
+                if not in_tree[v] :
+                    u = v
+                    break
+        else :
+            edges[n_edge, 0], edges[n_edge, 1], weights[n_edge] = best_s[u], best_t[u], best_w[u]
+            n_edge += 1
+        in_tree[u] = True
+        for v in range(n_node) :
+            if in_tree[v] :
+                continue
+            s, t = min(u, v), max(u, v)
+            k = s * (2 * n_node - s - 1) // 2 + t - s - 1
+            d = float(values[k])
+            if comparable.shape[0] > 0 :
+                d = d * n_loci / comparable[k]
+            w = np.rint(d) + min(weight[u], weight[v])
+            if w == 0 :
+                continue
+            if best_s[v] < 0 or _edge_less(w, s, t, best_w[v], best_s[v], best_t[v]) :
+                best_w[v], best_s[v], best_t[v] = w, s, t
+    return edges[:n_edge], weights[:n_edge]
+
+
+def _minimum_arborescence(weights) :
+    '''
+    Minimum spanning arborescence of the complete digraph of n nodes with edge weights
+    weights[source, target], given in the first n rows and columns of the (n + 1, n + 1) array
+    'weights', whose last row and column are for a virtual root. 'weights' is used as working
+    space and overwritten. The root is whichever node gives the smallest total weight
+    (Chu-Liu/Edmonds): the virtual root, with an edge heavier than any tree to every node,
+    stands in for the choice of root.
+    Cycles of cheapest entering edges are contracted into the row and column of one of their members,
+    so each contraction costs O(n * cycle length). Uses about 12 bytes per matrix entry, 'weights' included.
+    Returns an (n - 1, 2) array of (source, target) edges.
+    '''
+    # the original end points of the edges, in uint16 unless there are more nodes than it holds
+    index_type = np.uint16 if weights.shape[0] <= np.iinfo(np.uint16).max + 1 else np.int32
+    sources, targets = np.empty(weights.shape, dtype=index_type), np.empty(weights.shape, dtype=index_type)
+    return _arborescence_kernel(weights, sources, targets)
+
+@jit(nopython=True, nogil=True, cache=True)
+def _arborescence_kernel(weights, sources, targets) :
+    n_node = weights.shape[0] - 1
+    root = n_node
+    big = (np.max(weights[:n_node, :n_node]) + 1.) * (n_node + 1)
+    n_max = 2 * n_node + 1
+    # Edge weights between super nodes, and the original end points of each edge.
+    # A super node takes the row and column (the slot) of one of its members.
+    weights[root, :] = big
+    weights[:, root] = np.inf
+    for a in range(n_node + 1) :
+        weights[a, a] = np.inf
+        sources[a, :] = a
+        targets[:, a] = a
+    slot = np.arange(n_node + 1)
+    node_at = np.arange(n_node + 1)
+    alive = np.ones(n_node + 1, dtype=np.bool_)
+    in_w, in_u, in_v, parent = np.full(n_max, np.inf), np.full(n_max, -1), np.full(n_max, -1), np.full(n_max, -1)
+    mark, starts, cycle = np.full(n_node + 1, -1), np.empty(n_node, dtype=np.int64), np.empty(n_node, dtype=np.int64)
+    pending, n_pending, n_super = np.arange(n_node), n_node, n_node + 1
+    while n_pending > 0 :
+        # cheapest entering edge of each new super node
+        for k in range(n_pending) :
+            b = pending[k]
+            best = -1
+            for a in range(n_node + 1) :
+                if alive[a] and a != b and (best < 0 or weights[a, b] < weights[best, b]) :
+                    best = a
+            x = node_at[b]
+            in_w[x], in_u[x], in_v[x] = weights[best, b], sources[best, b], targets[best, b]
+        # find the cycles among the entering edges
+        mark[:] = -1
+        n_pending = 0
+        for b0 in range(n_node) :
+            if not alive[b0] or mark[b0] >= 0 :
+                continue
+            b = b0
+            while b != root and mark[b] < 0 :
+                mark[b] = b0
+                b = slot[in_u[node_at[b]]]
+            if b != root and mark[b] == b0 :
+                starts[n_pending] = b
+                n_pending += 1
+        # contract each cycle into the slot of one of its members
+        for k in range(n_pending) :
+            b = starts[k]
+            n_cycle, c = 0, b
+            while True :
+                cycle[n_cycle] = c
+                n_cycle += 1
+                c = slot[in_u[node_at[c]]]
+                if c == b :
+                    break
+            x = n_super
+            n_super += 1
+            for i in range(n_cycle) :
+                parent[node_at[cycle[i]]] = x
+                mark[cycle[i]] = -2 - k
+            for a in range(n_node + 1) :
+                if not alive[a] or mark[a] == -2 - k :
+                    continue
+                # edges into a member are reduced by the member's entering edge
+                best = -1
+                for i in range(n_cycle) :
+                    c = cycle[i]
+                    if best < 0 or weights[a, c] - in_w[node_at[c]] < weights[a, best] - in_w[node_at[best]] :
+                        best = c
+                weights[a, b], sources[a, b], targets[a, b] = weights[a, best] - in_w[node_at[best]], sources[a, best], targets[a, best]
+                best = -1
+                for i in range(n_cycle) :
+                    c = cycle[i]
+                    if best < 0 or weights[c, a] < weights[best, a] :
+                        best = c
+                weights[b, a], sources[b, a], targets[b, a] = weights[best, a], sources[best, a], targets[best, a]
+            for i in range(1, n_cycle) :
+                alive[cycle[i]] = False
+            for v in range(n_node) :
+                if not alive[slot[v]] :
+                    slot[v] = b
+            node_at[b] = x
+            pending[k] = b
+    # expand the super nodes from the outermost one in: the member holding the target
+    # of the super node's entering edge takes that edge, the others keep their own
+    for x in range(n_super - 1, n_node, -1) :
+        y = in_v[x]
+        while parent[y] != x :
+            y = parent[y]
+        in_u[y], in_v[y] = in_u[x], in_v[x]
+    edges = np.empty((max(n_node - 1, 0), 2), dtype=np.int64)
+    k = 0
+    for v in range(n_node) :
+        if in_u[v] != root :
+            edges[k, 0], edges[k, 1] = in_u[v], v
+            k += 1
+    return edges[:k]
+
+
+def count_dtype(n_loci) :
+    '''The integer type of distance counts of profiles with n_loci loci.'''
+    return np.uint16 if n_loci <= np.iinfo(np.uint16).max else np.uint32
+
+_integers = (int, np.integer)
+
+class Distances(object) :
+    '''
+    A distance matrix as the tree methods read it. The subclasses keep it in different forms,
+    and all are read like a numpy array: dist[i, j] with integers or arrays of them, dist.row(i)
+    for row i, dist.shape and dist.max(). Values are the float64 the dense matrix would hold.
+    '''
+    def max(self) :
+        return np.max([self.row(i).max() for i in range(self.shape[0])])
+    def dense(self) :
+        res = np.empty(self.shape)
+        for i in range(self.shape[0]) :
+            res[i] = self.row(i)
+        return res
+
+class DenseDistances(Distances) :
+    '''A distance matrix kept as a float array, for the matrix types without a compact form.'''
+    def __init__(self, values) :
+        self.values = values
+        self.shape = values.shape
+    def __getitem__(self, key) :
+        return self.values[key]
+    def row(self, i) :
+        return self.values[i]
+    def max(self) :
+        return np.max(self.values)
+    def dense(self) :
+        return self.values
+
+class SymmetricDistances(Distances) :
+    '''
+    A symmetric distance matrix kept as its upper triangle in condensed order: the pair (i, j), i < j,
+    at i*(2n-i-1)/2 + j-i-1, as in scipy's squareform. The values are integer counts of differences,
+    scaled to values * n_loci / comparable when the comparable loci are given ('pair_delete'),
+    which is the division the distance kernels do, so the distances are the same floats.
+    With uint16 counts this takes 1 byte per matrix entry, or 2 bytes with the comparable loci,
+    against 8 for the dense float matrix.
+    '''
+    def __init__(self, n, values, comparable=None, n_loci=1) :
+        self.shape = (n, n)
+        self.values, self.comparable, self.n_loci = values, comparable, n_loci
+        # pairs without comparable loci have nan distances, as from the kernels
+        self.nan_pairs = comparable is not None and not comparable.all()
+        rows = np.arange(n, dtype=np.int64)
+        # the pair (i, j), i < j, is at offsets[i] + j
+        self.offsets = rows * (2*n - rows - 1) // 2 - rows - 1
+        self.columns = rows
+    @classmethod
+    def from_square(cls, dist) :
+        '''The upper triangle of a square matrix, in its own type, e.g. a block of the distance matrix store.'''
+        dist = np.asarray(dist)
+        n = dist.shape[0]
+        res = cls(n, np.empty(n * (n - 1) // 2, dtype=dist.dtype))
+        for i in range(n - 1) :
+            res.values[res.offsets[i] + i + 1 : res.offsets[i] + n] = dist[i, i+1:]
+        return res
+    def _distances(self, k) :
+        if self.comparable is None :
+            return self.values[k].astype(float)
+        if not self.nan_pairs :
+            return self.values[k].astype(float) * self.n_loci / self.comparable[k]
+        with np.errstate(divide='ignore', invalid='ignore') :
+            return self.values[k].astype(float) * self.n_loci / self.comparable[k]
+    def __getitem__(self, key) :
+        i, j = key
+        if isinstance(i, _integers) and isinstance(j, _integers) :
+            if i == j :
+                return np.float64(0.)
+            return self._distances(self.offsets[min(i, j)] + max(i, j))
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+        lo, hi = np.minimum(i, j), np.maximum(i, j)
+        same = (lo == hi)
+        if self.values.size == 0 :
+            return np.zeros(same.shape)
+        res = self._distances(np.where(same, 0, self.offsets[lo] + hi))
+        res[same] = 0.
+        return res
+    def row(self, i) :
+        return self[i, self.columns]
+    def max(self) :
+        chunk = 1 << 22
+        return np.max([0.] + [self._distances(slice(k, k + chunk)).max() for k in range(0, self.values.size, chunk)])
+
+class AsymmetricDistances(Distances) :
+    '''
+    An asymmetric distance matrix kept as integer counts of differences, scaled to
+    values[i, j] * n_loci / present[j] when the present loci of each column are given
+    ('pair_delete'), which is the division the distance kernel does, so the distances are
+    the same floats. With uint16 counts this takes 2 bytes per matrix entry against 8.
+    '''
+    def __init__(self, values, present=None, n_loci=1) :
+        self.values, self.present, self.n_loci = values, present, n_loci
+        self.shape = values.shape
+        self.nan_columns = present is not None and not present.all()
+    def _distances(self, values, j) :
+        if self.present is None :
+            return values.astype(float)
+        if not self.nan_columns :
+            return values.astype(float) * self.n_loci / self.present[j]
+        with np.errstate(divide='ignore', invalid='ignore') :
+            return values.astype(float) * self.n_loci / self.present[j]
+    def __getitem__(self, key) :
+        i, j = key
+        if isinstance(i, _integers) and isinstance(j, _integers) and not self.nan_columns :
+            # the branch recraft reads many single distances
+            if self.present is None :
+                return np.float64(self.values[i, j])
+            return np.float64(float(self.values[i, j]) * self.n_loci / float(self.present[j]))
+        return self._distances(self.values[i, j], j)
+    def row(self, i) :
+        return self._distances(self.values[i], slice(None))
+
+def as_distances(dist) :
+    '''Distances as they are, and arrays as DenseDistances.'''
+    return dist if isinstance(dist, Distances) else DenseDistances(np.asarray(dist))
 
 
 class distance_matrix(object) :
     @staticmethod
-    def get_distance(func, profiles, handle_missing) :
-        from multiprocessing import Pool
-        n_profile = profiles.shape[0]
-        n_proc = min(int(params['n_proc']), profiles.shape[0])
-        np.save(params['prof_file'], profiles)
-        if n_proc > 1 :
-            pool = Pool(n_proc)
-            indices = np.array([[n_profile*v/n_proc+0.5, n_profile*(v+1)/n_proc+0.5] for v in np.arange(n_proc, dtype=float)], dtype=int)
-            del profiles
-            subfiles = pool.map(parallel_distance, [[func, params['prof_file'], params['dist_subfile'], handle_missing, idx] for idx in indices])
-            pool.close()
-            del pool
-            res = np.hstack([ np.load(subfile) for subfile in subfiles ])
-        else :
-            subfiles = [parallel_distance([func, params['prof_file'], params['dist_subfile'], handle_missing, [0, n_profile]])]
-            res = np.load(subfiles[0])
-        for subfile in subfiles :
-            # try :
-            os.unlink(subfile)
-            # except :
-            #     pass
-        np.save(params['dist_file'], res)
+    def get_distance(func, profiles, handle_missing, n_proc=None, packed_presence=None) :
+        res = distance_matrix.get_columns(func, profiles, handle_missing, n_proc=n_proc, packed_presence=packed_presence)
         if func == 'symmetric' :
             res[res.T > res] = res.T[res.T > res]
         return res
     @staticmethod
-    def asymmetric_wgMLST(profiles, handle_missing = 'pair_delete', index_range=None) :
+    def get_compact(func, profiles, handle_missing, n_proc=None, packed_presence=None) :
+        '''
+        The distance matrix in the smallest form the tree methods read: SymmetricDistances for 'symmetric'
+        and AsymmetricDistances for 'asymmetric', both kept as integer counts, and DenseDistances of
+        get_distance for the other matrix types.
+        '''
+        n_loci = profiles.shape[1]
+        if func == 'symmetric' :
+            diffs, comparable = distance_matrix.get_columns(func, profiles, handle_missing, n_proc=n_proc, packed_presence=packed_presence, counts=True)
+            return SymmetricDistances(profiles.shape[0], diffs, comparable if handle_missing == 'pair_delete' else None, n_loci)
+        if func == 'asymmetric' :
+            diffs, present = distance_matrix.get_columns(func, profiles, handle_missing, n_proc=n_proc, counts=True)
+            return AsymmetricDistances(diffs, present if handle_missing != 'absolute_distance' else None, n_loci)
+        return DenseDistances(distance_matrix.get_distance(func, profiles, handle_missing, n_proc=n_proc, packed_presence=packed_presence))
+    @staticmethod
+    def get_columns(func, profiles, handle_missing, start=0, n_proc=None, packed_presence=None, counts=False) :
+        '''
+        Columns [start, n) of the distance matrix, as an (n, n - start) array.
+        With more than one process the profiles are shared once through shared memory,
+        and the pool workers write their column ranges straight into shared output buffers.
+        For 'symmetric', only the part of each column above the diagonal is complete.
+        With 'counts' ('symmetric' and 'asymmetric'), the integer counts the distances are made of,
+        in the type count_dtype gives, instead: for 'symmetric' the differences and the comparable
+        loci of the pairs (j, i), j < i, of the columns, in the condensed arrays of SymmetricDistances
+        (the comparable loci only for 'pair_delete', which scales by them), and for 'asymmetric' the
+        (n, n - start) differences and the present loci of each column.
+        The compiled kernels are serial and release the GIL, so all parallelism comes from
+        the process pool, and in-process calls from different threads run at the same time.
+        'n_proc' and 'packed_presence' default to the module parameters.
+        '''
+        n_profile, n_loci = profiles.shape
+        packed_presence = params['packed_presence'] if packed_presence is None else packed_presence
+        if func == 'symmetric' and packed_presence and handle_missing in ('pair_delete', 'absolute_distance') :
+            func, profiles = 'symmetric_packed', narrow_profiles(profiles)
+        if not counts :
+            shapes = [((n_profile, n_profile - start), np.float64)]
+        elif func == 'asymmetric' :
+            shapes = [((n_profile, n_profile - start), count_dtype(n_loci)), ((n_profile - start, ), np.int64)]
+        else :
+            n_pair = n_profile * (n_profile - 1) // 2
+            shapes = [((n_pair, ), count_dtype(n_loci)), ((n_pair if handle_missing == 'pair_delete' else 0, ), count_dtype(n_loci))]
+        n_proc = min(int(params['n_proc'] if n_proc is None else n_proc), n_profile - start)
+        if n_proc <= 1 :
+            outputs = [np.zeros(shape, dtype=dtype) for shape, dtype in shapes]
+            getattr(distance_matrix, func)(profiles, handle_missing, [start, n_profile], **_output_args(func, outputs, [start, n_profile], start, counts))
+            return outputs[0] if not counts else tuple(outputs)
+
+        shms = [SharedMemory(create=True, size=max(profiles.nbytes, 1))] + \
+               [SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)) for shape, dtype in shapes]
+        try :
+            shared_profiles = np.ndarray(profiles.shape, dtype=profiles.dtype, buffer=shms[0].buf)
+            shared_profiles[:] = profiles
+            # new shared memory is zero filled, as np.zeros would be
+            outputs = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for (shape, dtype), shm in zip(shapes, shms[1:])]
+            prof_info = (shms[0].name, profiles.shape, profiles.dtype.str)
+            out_infos = [(shm.name, output.shape, output.dtype.str) for shm, output in zip(shms[1:], outputs)]
+            callups = [[func, prof_info, out_infos, handle_missing, index_range, start, counts] \
+                       for index_range in chunk_ranges(func, start, n_profile, 4*n_proc)]
+            for index_range in get_pool(n_proc).imap_unordered(parallel_distance, callups) :
+                pass
+            res = [output.copy() for output in outputs]
+        finally :
+            shared_profiles = outputs = None
+            for shm in shms :
+                shm.close()
+                shm.unlink()
+        return res[0] if not counts else tuple(res)
+    @staticmethod
+    def asymmetric_wgMLST(profiles, handle_missing = 'pair_delete', index_range=None, distances=None) :
+        if handle_missing in ('absolute_distance', ) :
+            return distance_matrix.asymmetric(profiles, handle_missing, index_range, distances)
         if index_range is None :
             index_range = [0, profiles.shape[0]]
 
         presences = (profiles > 0)
         pp = np.sum(presences, 0).astype(float)
         pp = pp*(pp-1)/(presences.shape[0]*(presences.shape[0]-1))
-        distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
-
-        if handle_missing not in ('absolute_distance', ) :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum(((profiles != profile) & (presences * presence))+(presences < presence)*pp, axis=1) * float(presence.size)/np.sum(presence)
-                distances[:, i2] = diffs
-        else :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum((profiles != profile) & presence, axis=1)
-                distances[:, i2] = diffs
+        if distances is None :
+            distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
+        _asymmetric_wgMLST_kernel(profiles, presences, pp, index_range[0], distances)
         return distances
 
     @staticmethod
-    def blockwise(profiles, handle_missing = 0.01, index_range=None) :
+    def blockwise(profiles, handle_missing = 0.01, index_range=None, distances=None) :
         if index_range is None :
             index_range = [0, profiles.shape[0]]
 
-        presences = (profiles > 0)
-        distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
-
-        for i2, id in enumerate(np.arange(*index_range)) :
-            profile = profiles[id]
-            diffs = np.hstack([np.zeros([profiles.shape[0], 1], dtype=int), profiles - profile, np.zeros([profiles.shape[0], 1], dtype=int)])
-            d1 = np.sum((diffs[:, 1:] != diffs[:, :-1]) & (diffs[:, 1:] != 0), 1)
-            d2 = np.sum(diffs != 0, 1) - d1
-            distances[:, i2] = d1 + d2 * handle_missing
+        if distances is None :
+            distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
+        _blockwise_kernel(profiles, float(handle_missing), index_range[0], distances)
         return distances
 
     @staticmethod
-    def asymmetric(profiles, handle_missing = 'pair_delete', index_range=None) :
+    def asymmetric(profiles, handle_missing = 'pair_delete', index_range=None, distances=None, counts=None) :
+        '''
+        With 'counts', a pair of arrays (differences, present loci) as get_columns(counts=True) gives them,
+        the counts are written there instead of the distances.
+        '''
         if index_range is None :
             index_range = [0, profiles.shape[0]]
 
         presences = (profiles > 0)
-        distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
-
-        if handle_missing not in ('absolute_distance', ) :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum(((profiles != profile) & presence), axis=1) * float(presence.size)/np.sum(presence)
-                distances[:, i2] = diffs
+        if counts is not None :
+            distances, present = counts
         else :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum((profiles != profile) & presence, axis=1)
-                distances[:, i2] = diffs
-        return distances
+            present = np.empty(0, dtype=np.int64)
+            if distances is None :
+                distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
+        _asymmetric_kernel(profiles, presences, handle_missing not in ('absolute_distance', ), index_range[0], distances, present)
+        return distances if counts is None else counts
 
     @staticmethod
-    def symmetric(profiles, handle_missing = 'pair_delete', index_range=None) :
+    def _symmetric_outputs(profiles, index_range, distances, counts) :
+        if counts is not None :
+            return (np.empty((0, 0)), ) + tuple(counts)
+        if distances is None :
+            distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
+        return distances, np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint16)
+
+    @staticmethod
+    def symmetric(profiles, handle_missing = 'pair_delete', index_range=None, distances=None, counts=None) :
+        '''
+        With 'counts', a pair of condensed arrays (differences, comparable loci) as get_columns(counts=True)
+        gives them, the counts of the pairs (j, i), j < i, of the columns i in index_range are written there
+        instead of the distances.
+        '''
         if index_range is None :
             index_range = [0, profiles.shape[0]]
 
         if handle_missing in ('as_allele', ) :
-            presences = np.ones(shape=profiles.shape, dtype=int)
+            presences = np.ones(shape=profiles.shape, dtype=bool)
         elif handle_missing in ('pair_delete', 'absolute_distance') :
             presences = (profiles > 0)
         else :
             presences = np.repeat(np.sum(profiles >0, 0) >= profiles.shape[0], profiles.shape[0]).reshape([profiles.shape[1], profiles.shape[0]]).T
 
-        distances = np.zeros(shape=[profiles.shape[0], index_range[1] - index_range[0]])
-        if handle_missing in ('pair_delete',) :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                comparable = (presences[:id] * presence)
-                diffs = np.sum((profiles[:id] != profile) & comparable, axis=1) * float(presence.size) / np.sum(comparable, axis=1)
-                distances[:id, i2] = diffs
-                distances[id, :i2] = diffs[index_range[0]:index_range[0]+id]
-        else :
-            for i2, id in enumerate(np.arange(*index_range)) :
-                profile, presence = profiles[id], presences[id]
-                diffs = np.sum((profiles[:id] != profile) & (presences[:id] * presence), axis=1)
-                distances[:id, i2] = diffs
-                distances[id, :i2] = diffs[index_range[0]:index_range[0]+id]
-        return distances
+        outputs = distance_matrix._symmetric_outputs(profiles, index_range, distances, counts)
+        _symmetric_kernel(profiles, presences, handle_missing in ('pair_delete',), index_range[0], index_range[1], *outputs)
+        return outputs[0] if counts is None else counts
+
+    @staticmethod
+    def symmetric_packed(profiles, handle_missing = 'pair_delete', index_range=None, distances=None, counts=None) :
+        '''
+        symmetric() for 'pair_delete' and 'absolute_distance' on bit-packed presence masks.
+        The comparable loci of a pair are counted with popcounts over 64-locus words.
+        '''
+        if index_range is None :
+            index_range = [0, profiles.shape[0]]
+
+        packed = pack_presences(profiles > 0)
+        outputs = distance_matrix._symmetric_outputs(profiles, index_range, distances, counts)
+        _symmetric_packed_kernel(profiles, packed, handle_missing in ('pair_delete',), index_range[0], index_range[1], *outputs)
+        return outputs[0] if counts is None else counts
 
     @staticmethod
     def symmetric_link(profiles, links, handle_missing = 'pair_delete') :
@@ -216,14 +848,23 @@ class distance_matrix(object) :
 
     @staticmethod
     def harmonic(dist, n_str) :
-        weights = dist.shape[0] / np.sum(1.0/(dist + 0.1), 1)
+        dist = as_distances(dist)
+        # row by row, with numpy's summation of each row as np.sum(..., 1) does it
+        weights = dist.shape[0] / np.array([np.sum(1.0/(dist.row(i) + 0.1)) for i in range(dist.shape[0])])
         cw = np.vstack([-np.array(n_str), weights])
         weights[np.lexsort(cw)] = np.arange(dist.shape[0], dtype=float)/dist.shape[0]
         return weights
 
     @staticmethod
     def eBurst(dist, n_str) :
-        weights = np.apply_along_axis(np.bincount, 1, np.hstack([dist.astype(int), np.array([[np.max(dist).astype(int)+1]]*dist.shape[1])]) )
+        dist = as_distances(dist)
+        # the number of nodes at each distance from each node, up to the largest distance + 1,
+        # which every row has once
+        top = int(dist.max()) + 1
+        weights = np.empty((dist.shape[0], top + 1), dtype=np.int32)
+        for i in range(dist.shape[0]) :
+            weights[i] = np.bincount(dist.row(i).astype(int), minlength=top + 1)
+        weights.T[top] += 1
         weights.T[0] += n_str
         dist_order = np.concatenate([[0], np.arange(weights.shape[1]-1, 0, -1)])
         orders = np.lexsort(-weights.T[dist_order])
@@ -233,174 +874,213 @@ class distance_matrix(object) :
 
 
 class methods(object) :
+    @staticmethod
+    def _distance(matrix_type, profiles, handle_missing, dist=None, n_proc=None, packed_presence=None) :
+        '''
+        The precomputed distances when they can stand in for the matrix, otherwise the distances computed from the profiles.
+        Precomputed distances are symmetric pair_delete distances, as in the distance matrix store.
+        '''
+        if dist is not None and matrix_type == 'symmetric' and handle_missing == 'pair_delete' :
+            return SymmetricDistances.from_square(dist)
+        return distance_matrix.get_compact(matrix_type, profiles, handle_missing, n_proc=n_proc, packed_presence=packed_presence)
+
     @staticmethod
     def _blockwise(dist, weight, **params) :
-        x = methods._symmetric(dist*10000., weight, **params)
+        x = methods._symmetric(as_distances(dist).dense()*10000., weight, **params)
         return [[b[0], b[1], b[2]/10000.] for b in x]
     @staticmethod
     def _symmetric(dist, weight, **params) :
-        def minimum_spanning_tree(dist) :
-            n_node = dist.shape[0]
-            nodes = np.arange(n_node)
-            ng = {n:[n] for n in nodes}
-            edges = np.array([ [x, y, dist[x, y]] for y in np.arange(n_node) for x in np.arange(y) ])
-            edges = edges[np.argsort(edges.T[2])].astype(int)
-            mst = []
-            for m, e in enumerate(edges) :
-                if nodes[e[0]] == nodes[e[1]] :
-                    continue
-                mst.append(e.tolist())
-                if nodes[e[0]] > nodes[e[1]] :
-                    s, e = nodes[e[1]], nodes[e[0]]
-                else :
-                    s, e = nodes[e[0]], nodes[e[1]]
-                nodes[ng[e]] = s
-                ng[s].extend(ng.pop(e))
-            return mst
-
-
-        dist = np.round(dist, 0) + weight.reshape([weight.size, -1])
-        np.fill_diagonal(dist, 0.0)
-        dist[dist > dist.T] = dist.T[dist > dist.T]
-        # try:
-        g = nx.Graph(dist)
-        ms = nx.minimum_spanning_tree(g)
-        dist = np.round(dist, 0)
-        return [[d[0], d[1], int(d[2]['weight'])] for d in ms.edges(data=True)]
-        # except :
-        res = minimum_spanning_tree(dist)
-        dist = np.round(dist, 0)
-        return res
+        '''
+        Minimum spanning tree of round(dist) plus the smaller weight of the two ends of each edge,
+        read from the condensed distances. Other matrices are condensed from their upper triangle,
+        so they must be symmetric.
+        '''
+        dist = as_distances(dist)
+        if not isinstance(dist, SymmetricDistances) :
+            dist = SymmetricDistances.from_square(dist.dense())
+        comparable = dist.comparable if dist.comparable is not None else np.empty(0, dtype=dist.values.dtype)
+        edges, weights = _minimum_spanning_tree(dist.values, comparable, dist.n_loci, weight)
+        # same edge order as networkx's minimum_spanning_tree(Graph(dist)).edges()
+        order = np.lexsort((edges.T[1], weights, edges.T[0]))
+        return [[int(s), int(t), int(w)] for (s, t), w in zip(edges[order], weights[order])]
 
     @staticmethod
     def _asymmetric(dist, weight, **params) :
-        def get_shortcut(dist, weight, cutoff=5) :
+        '''
+        Minimum arborescence of wdist = round(dist) + weight of the source, after the shortcuts.
+        The rows of wdist are made from 'dist' when they are needed, and only the rows the shortcuts
+        change are kept, so the arborescence's weights are the only n x n float array.
+        '''
+        dist = as_distances(dist)
+        changed = dict()
+        def wdist_row(s) :
+            if s in changed :
+                return changed[s]
+            row = np.round(dist.row(s), 0) + weight[s]
+            row[s] = 0.
+            return row
+
+        def get_shortcut(weight, cutoff=5) :
             if dist.shape[0] < 10000 :
                 cutoff = 1
-            link = np.array(np.where(dist < (cutoff+1) ))
-            link = link.T[weight[link[0]] < weight[link[1]]].T
-            link = np.vstack([link, dist[tuple(link.tolist())] + weight[link[0]]])
+            sources, targets, values = [], [], []
+            for s in range(dist.shape[0]) :
+                row = wdist_row(s)
+                t = np.flatnonzero(row < (cutoff+1))
+                sources.append(np.full(t.size, s, dtype=np.int64))
+                targets.append(t)
+                values.append(row[t])
+            link = np.vstack([np.concatenate(sources), np.concatenate(targets)])
+            keep = weight[link[0]] < weight[link[1]]
+            link = link.T[keep].T
+            link = np.vstack([link, np.concatenate(values)[keep] + weight[link[0]]])
             link = link.T[np.lexsort(link)]
             return link[np.unique(link.T[1], return_index=True)[1]].astype(int)
 
-        # try:
-        wdist = np.round(dist, 0) + weight.reshape([weight.size, -1])
-        np.fill_diagonal(wdist, 0.0)
-        del dist
-
         presence = np.arange(weight.shape[0])
-        shortcuts = get_shortcut(wdist, weight)
+        shortcuts = get_shortcut(weight)
         for (s, t, d) in shortcuts :
-            wdist[s, wdist[s] > wdist[t]] = wdist[t, wdist[s] > wdist[t]]
+            ws, wt = wdist_row(s), wdist_row(t)
+            ws[ws > wt] = wt[ws > wt]
+            changed[s] = ws
         presence[shortcuts.T[1]] = -1
-        wdist = wdist.T[presence >= 0].T[presence >= 0]
+        for t in shortcuts.T[1] :
+            changed.pop(t, None)
         presence = presence[presence >=0]
 
-        wdist_file = params['tempfix'] + '.wdist.list'
-        with open(wdist_file, 'w') as fout :
-            for d in wdist :
-                fout.write('{0}\n'.format('\t'.join([str(dd) for dd in (d+1.)])))
-        del wdist, d
-        mstree = Popen([params['edmonds_' + platform.system()], wdist_file], stdout=PIPE).communicate()[0]
-        os.unlink(wdist_file)
-        if isinstance(mstree, bytes) :
-            mstree = mstree.decode('utf8')
-        mstree = np.array([ br.strip().split() for br in mstree.strip().split('\n')], dtype=float).astype(int)
+        # the weights of the arborescence, with a last row and column for its virtual root
+        weights = np.empty((presence.size + 1, presence.size + 1))
+        for a, s in enumerate(presence) :
+            weights[a, :presence.size] = wdist_row(s)[presence]
+        mstree = _minimum_arborescence(weights)
+        del weights
         assert mstree.size > 0
-        mstree.T[2] -= 1
         mstree.T[:2] = presence[mstree.T[:2]]
+        lengths = np.round(dist[mstree.T[0], mstree.T[1]], 0) + weight[mstree.T[0]]
+        for e, (s, t) in enumerate(mstree) :
+            if s in changed :
+                lengths[e] = changed[s][t]
+        mstree = np.hstack([mstree, lengths.astype(int).reshape([-1, 1])])
         return mstree.tolist() + shortcuts.tolist()
-        # except :
-        #     try :
-        #         os.unlink(wdist_file)
-        #     except :
-        #         pass
-        #     dist = np.load(params['dist_file'])
-        #     wdist = np.round(dist, 0) + weight.reshape([weight.size, -1])
-        #     np.fill_diagonal(wdist, 0.0)
-        #     del dist
-
-        #     presence = np.arange(weight.shape[0])
-        #     shortcuts = get_shortcut(wdist, weight)
-        #     for (s, t, d) in shortcuts :
-        #         wdist[s, wdist[s] > wdist[t]] = wdist[t, wdist[s] > wdist[t]]
-        #         presence[t] = -1
-        #     wdist = wdist.T[presence >= 0].T[presence >= 0]
-        #     presence = presence[presence >=0]
-
-        #     g = nx.DiGraph(wdist)
-        #     ms = nx.minimum_spanning_arborescence(g)
-        #     return [[presence[d[0]], presence[d[1]], int(d[2]['weight'])] for d in ms.edges(data=True)] + shortcuts.tolist()
 
     @staticmethod
-    def _branch_recraft(branches, dist, weights, n_loci) :
+    def _candidates(weights, dists, nodes, n=None) :
+        '''
+        The nodes in order of (weight, distance, node), as sorted(zip(weights, dists, nodes)) would give them.
+        With 'n', only the first n, found without sorting the others.
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if n is not None and nodes.size > n :
+            keep = weights <= np.partition(weights, n-1)[n-1]
+            weights, dists, nodes = weights[keep], dists[keep], nodes[keep]
+        order = np.lexsort((nodes, dists, weights))[:n]
+        return weights[order], dists[order], nodes[order].tolist()
 
+    @staticmethod
+    def _branch_recraft(branches, dist, weights, n_loci) :
+        '''
+        Moves the ends of each branch, shortest first, to a better fitting node of the same group.
+        A branch that gets longer than the next one is put back among the remaining branches, which are
+        then taken in order of length. They are kept in a heap keyed on (length, sequence), where the
+        sequence reproduces the order of a stable re-sort of the remaining list: a branch that is put back
+        goes before the branches of the same length.
+        Groups are kept in a union-find. For each group only the members with one of its three lowest
+        weights are kept, as only those are candidates for a new end.
+        '''
         if n_loci is None :
-            n_loci = np.max(dist)
+            n_loci = dist.max()
+
+        nodes = {b for br in branches for b in br[:2]}
+        group_id, group_size, group_heads, childrens = {b:b for b in nodes}, {b:1 for b in nodes}, {b:[b] for b in nodes}, {b:[] for b in nodes}
+        def find(b) :
+            while group_id[b] != b :
+                group_id[b] = group_id[group_id[b]]
+                b = group_id[b]
+            return b
 
-        group_id, groups, childrens = {b:b for br in branches for b in br[:2]}, \
-            {b:[b] for br in branches for b in br[:2]}, \
-            {b:[] for br in branches for b in br[:2]}
         branches = sorted(branches, key=lambda br:[dist[br[0], br[1]]] + sorted([weights[br[0]], weights[br[1]]]))
-        i = 0
-        while i < len(branches) :
-            src, tgt, brlen = branches[i]
+        # the branches are taken in the order above until the first one is put back
+        recrafted, heap, n_back, i = [], None, 0, 0
+        while (heap is None and i < len(branches)) or heap :
+            if heap is None :
+                src, tgt, brlen = branches[i]
+                i += 1
+            else :
+                src, tgt, brlen = heapq.heappop(heap)[2]
 
-            sources, targets = groups[group_id[src]], groups[group_id[tgt]]
+            source_id, target_id = find(src), find(tgt)
             tried = {}
-            if len(sources) > 1 :
-                for w, d, s in sorted(zip(weights[sources], dist[sources, tgt], sources))[:3] :
+            if group_size[source_id] > 1 :
+                heads = group_heads[source_id]
+                ws, ds, ss = methods._candidates(weights[heads], dist[heads, tgt], heads, 3)
+                moves = (ds < 1.5*dist[src, tgt]) & contemporary(dist[ss, src], dist[src, ss], ds, dist[src, tgt], n_loci)
+                for s, move in zip(ss, moves) :
                     if s == src : break
-                    if d < 1.5*dist[src, tgt] :
-                        if contemporary([dist[s, src], dist[src, s]], d, dist[src, tgt], n_loci) :
-                            tried[src], src = s, s
-                            break
+                    if move :
+                        tried[src], src = s, s
+                        break
                 while src not in tried :
                     tried[src] = src
-                    mid_nodes = sorted([[weights[s], dist[s,tgt], s] for s in childrens[src] if s not in tried and dist[s,tgt] < 2*dist[src, tgt]])
-                    for w, d, s in mid_nodes :
-                        if d < dist[src, tgt] :
-                            if not contemporary([dist[src, s], dist[s, src]], dist[src, tgt], d, n_loci) :
-                                tried[src], src = s, s
-                                break
-                        elif w < weights[src] :
-                            if contemporary([dist[s, src], dist[src, s]], d, dist[src, tgt], n_loci) :
-                                tried[src], src = s, s
-                                break
+                    mid_nodes = [s for s in childrens[src] if s not in tried]
+                    ws, ds, ss = methods._candidates(weights[mid_nodes], dist[mid_nodes, tgt], mid_nodes)
+                    within = ds < 2*dist[src, tgt]
+                    ws, ds, ss = ws[within], ds[within], [s for s, w in zip(ss, within) if w]
+                    moves = np.where(ds < dist[src, tgt],
+                                     ~contemporary(dist[src, ss], dist[ss, src], dist[src, tgt], ds, n_loci),
+                                     (ws < weights[src]) & contemporary(dist[ss, src], dist[src, ss], ds, dist[src, tgt], n_loci))
+                    for s, move in zip(ss, moves) :
+                        if move :
+                            tried[src], src = s, s
+                            break
                         tried[s] = src
-            if len(targets) > 1 :
-                for w, d, t in sorted(zip(weights[targets], dist[src, targets], targets))[:3] :
+            if group_size[target_id] > 1 :
+                heads = group_heads[target_id]
+                ws, ds, ts = methods._candidates(weights[heads], dist[src, heads], heads, 3)
+                moves = (ds < 1.5*dist[src, tgt]) & contemporary(dist[ts, tgt], dist[tgt, ts], ds, dist[src, tgt], n_loci)
+                for t, move in zip(ts, moves) :
                     if t == tgt : break
-                    if d < 1.5*dist[src, tgt] :
-                        if contemporary([dist[t, tgt], dist[tgt, t]], d, dist[src, tgt], n_loci) :
-                            tried[tgt], tgt = t, t
-                            break
+                    if move :
+                        tried[tgt], tgt = t, t
+                        break
+                # As in GrapeTree, the moves below are tested against, and go to, the last 't' of the loop above
+                # rather than the child being looked at. Kept as is, so that the trees do not change.
                 while tgt not in tried :
                     tried[tgt] = tgt
-                    mid_nodes = sorted([[weights[t], dist[src,t], t] for t in childrens[tgt] if t not in tried and dist[src, t] < 2*dist[src, tgt]])
-                    for w, d, s in mid_nodes :
-                        if d < dist[src, tgt] :
-                            if not contemporary([dist[tgt, t], dist[t, tgt]], dist[src, tgt], d, n_loci) :
-                                tried[tgt], tgt = t, t
-                                break
-                        elif w < weights[tgt] :
-                            if contemporary([dist[t, tgt], dist[tgt, t]], d, dist[src, tgt], n_loci) :
-                                tried[tgt], tgt = t, t
-                                break
+                    mid_nodes = [c for c in childrens[tgt] if c not in tried]
+                    ws, ds, cs = methods._candidates(weights[mid_nodes], dist[src, mid_nodes], mid_nodes)
+                    within = ds < 2*dist[src, tgt]
+                    ws, ds = ws[within], ds[within]
+                    moves = np.where(ds < dist[src, tgt],
+                                     ~contemporary(dist[tgt, t], dist[t, tgt], dist[src, tgt], ds, n_loci),
+                                     (ws < weights[tgt]) & contemporary(dist[t, tgt], dist[tgt, t], ds, dist[src, tgt], n_loci))
+                    for move in moves :
+                        if move :
+                            tried[tgt], tgt = t, t
+                            break
                         tried[t] = tgt
             brlen = dist[src, tgt]
-            branches[i] = [src, tgt, brlen]
-            if i >= len(branches) - 1 or branches[i+1][2] >= brlen:
-                tid = group_id[tgt]
-                for t in targets :
-                    group_id[t] = group_id[src]
-                groups[group_id[src]].extend(groups.pop(tid, []))
+            if heap is None :
+                next_brlen = branches[i][2] if i < len(branches) else None
+            else :
+                next_brlen = heap[0][0] if heap else None
+            if next_brlen is None or next_brlen >= brlen :
+                if group_size[source_id] < group_size[target_id] :
+                    source_id, target_id = target_id, source_id
+                heads = group_heads[source_id] + group_heads.pop(target_id)
+                third = np.partition(weights[heads], min(2, len(heads)-1))[min(2, len(heads)-1)]
+                group_heads[source_id] = [h for h in heads if weights[h] <= third]
+                group_id[target_id] = source_id
+                group_size[source_id] += group_size.pop(target_id)
                 childrens[src].append(tgt)
                 childrens[tgt].append(src)
-                i += 1
+                recrafted.append([src, tgt, brlen])
             else :
-                branches[i:] = sorted(branches[i:], key=lambda br:br[2])
-        return branches
+                if heap is None :
+                    heap = [(br[2], seq, br) for seq, br in enumerate(branches[i:])]
+                    heapq.heapify(heap)
+                n_back += 1
+                heapq.heappush(heap, (brlen, -n_back, [src, tgt, brlen]))
+        return recrafted
 
     @staticmethod
     def _network2tree(branches, names) :
@@ -440,18 +1120,25 @@ class methods(object) :
 
 
     @staticmethod
-    def MSTree(names, profiles, embeded, matrix_type='asymmetric', heuristic='harmonic', branch_recraft=True, handle_missing='pair_delete', **params) :
+    def MSTree(names, profiles, embeded, matrix_type='asymmetric', heuristic='harmonic', branch_recraft=True, handle_missing='pair_delete', dist=None, stages=None, **params) :
+        stages = stages or Stages()
         n_loci = profiles.shape[1]
-        dist = distance_matrix.get_distance(matrix_type, profiles, handle_missing)
-        weight = eval('distance_matrix.'+heuristic)(dist, [len(embeded[n]) for n in names])
-
-        tree = eval('methods._'+matrix_type)(dist, weight, **params)
+        with stages('distance') :
+            dist = methods._distance(matrix_type, profiles, handle_missing, dist, params.get('n_proc'), params.get('packed_presence'))
+        with stages('weights') :
+            weight = eval('distance_matrix.'+heuristic)(dist, [len(embeded[n]) for n in names])
+
+        with stages('spanning_tree') :
+            # wgMLST distances are asymmetric too, and take the same spanning arborescence
+            tree = eval('methods._'+('asymmetric' if matrix_type == 'asymmetric_wgMLST' else matrix_type))(dist, weight, **params)
         if branch_recraft :
-            tree = methods._branch_recraft(tree, np.load(params['dist_file']), weight, n_loci)
-            del dist
-        if matrix_type != 'blockwise' :
-            tree = distance_matrix.symmetric_link(np.load(params['prof_file']), tree, handle_missing= handle_missing)
-        tree = methods._network2tree(tree, names)
+            with stages('branch_recraft') :
+                tree = methods._branch_recraft(tree, dist, weight, n_loci)
+        del dist
+        with stages('network2tree') :
+            if matrix_type != 'blockwise' :
+                tree = distance_matrix.symmetric_link(profiles, tree, handle_missing= handle_missing)
+            tree = methods._network2tree(tree, names)
         return tree
 
     @staticmethod
@@ -473,7 +1160,8 @@ class methods(object) :
         return tree
 
     @staticmethod
-    def distance(names, profiles, embeded, matrix_type='symmetric', handle_missing='pair_delete', **params) :
+    def distance(names, profiles, embeded, matrix_type='symmetric', handle_missing='pair_delete', stages=None, **params) :
+        stages = stages or Stages()
         ids = {n:id for id, n in enumerate(names)}
         ids = { gg:ids[k] for k,g in embeded.items() for gg in g }
         names, indices = [], []
@@ -481,30 +1169,35 @@ class methods(object) :
             names.append(n)
             indices.append(i)
         indices = np.array(indices)
-        d = distance_matrix.get_distance(matrix_type, profiles, handle_missing)
-        if handle_missing != 'absolute_distance' and matrix_type != 'blockwise' :
-            d /= profiles.shape[1]
-
-        dist = np.zeros([len(names), len(names)])
-        for i, i2 in enumerate(indices) :
-            dist[i] = d[i2, indices]
-        dist_txt = ['    {0}'.format(dist.shape[0])]
-        for n, d in zip(names, dist) :
-            dist_txt.append('{0!s:10} {1}'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])))
+        with stages('distance') :
+            dist = distance_matrix.get_compact(matrix_type, profiles, handle_missing, params.get('n_proc'), params.get('packed_presence'))
+        scaled = handle_missing != 'absolute_distance' and matrix_type != 'blockwise'
+
+        with stages('phylip') :
+            dist_txt = ['    {0}'.format(len(names))]
+            for n, i2 in zip(names, indices) :
+                d = dist.row(i2)[indices]
+                if scaled :
+                    d /= profiles.shape[1]
+                dist_txt.append('{0!s:10} {1}'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])))
         return dist_txt
 
     @staticmethod
-    def fastme(names, profiles, embeded, handle_missing='pair_delete', **params) :
-        dist = distance_matrix.get_distance('symmetric', profiles, handle_missing)
+    def fastme(names, profiles, embeded, handle_missing='pair_delete', dist=None, stages=None, **params) :
+        stages = stages or Stages()
+        with stages('distance') :
+            dist = methods._distance('symmetric', profiles, handle_missing, dist, params.get('n_proc'), params.get('packed_presence'))
 
         dist_file = params['tempfix'] + 'dist.list'
-        with open(dist_file, 'w') as fout :
+        with stages('phylip'), open(dist_file, 'w') as fout :
             fout.write('    {0}\n'.format(dist.shape[0]))
-            for n, d in enumerate(dist) :
+            for n in range(dist.shape[0]) :
+                d = dist.row(n)
                 fout.write( '{0!s:10} {1}\n'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])) )
         del dist, d
         # try :
-        Popen([params['NJ_{0}'.format(platform.system())], '-i', dist_file, '-m', 'B', '-n', 'B'], stdout=PIPE).communicate()
+        with stages('program') :
+            Popen([params['NJ_{0}'.format(platform.system())], '-i', dist_file, '-m', 'B', '-n', 'B'], stdout=PIPE).communicate()
         # except Exception as e :
         #     if platform.system() == 'Linux' :
         #         Popen([params['NJ_Linux32'], '-i', dist_file, '-m', 'N'], stdout=PIPE).communicate()
@@ -524,17 +1217,21 @@ class methods(object) :
             leaf.name = names[int(leaf.name.strip("'"))]
         return tree
     @staticmethod
-    def NJ(names, profiles, embeded, handle_missing='pair_delete', **params) :
-        dist = distance_matrix.get_distance('symmetric', profiles, handle_missing)
+    def NJ(names, profiles, embeded, handle_missing='pair_delete', dist=None, stages=None, **params) :
+        stages = stages or Stages()
+        with stages('distance') :
+            dist = methods._distance('symmetric', profiles, handle_missing, dist, params.get('n_proc'), params.get('packed_presence'))
 
         dist_file = params['tempfix'] + 'dist.list'
-        with open(dist_file, 'w') as fout :
+        with stages('phylip'), open(dist_file, 'w') as fout :
             fout.write('    {0}\n'.format(dist.shape[0]))
-            for n, d in enumerate(dist) :
+            for n in range(dist.shape[0]) :
+                d = dist.row(n)
                 fout.write( '{0!s:10} {1}\n'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])) )
         del dist, d
         # try :
-        Popen([params['NJ_{0}'.format(platform.system())], '-i', dist_file, '-m', 'N'], stdout=PIPE).communicate()
+        with stages('program') :
+            Popen([params['NJ_{0}'.format(platform.system())], '-i', dist_file, '-m', 'N'], stdout=PIPE).communicate()
         # except Exception as e :
         #     if platform.system() == 'Linux' :
         #         Popen([params['NJ_Linux32'], '-i', dist_file, '-m', 'N'], stdout=PIPE).communicate()
@@ -554,16 +1251,20 @@ class methods(object) :
             leaf.name = names[int(leaf.name.strip("'"))]
         return tree
     @staticmethod
-    def RapidNJ(names, profiles, embeded, handle_missing='pair_delete', **params) :
-        dist = distance_matrix.get_distance('symmetric', profiles, handle_missing)
+    def RapidNJ(names, profiles, embeded, handle_missing='pair_delete', dist=None, stages=None, **params) :
+        stages = stages or Stages()
+        with stages('distance') :
+            dist = methods._distance('symmetric', profiles, handle_missing, dist, params.get('n_proc'), params.get('packed_presence'))
 
         dist_file = params['tempfix'] + 'dist.list'
-        with open(dist_file, 'w') as fout :
+        with stages('phylip'), open(dist_file, 'w') as fout :
             fout.write('    {0}\n'.format(dist.shape[0]))
-            for n, d in enumerate(dist) :
+            for n in range(dist.shape[0]) :
+                d = dist.row(n)
                 fout.write( '{0!s:10} {1}\n'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])) )
         del dist, d
-        Popen([params['RapidNJ_{0}'.format(platform.system())], '-n', '-x', dist_file+'_rapidnj.nwk', '-i', 'pd', dist_file], stdout=PIPE, stderr=PIPE).communicate()
+        with stages('program') :
+            Popen([params['RapidNJ_{0}'.format(platform.system())], '-n', '-x', dist_file+'_rapidnj.nwk', '-i', 'pd', dist_file], stdout=PIPE, stderr=PIPE).communicate()
         tree = Tree(dist_file + '_rapidnj.nwk')
         for fname in glob(dist_file + '*') :
             os.unlink(fname)
@@ -578,17 +1279,20 @@ class methods(object) :
             leaf.name = names[int(leaf.name.strip("'"))]
         return tree
     @staticmethod
-    def ninja(names, profiles, embeded, handle_missing='pair_delete', **params) :
-        dist = distance_matrix.get_distance('symmetric', profiles, handle_missing)
-        dist = dist/profiles.shape[1]
+    def ninja(names, profiles, embeded, handle_missing='pair_delete', stages=None, **params) :
+        stages = stages or Stages()
+        with stages('distance') :
+            dist = distance_matrix.get_compact('symmetric', profiles, handle_missing, params.get('n_proc'), params.get('packed_presence'))
         dist_file = params['tempfix'] + 'dist.list'
-        with open(dist_file, 'w') as fout :
+        with stages('phylip'), open(dist_file, 'w') as fout :
             fout.write('    {0}\n'.format(dist.shape[0]))
-            for n, d in enumerate(dist) :
+            for n in range(dist.shape[0]) :
+                d = dist.row(n)/profiles.shape[1]
                 fout.write( '{0!s:10} {1}\n'.format(n, ' '.join(['{:.6f}'.format(dd) for dd in d])) )
         del dist, d
         free_memory = int(0.9*psutil.virtual_memory().total/(1024.**2))
-        ninja_out = Popen(['java', '-server', '-Xmx'+str(free_memory)+'M', '-jar', params['ninja_{0}'.format(platform.system())], '--in_type', 'd', dist_file], stdout=PIPE, stderr=PIPE, universal_newlines=True).communicate()
+        with stages('program') :
+            ninja_out = Popen(['java', '-server', '-Xmx'+str(free_memory)+'M', '-jar', params['ninja_{0}'.format(platform.system())], '--in_type', 'd', dist_file], stdout=PIPE, stderr=PIPE, universal_newlines=True).communicate()
         tree = Tree(ninja_out[0])
         for fname in glob(dist_file + '*') :
             os.unlink(fname)
@@ -606,10 +1310,14 @@ class methods(object) :
             leaf.name = names[int(leaf.name.strip("'"))]
         return tree
 
-def nonredundant(names, profiles) :
-    encoded_profile = np.array([np.unique(p, return_inverse=True)[1]+1 for p in profiles.T]).T
-    encoded_profile[ (profiles == '0') | (profiles == 'N') | (profiles == '-')] = 0
-    if params['handle_missing'] == 'complete_delete' :
+def nonredundant(names, profiles, handle_missing='pair_delete') :
+    if np.issubdtype(profiles.dtype, np.integer) :
+        # already encoded per locus, with 0 for missing data
+        encoded_profile = profiles
+    else :
+        encoded_profile = np.array([np.unique(p, return_inverse=True)[1]+1 for p in profiles.T]).T
+        encoded_profile[ (profiles == '0') | (profiles == 'N') | (profiles == '-')] = 0
+    if handle_missing == 'complete_delete' :
         encoded_profile = encoded_profile[:, np.sum(encoded_profile == 0, 0) > 0]
     names = names[np.lexsort(encoded_profile.T)]
     profiles = encoded_profile[np.lexsort(encoded_profile.T)]
@@ -660,24 +1368,94 @@ def backend(**args) :
 
         To obtain a standard distance matrix :
         backend(profile=<filename>, method='distance')
+
+        To skip the text parsing when the profiles are already in memory, see backend_matrix.
+        To build several trees at the same time, see TreeEngine.
     '''
-    global params
-    params.update(args)
-    if params['method'] == 'MSTreeV2' :
-        params['method'] = 'MSTree'
-        params['matrix_type'] = 'asymmetric'
-        params['heuristic'] = 'harmonic'
-        params['branch_recraft'] = True
+    return TreeEngine(**args).profile_tree(args['profile'])
 
-    if params['wgMLST'] and params['matrix_type'] == 'asymmetric' :
-        matrix_type = 'asymmetric_wgMLST'
+def backend_matrix(names, profiles, dist=None, **args) :
+    '''
+    In-process entry point that takes the profiles as arrays instead of text.
+    paramters :
+        names: array of sample names, one per row of profiles
+        profiles: integer array with one row per sample and one column per locus.
+                  Alleles are encoded per locus, and 0 means missing data.
+        dist: optional symmetric pair_delete distances between the samples, in the order of names,
+              e.g. a block of the distance matrix store. MSTree with a symmetric matrix and the NJ
+              methods use them instead of comparing the profiles.
+        Other parameters as for backend.
 
+    Outputs :
+        A string of a NEWICK tree
 
+    Examples :
+        backend_matrix(names, profiles, method='MSTreeV2')
+    '''
+    return TreeEngine(**args).tree(names, profiles, dist)
+
+def update_params(args) :
+    '''
+    The parameters of a tree: the module defaults updated with 'args', with MSTreeV2 expanded.
+    '''
+    tree_params = dict(params, **args)
+    if tree_params['method'] == 'MSTreeV2' :
+        tree_params['method'] = 'MSTree'
+        tree_params['matrix_type'] = 'asymmetric'
+        tree_params['heuristic'] = 'harmonic'
+        tree_params['branch_recraft'] = True
+
+    if tree_params['wgMLST'] and tree_params['matrix_type'] == 'asymmetric' :
+        tree_params['matrix_type'] = 'asymmetric_wgMLST'
+    return tree_params
+
+class TreeEngine(object) :
+    '''
+    Builds trees with its own parameters, so that several trees can be built at the same
+    time in threads or processes.
+    paramters :
+        scratch_dir: directory for the temporary files of the external programs (FastME, RapidNJ, ninja).
+                     Every tree gets a new directory in it, removed when the tree is done.
+                     [DEFAULT: the system temporary directory]
+        Other parameters as for backend. They apply to every tree of the engine, and the
+        parameters given to tree() and profile_tree() apply to that tree only.
+
+    Examples :
+        engine = TreeEngine(method='MSTree', n_proc=4)
+        tree = engine.tree(names, profiles)
+        tree = engine.tree(names, profiles, method='NJ')
+
+        To time the stages of a tree :
+        stages = Stages()
+        tree = engine.tree(names, profiles, stages=stages)
+        stages.spans
+    '''
+    def __init__(self, scratch_dir=None, **args) :
+        self.scratch_dir = scratch_dir
+        self.args = args
+
+    def tree(self, names, profiles, dist=None, stages=None, **args) :
+        '''
+        A NEWICK tree of in-memory profiles, as for backend_matrix.
+        The stages of the tree are recorded in 'stages' if given.
+        '''
+        return build_tree(np.asarray(names), np.asarray(profiles), dist, update_params(dict(self.args, **args)), self.scratch_dir, stages)
+
+    def profile_tree(self, profile, stages=None, **args) :
+        '''
+        A NEWICK tree of a profile or fasta file, or its content as a string, as for backend.
+        '''
+        stages = stages or Stages()
+        with stages('read_profile') :
+            names, profiles = read_profile(profile)
+        return build_tree(names, np.char.upper(profiles), None, update_params(dict(self.args, **args)), self.scratch_dir, stages)
+
+def read_profile(profile) :
     names, profiles = [], []
     # try :
-    fin = open(params['profile']).readlines() if os.path.isfile(params['profile']) else params['profile'].split('\n')
+    fin = open(profile).readlines() if os.path.isfile(profile) else profile.split('\n')
     # except :
-    #     fin = params['profile'].split('\n')
+    #     fin = profile.split('\n')
 
     allele_cols = None
     for line_id, line in enumerate(fin) :
@@ -715,21 +1493,30 @@ def backend(**args) :
                 profiles.append(np.array(part)[allele_cols])
             else :
                 profiles.append(part[1:])
-    profiles = np.char.upper(profiles)
+    return names, profiles
+
+def build_tree(names, profiles, dist=None, params=params, scratch_dir=None, stages=None) :
+    stages = stages or Stages()
     names = [re.sub(r'[\(\)\ \,\"\';]', '_', n) for n in names]
-    names, profiles, embeded = nonredundant(np.array(names), np.array(profiles))
+    rows = {n:i for i, n in enumerate(names)}
+    with stages('nonredundant') :
+        names, profiles, embeded = nonredundant(np.array(names), np.array(profiles), params['handle_missing'])
+    if dist is not None :
+        # keep the rows and columns of the remaining (non-redundant) samples
+        rows = np.array([rows[n] for n in names], dtype=np.int64)
+        dist = np.asarray(dist)[np.ix_(rows, rows)]
     if int(params.get('checkEnv', False)) :
         time, memory = estimate_Consumption(platform.system(), params['method'], params['matrix_type'], int(params['n_proc']), profiles.shape[1], profiles.shape[0])
         free_memory = psutil.virtual_memory().available
         import json
         return json.dumps(dict(time=time, memory=memory, affordable=free_memory >= memory))
-    with tempfile.NamedTemporaryFile(delete=True, dir='.') as f :
-        params['tempfix'] = f.name
-        params['prof_file'] = params['tempfix']+'.prof.npy'
-        params['dist_file'] = params['tempfix']+'.dist.npy'
-        params['dist_subfile'] = params['tempfix']+'.dist.{0}.npy'
-        tre = eval('methods.' + params['method'])(names, profiles, embeded, **params)
-        if params['method'] != 'distance' :
+    scratch = tempfile.mkdtemp(prefix='tree_', dir=scratch_dir)
+    try :
+        params = dict(params, tempfix=os.path.join(scratch, 'tree_'))
+        tre = eval('methods.' + params['method'])(names, profiles, embeded, dist=dist, stages=stages, **params)
+        if params['method'] == 'distance' :
+            return '\n'.join(tre)
+        with stages('newick') :
             maxDist = 0.
             for node in tre.iter_descendants() :
                 if node.dist > maxDist: maxDist = node.dist
@@ -745,20 +1532,9 @@ def backend(**args) :
                     leaf.name = ''
                     for n in embeded_group :
                         leaf.add_child(name=n, dist=0.)
-
-            for fname in (params['prof_file'], params['dist_file']) :
-                # try:
-                os.unlink(fname)
-                # except :
-                #     pass
             return tre.write(format=1).replace("'", "")
-        else :
-            for fname in (params['prof_file'], params['dist_file']) :
-                # try:
-                os.unlink(fname)
-                # except :
-                #     pass
-            return '\n'.join(tre)
+    finally :
+        shutil.rmtree(scratch, ignore_errors=True)
 
 def estimate_Consumption(platform, method, matrix, n_proc, n_loci, n_profile) :
     if method in ('MSTree', 'RapidNJ') :
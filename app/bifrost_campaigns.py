@@ -0,0 +1,154 @@
+"""
+Bulk submission of Bifrost jobs.
+
+A campaign reprocesses many sequences with the same analyses. Its sequences
+are split into batches of 'batch_size', and each batch is submitted to the HPC
+as one launch script command. Batches are submitted in the background, at most
+'concurrency' at a time, over the pooled SSH connections (see hpc).
+
+The campaign is stored in db.bifrost_campaigns with the number of its batches
+in each state, and every batch in db.bifrost_batches:
+
+    Queued    not submitted yet
+    Running   launch command running
+    Accepted  launch command finished without error
+    Failed    launch command reported an error or could not be run
+
+The counts are updated with each batch, so the progress of a campaign is read
+from a single document. While a batch's launch command runs, its 'heartbeat'
+is renewed every 'heartbeat_seconds'. When an API worker starts, it marks the
+Running batches without a heartbeat for 'stale_seconds' Failed, as their
+worker stopped and they may already have been submitted, and submits the
+queued batches of every campaign. Batches being submitted by the other API
+workers are left alone.
+"""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from starlette.concurrency import run_in_threadpool
+
+from models import BifrostCampaign, JobStatus
+
+DEFAULTS = dict(
+    batch_size=20,    # sequences per launch command
+    concurrency=8,    # launch commands running at a time
+    heartbeat_seconds=30,
+    stale_seconds=300,  # a Running batch without a heartbeat for this long is failed at startup
+)
+
+UNFINISHED = (JobStatus.Queued.value, JobStatus.Running.value)
+STATES = UNFINISHED + (JobStatus.Accepted.value, JobStatus.Failed.value)
+
+
+def create_indexes(db):
+    db.bifrost_batches.create_index([('campaign', ASCENDING), ('status', ASCENDING), ('index', ASCENDING)])
+
+
+def create(db, sequences: list[str], analyses: list[str], batch_size: int) -> ObjectId:
+    """Store a campaign and its queued batches."""
+    batches = [sequences[start:start + batch_size] for start in range(0, len(sequences), batch_size)]
+    campaign_id = db.bifrost_campaigns.insert_one({
+        'created': datetime.now(),
+        'analyses': analyses,
+        'batch_size': batch_size,
+        'n_sequences': len(sequences),
+        'n_batches': len(batches),
+        'batches': dict({state: 0 for state in STATES}, **{JobStatus.Queued.value: len(batches)}),
+    }).inserted_id
+    if batches:
+        db.bifrost_batches.insert_many([
+            {'campaign': campaign_id, 'index': index, 'sequences': batch, 'status': JobStatus.Queued.value}
+            for index, batch in enumerate(batches)])
+    return campaign_id
+
+
+def _move(db, batch: dict, status: str, **fields):
+    """Change the state of a batch, and the campaign's counts with it."""
+    if db.bifrost_batches.update_one({'_id': batch['_id'], 'status': batch['status']},
+                                     {'$set': dict(fields, status=status)}).modified_count:
+        db.bifrost_campaigns.update_one({'_id': batch['campaign']},
+                                        {'$inc': {f"batches.{batch['status']}": -1, f"batches.{status}": 1}})
+        batch['status'] = status
+        return True
+    return False
+
+
+async def submit(db, campaign_id: ObjectId, run, command, concurrency: int, heartbeat_seconds: float):
+    """
+    Submit the queued batches of a campaign.
+    'run' is a coroutine function that runs a shell command on the HPC, and
+    'command' gives the launch command for a batch of sequences and analyses.
+    The database calls run in threads, so they do not block the event loop.
+    """
+    campaign = await run_in_threadpool(db.bifrost_campaigns.find_one, {'_id': campaign_id})
+    semaphore = asyncio.Semaphore(concurrency)
+    running = set()
+
+    async def submit_batch(batch):
+        async with semaphore:
+            now = datetime.now()
+            if not await run_in_threadpool(_move, db, batch, JobStatus.Running.value, started_at=now, heartbeat=now):
+                return
+            running.add(batch['_id'])
+            try:
+                stdout, stderr = await run(command(batch['sequences'], campaign['analyses']))
+            except Exception as e:
+                await run_in_threadpool(_move, db, batch, JobStatus.Failed.value, error=repr(e), finished_at=datetime.now())
+                return
+            finally:
+                running.discard(batch['_id'])
+            status = JobStatus.Failed if 'error' in str(stdout) else JobStatus.Accepted
+            await run_in_threadpool(_move, db, batch, status.value, process_out=str(stdout), process_error=str(stderr),
+                                    finished_at=datetime.now())
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(heartbeat_seconds)
+            if running:
+                await run_in_threadpool(db.bifrost_batches.update_many,
+                                        {'_id': {'$in': list(running)}, 'status': JobStatus.Running.value},
+                                        {'$set': {'heartbeat': datetime.now()}})
+
+    batches = await run_in_threadpool(lambda: list(db.bifrost_batches.find(
+        {'campaign': campaign_id, 'status': JobStatus.Queued.value}).sort('index', ASCENDING)))
+    beating = asyncio.ensure_future(heartbeat())
+    try:
+        await asyncio.gather(*[submit_batch(batch) for batch in batches])
+    finally:
+        beating.cancel()
+    campaign = await run_in_threadpool(db.bifrost_campaigns.find_one, {'_id': campaign_id})
+    print(f"Submitted Bifrost campaign {campaign_id}: {campaign['batches']}")
+
+
+def interrupted(db, stale_seconds: float) -> list[ObjectId]:
+    """
+    At startup: fail the batches whose worker stopped while submitting them, and
+    return the campaigns with queued batches.
+    """
+    limit = datetime.now() - timedelta(seconds=stale_seconds)
+    # Batches from before heartbeats were kept only have started_at
+    stale = {'status': JobStatus.Running.value, '$or': [{'heartbeat': {'$lt': limit}},
+                                                        {'heartbeat': {'$exists': False}, 'started_at': {'$lt': limit}}]}
+    for batch in db.bifrost_batches.find(stale):
+        _move(db, batch, JobStatus.Failed.value, error='Interrupted while being submitted', finished_at=datetime.now())
+    return db.bifrost_batches.distinct('campaign', {'status': JobStatus.Queued.value})
+
+
+def progress(db, campaign_id: str) -> BifrostCampaign:
+    campaign = db.bifrost_campaigns.find_one({'_id': ObjectId(campaign_id)}) if ObjectId.is_valid(campaign_id) else None
+    if campaign is None:
+        return BifrostCampaign(job_id=campaign_id, status=JobStatus.Failed, error=f"No campaign with id {campaign_id}")
+    batches = campaign['batches']
+    if any(batches[state] for state in UNFINISHED):
+        status = JobStatus.Running
+    elif batches[JobStatus.Failed.value]:
+        status = JobStatus.Failed
+    else:
+        status = JobStatus.Succeeded
+    return BifrostCampaign(job_id=campaign_id, status=status, analyses=campaign['analyses'],
+                           batch_size=campaign['batch_size'], n_sequences=campaign['n_sequences'],
+                           n_batches=campaign['n_batches'], batches=batches, started_at=campaign['created'])
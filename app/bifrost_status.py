@@ -0,0 +1,161 @@
+"""
+Batched, cached status of Bifrost jobs on the HPC.
+
+The frontend polls the status of every job it shows, every few seconds. Rather
+than running 'checkjob' once per poll, StatusCache keeps the last status of
+each requested job for 'ttl_seconds'. When a request needs a status that is
+missing or older, the statuses of all jobs polled within 'forget_seconds' that
+are due are fetched together with one command:
+
+    for j in 1234 1235; do echo "### $j"; checkjob "$j" 2>&1; done
+
+Requests that arrive while a fetch is running wait for that fetch instead of
+starting another, so the number of HPC commands follows the TTL, not the
+number of clients and jobs. Finished jobs do not change, so their status is
+kept for 'finished_ttl_seconds'.
+
+The Moab state of each job is mapped to a JobStatus:
+
+    Idle, Deferred, *Hold, Blocked, NotQueued   Queued
+    Starting, Running, Suspended                Running
+    Completed with completion code 0            Succeeded
+    Completed otherwise, Removed, Vacated       Failed
+    job not found                               Failed
+"""
+from __future__ import annotations
+
+import asyncio
+import re
+import shlex
+import time
+
+from models import BifrostJob, JobStatus
+
+DEFAULTS = dict(
+    ttl_seconds=10,
+    finished_ttl_seconds=300,
+    forget_seconds=120,  # jobs not polled for this long are left out of the batches
+    max_batch=200,       # job ids per command
+)
+
+MARKER = '### '
+JOB_ID = re.compile(r'[\w.\-\[\]]+')
+STATES = {
+    'Idle': JobStatus.Queued, 'Deferred': JobStatus.Queued, 'Hold': JobStatus.Queued,
+    'UserHold': JobStatus.Queued, 'SystemHold': JobStatus.Queued, 'BatchHold': JobStatus.Queued,
+    'Blocked': JobStatus.Queued, 'NotQueued': JobStatus.Queued,
+    'Starting': JobStatus.Running, 'Running': JobStatus.Running, 'Suspended': JobStatus.Running,
+    'Removed': JobStatus.Failed, 'Vacated': JobStatus.Failed,
+}
+FINISHED = (JobStatus.Succeeded, JobStatus.Failed)
+
+
+def valid_job_id(job_id: str) -> bool:
+    """Job ids go into a shell command, so only scheduler job id characters are allowed."""
+    return JOB_ID.fullmatch(job_id) is not None
+
+
+def batch_command(job_ids) -> str:
+    ids = ' '.join(shlex.quote(job_id) for job_id in job_ids)
+    return f"for j in {ids}; do echo \"{MARKER}$j\"; checkjob \"$j\" 2>&1; done"
+
+
+def parse_checkjob(lines: list[str]) -> BifrostJob:
+    """The status of one job from its checkjob output."""
+    job = BifrostJob(process_out=str(lines))
+    state, completion_code = None, None
+    for line in lines:
+        if line.startswith('State:'):
+            state = line.split()[1] if len(line.split()) > 1 else None
+        elif line.startswith('Completion Code:'):
+            fields = line.split()
+            completion_code = int(fields[2]) if len(fields) > 2 and fields[2].lstrip('-').isdigit() else None
+    if state == 'Completed':
+        job.status = JobStatus.Succeeded if completion_code == 0 else JobStatus.Failed
+        if completion_code != 0:
+            job.error = f"Completion code {completion_code}"
+    elif state in STATES:
+        job.status = STATES[state]
+    else:
+        job.status = JobStatus.Failed
+        job.error = next((line.strip() for line in lines if 'ERROR' in line or 'cannot locate' in line),
+                         f"Unknown job state {state}")
+    return job
+
+
+def parse_batch(lines: list[str]) -> dict:
+    """Statuses of all jobs in the output of batch_command, by job id."""
+    blocks, job_id = dict(), None
+    for line in lines:
+        if line.startswith(MARKER):
+            job_id = line[len(MARKER):].strip()
+            blocks[job_id] = list()
+        elif job_id is not None:
+            blocks[job_id].append(line)
+    return {job_id: parse_checkjob(block) for job_id, block in blocks.items()}
+
+
+class StatusCache(object):
+    """
+    Job statuses fetched in batches through 'run', a coroutine function that
+    runs a shell command on the HPC and returns its stdout and stderr lines.
+    """
+
+    def __init__(self, run, ttl_seconds: float = 10, finished_ttl_seconds: float = 300,
+                 forget_seconds: float = 120, max_batch: int = 200):
+        self.run = run
+        self.ttl_seconds = ttl_seconds
+        self.finished_ttl_seconds = finished_ttl_seconds
+        self.forget_seconds = forget_seconds
+        self.max_batch = max_batch
+        self.statuses = dict()  # job id: (BifrostJob, time fetched)
+        self.polled = dict()    # job id: time last requested
+        self.fetching = None
+        self.metrics = dict(requests=0, cached=0, commands=0, jobs_fetched=0)
+
+    def _fresh(self, job_id: str, now: float) -> bool:
+        if job_id not in self.statuses:
+            return False
+        job, fetched = self.statuses[job_id]
+        ttl = self.finished_ttl_seconds if job.status in FINISHED else self.ttl_seconds
+        return now - fetched < ttl
+
+    async def _fetch(self):
+        now = time.monotonic()
+        for job_id in [j for j, polled in self.polled.items() if now - polled > self.forget_seconds]:
+            del self.polled[job_id]
+            self.statuses.pop(job_id, None)
+        due = [job_id for job_id in self.polled if not self._fresh(job_id, now)]
+        for start in range(0, len(due), self.max_batch):
+            batch = due[start:start + self.max_batch]
+            stdout, stderr = await self.run(batch_command(batch))
+            self.metrics['commands'] += 1
+            fetched = time.monotonic()
+            parsed = parse_batch(stdout)
+            for job_id in batch:
+                job = parsed.get(job_id) or BifrostJob(status=JobStatus.Failed, error='No checkjob output',
+                                                       process_error=str(stderr))
+                job.job_id = job_id
+                self.statuses[job_id] = (job, fetched)
+            self.metrics['jobs_fetched'] += len(batch)
+
+    async def get(self, job_ids: list[str]) -> list[BifrostJob]:
+        """Statuses of the given jobs, fetching the ones that are not cached or too old."""
+        now = time.monotonic()
+        self.metrics['requests'] += 1
+        for job_id in job_ids:
+            self.polled[job_id] = now
+        if all(self._fresh(job_id, now) for job_id in job_ids):
+            self.metrics['cached'] += 1
+        # A fetch that started before these jobs were added may not include them, but the next one does.
+        # Freshness is checked against the time of the request, so slow fetches cannot make it refetch.
+        for _ in range(2):
+            if all(self._fresh(job_id, now) for job_id in job_ids):
+                break
+            if self.fetching is None:
+                self.fetching = asyncio.ensure_future(self._fetch())
+                self.fetching.add_done_callback(lambda task: setattr(self, 'fetching', None))
+            await asyncio.shield(self.fetching)
+        return [self.statuses[job_id][0].copy() if job_id in self.statuses
+                else BifrostJob(job_id=job_id, status=JobStatus.Failed, error='No status fetched')
+                for job_id in job_ids]
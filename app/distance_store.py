@@ -0,0 +1,291 @@
+"""
+Binary, memory-mapped storage for cgMLST distance matrices.
+
+The text distance matrix (distance_matrix.tsv) is a space separated square matrix
+with the sample name in the first column. Parsing it at startup is slow and keeps
+a full float64 copy in every worker process. This module converts it once into:
+
+    distance_matrix.npy    dense n x n unsigned integer matrix (.npy format)
+    distance_matrix.names  sample names, one per line, in row/column order
+
+The .npy file is opened with np.load(mmap_mode='r'), so all workers on a host
+share the same pages through the OS page cache.
+
+New samples appended to allele_profiles.tsv can be added to an existing store
+without recomputing it: only the distances between the new samples and all
+samples are calculated (O(n*k) for k new samples), in parallel processes, and
+written into the store in blocks of new samples.
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+import MSTrees
+import profile_store
+
+TSV_NAME = 'distance_matrix.tsv'
+MATRIX_NAME = 'distance_matrix.npy'
+NAMES_NAME = 'distance_matrix.names'
+DTYPES = ('uint16', 'uint32')
+
+
+class DistanceMatrix(object):
+    """
+    Square sample-by-sample allele distance matrix with a sample name index.
+    'values' may be an in-memory array or a read-only np.memmap.
+    """
+
+    def __init__(self, names, values: np.ndarray):
+        if values.ndim != 2 or values.shape[0] != values.shape[1] or values.shape[0] != len(names):
+            raise ValueError(f"Distance matrix of shape {values.shape} does not match {len(names)} sample names")
+        self.names = np.asarray(names, dtype=object)
+        self.values = values
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def position(self, name: str) -> int:
+        """Row (and column) number of a sample. Raises KeyError for unknown samples."""
+        return self.index[name]
+
+    def row(self, name: str) -> np.ndarray:
+        return self.values[self.position(name)]
+
+    def nearest_neighbors(self, names, cutoff: int, block_size: int = 256) -> np.ndarray:
+        """
+        Names of all samples within 'cutoff' of any of the given samples,
+        excluding the query samples' own (diagonal) entries, in matrix order.
+        Rows are compared in blocks, so memory use is bounded by block_size rows.
+        """
+        positions = np.array([self.position(name) for name in names], dtype=np.int64)
+        found = np.zeros(len(self), dtype=bool)
+        for start in range(0, positions.size, block_size):
+            block = positions[start:start + block_size]
+            mask = self.values[block] <= cutoff
+            mask[np.arange(block.size), block] = False
+            found |= mask.any(axis=0)
+        return self.names[found]
+
+    def sub_matrix(self, names) -> np.ndarray:
+        """
+        Distances between the given samples, in the given order.
+        Rows are read in matrix order and only the requested columns of each,
+        so a memory-mapped matrix only pages in the blocks that are used.
+        """
+        positions = np.array([self.position(name) for name in names], dtype=np.int64)
+        order = np.argsort(positions)
+        sorted_positions = positions[order]
+        block = np.empty((positions.size, positions.size), dtype=self.values.dtype)
+        for i, position in enumerate(sorted_positions):
+            block[i] = self.values[position][sorted_positions]
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(order.size)
+        return block[np.ix_(inverse, inverse)]
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+
+
+def store_paths(cgmlst_dir) -> tuple[pathlib.Path, pathlib.Path]:
+    cgmlst_dir = pathlib.Path(cgmlst_dir)
+    return cgmlst_dir.joinpath(MATRIX_NAME), cgmlst_dir.joinpath(NAMES_NAME)
+
+
+def read_names(names_path) -> list[str]:
+    with open(names_path) as file:
+        return [line.rstrip('\n') for line in file]
+
+
+def write_names(names_path, names):
+    with open(names_path, 'w') as file:
+        for name in names:
+            file.write(f"{name}\n")
+
+
+def _replace(tmp_paths, paths):
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+
+
+def _remove(paths):
+    for path in paths:
+        if path.exists():
+            os.unlink(path)
+
+
+def convert(tsv_path, out_dir=None, dtype: str = 'uint16', chunksize: int = 1000) -> DistanceMatrix:
+    """
+    Convert a text distance matrix into the binary store.
+    The matrix is parsed in chunks of rows and written straight into the output
+    memmap, so the full float64 matrix is never held in memory.
+    Files are written under temporary names and renamed when complete, so
+    running workers never see a half written store.
+    """
+    tsv_path = pathlib.Path(tsv_path)
+    out_dir = tsv_path.parent if out_dir is None else pathlib.Path(out_dir)
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, not {dtype}")
+    max_value = np.iinfo(dtype).max
+    matrix_path, names_path = store_paths(out_dir)
+
+    with open(tsv_path) as file:
+        n_samples = len(file.readline().split(' ')) - 1
+
+    tmp_matrix_path = matrix_path.with_name(matrix_path.name + '.tmp')
+    tmp_names_path = names_path.with_name(names_path.name + '.tmp')
+    values = np.lib.format.open_memmap(tmp_matrix_path, mode='w+', dtype=dtype, shape=(n_samples, n_samples))
+    names = list()
+    try:
+        reader = pd.read_csv(tsv_path, sep=' ', index_col=0, header=None, dtype={0: str}, chunksize=chunksize)
+        for chunk in reader:
+            if chunk.shape[1] != n_samples:
+                raise ValueError(f"Row width {chunk.shape[1]} does not match {n_samples} columns in {tsv_path}")
+            rows = chunk.to_numpy(dtype=float)
+            if np.isnan(rows).any() or rows.min() < 0 or rows.max() > max_value:
+                raise ValueError(f"Distances in {tsv_path} cannot be stored as {dtype}")
+            values[len(names):len(names) + rows.shape[0]] = np.rint(rows)
+            names.extend(chunk.index)
+        if len(names) != n_samples:
+            raise ValueError(f"Found {len(names)} rows but {n_samples} columns in {tsv_path}")
+        values.flush()
+        del values
+        write_names(tmp_names_path, names)
+        _replace((tmp_matrix_path, tmp_names_path), (matrix_path, names_path))
+    finally:
+        _remove((tmp_matrix_path, tmp_names_path))
+    return load(out_dir)
+
+
+def load(cgmlst_dir) -> DistanceMatrix:
+    """
+    Load the distance matrix for a cgMLST directory.
+    Uses the memory-mapped binary store when present and falls back to
+    parsing distance_matrix.tsv (slow, and not shared between workers).
+    Raises FileNotFoundError if neither exists.
+    """
+    matrix_path, names_path = store_paths(cgmlst_dir)
+    if matrix_path.exists() and names_path.exists():
+        return DistanceMatrix(read_names(names_path), np.load(matrix_path, mmap_mode='r'))
+    tsv_path = pathlib.Path(cgmlst_dir, TSV_NAME)
+    print(f"No binary distance matrix in {cgmlst_dir}, parsing {tsv_path}. "
+          f"Run 'python distance_store.py convert {tsv_path}' to convert it.")
+    df = pd.read_csv(tsv_path, sep=' ', index_col=0, header=None, dtype={0: str})
+    return DistanceMatrix(df.index.tolist(), df.to_numpy())
+
+
+def new_distances(profiles: np.ndarray, n_old: int, handle_missing: str = 'pair_delete', n_proc: int = 5) -> np.ndarray:
+    """
+    Symmetric distances between the profiles from row 'n_old' on and all profiles,
+    as an (n, n - n_old) array, computed by 'n_proc' processes.
+    """
+    distances = MSTrees.distance_matrix.get_columns('symmetric', profiles, handle_missing, n_old, n_proc)
+    # Each new column is only complete above the diagonal, so complete the
+    # block between new samples from its transpose.
+    new_block = distances[n_old:]
+    distances[n_old:] = np.maximum(new_block, new_block.T)
+    return distances
+
+
+def _profiles(cgmlst_dir: pathlib.Path, profiles_path=None) -> profile_store.ProfileStore:
+    """
+    The allele profiles to append from: the binary profile store of cgmlst_dir, unless
+    'profiles_path' is given or allele_profiles.tsv is newer than the store.
+    """
+    if profiles_path is not None:
+        return profile_store.read_tsv(profiles_path)
+    tsv_path, meta_path = cgmlst_dir.joinpath(profile_store.TSV_NAME), profile_store.store_paths(cgmlst_dir)['meta']
+    if meta_path.exists() and not (tsv_path.exists() and tsv_path.stat().st_mtime > meta_path.stat().st_mtime):
+        return profile_store.load(cgmlst_dir)
+    if meta_path.exists():
+        print(f"{tsv_path} is newer than its binary store, encoding it. "
+              f"Run 'python profile_store.py {tsv_path}' to update the store.")
+    return profile_store.read_tsv(tsv_path)
+
+
+def append(cgmlst_dir, profiles_path=None, handle_missing: str = 'pair_delete', n_proc: int = 5,
+           block_size: int = 1000) -> DistanceMatrix:
+    """
+    Add samples from the allele profiles that are not yet in the binary store.
+    The profiles come from the binary profile store when it is up to date, otherwise
+    from allele_profiles.tsv (or 'profiles_path').
+    Distances are only computed between the new samples and all samples, for
+    'block_size' new samples at a time, and written straight into the enlarged
+    matrix; the existing distances are copied. The store is replaced when
+    complete, so workers must reload it to see the new samples.
+    """
+    cgmlst_dir = pathlib.Path(cgmlst_dir)
+    matrix_path, names_path = store_paths(cgmlst_dir)
+    if not (matrix_path.exists() and names_path.exists()):
+        raise FileNotFoundError(f"No binary distance matrix in {cgmlst_dir}")
+    matrix = load(cgmlst_dir)
+
+    store = _profiles(cgmlst_dir, profiles_path)
+    profiles_path = profiles_path or cgmlst_dir.joinpath(profile_store.TSV_NAME)
+    unknown = [name for name in matrix.names if name not in store]
+    if unknown:
+        raise ValueError(f"{len(unknown)} samples in the distance matrix are not in {profiles_path}, e.g. {unknown[0]}")
+    new_names = [name for name in store.names if name not in matrix]
+    if not new_names:
+        return matrix
+
+    n_old, n_total = len(matrix), len(matrix) + len(new_names)
+    profiles = store.profiles(list(matrix.names) + new_names)
+    dtype = matrix.values.dtype
+
+    tmp_matrix_path = matrix_path.with_name(matrix_path.name + '.tmp')
+    tmp_names_path = names_path.with_name(names_path.name + '.tmp')
+    values = np.lib.format.open_memmap(tmp_matrix_path, mode='w+', dtype=dtype, shape=(n_total, n_total))
+    try:
+        for start in range(0, n_old, block_size):
+            end = min(start + block_size, n_old)
+            values[start:end, :n_old] = matrix.values[start:end]
+        # The columns of each block of new samples against all samples up to the block's end, and by
+        # symmetry its rows; the rest of the block's columns are the rows of the later blocks
+        for start in range(n_old, n_total, block_size):
+            end = min(start + block_size, n_total)
+            columns = np.rint(new_distances(profiles[:end], start, handle_missing, n_proc))
+            if columns.max() > np.iinfo(dtype).max:
+                raise ValueError(f"New distances cannot be stored as {dtype}")
+            values[:end, start:end] = columns
+            values[start:end, :end] = columns.T
+        values.flush()
+        del values
+        write_names(tmp_names_path, list(matrix.names) + new_names)
+        _replace((tmp_matrix_path, tmp_names_path), (matrix_path, names_path))
+    finally:
+        _remove((tmp_matrix_path, tmp_names_path))
+    return load(cgmlst_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and update the memory-mappable binary distance matrix store.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='Convert distance_matrix.tsv into the binary store.')
+    convert_parser.add_argument('tsv', help='Path to distance_matrix.tsv')
+    convert_parser.add_argument('--out_dir', '-o', help='Output directory [DEFAULT: same directory as the input]', default=None)
+    convert_parser.add_argument('--dtype', '-d', help='Integer type of the stored distances [DEFAULT: uint16]', choices=DTYPES, default='uint16')
+    append_parser = subparsers.add_parser('append', help='Add new samples from allele_profiles.tsv to the binary store.')
+    append_parser.add_argument('cgmlst_dir', help='Directory with the binary store')
+    append_parser.add_argument('--profiles', '-p', help='Allele profiles [DEFAULT: allele_profiles.tsv in cgmlst_dir]', default=None)
+    append_parser.add_argument('--missing', '-y', dest='handle_missing', help='Missing data handling, as in MSTrees [DEFAULT: pair_delete]',
+                               choices=('pair_delete', 'as_allele', 'absolute_distance'), default='pair_delete')
+    append_parser.add_argument('--n_proc', '-n', help='Number of processes [DEFAULT: 5]', type=int, default=5)
+    args = parser.parse_args()
+    start = datetime.now()
+    if args.command == 'convert':
+        matrix = convert(args.tsv, args.out_dir, args.dtype)
+        print(f"Converted {len(matrix)} samples ({matrix.nbytes} bytes) in {datetime.now() - start}")
+    else:
+        matrix = append(args.cgmlst_dir, args.profiles, args.handle_missing, args.n_proc)
+        print(f"Distance matrix has {len(matrix)} samples after update in {datetime.now() - start}")
@@ -0,0 +1,184 @@
+"""
+Pooled SSH connections to the HPC.
+
+Opening an SSH connection takes a TCP handshake, a key exchange and password
+authentication. SSHPool keeps a few connections open (with SSH keep-alive
+packets) and runs each command on its own channel of one of them:
+
+- a connection takes at most 'max_channels' commands at a time, and a new
+  connection is only opened when all open ones are full, up to
+  'max_connections'; further commands wait for a free channel
+- connections that the server or network has closed are dropped and reopened
+  on the next command, and connections idle for 'idle_seconds' are closed
+- a command whose channel cannot be opened is retried on another connection,
+  which drops every broken one until a new connection is opened; once the
+  command has been sent it is never retried, so a job is not submitted twice
+
+paramiko is blocking, so async endpoints call 'await pool.run(command)', which
+runs the command in the pool's own threads instead of the event loop.
+"""
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+from paramiko import AutoAddPolicy, SSHException
+from paramiko.client import SSHClient
+
+DEFAULTS = dict(
+    max_connections=2,
+    max_channels=8,       # below OpenSSH's default MaxSessions of 10
+    keepalive_seconds=30,
+    idle_seconds=600,
+    timeout_seconds=30,   # connect and channel open timeout
+)
+
+CONNECTION_ERRORS = (SSHException, EOFError, OSError)
+
+
+class Connection(object):
+    """An open SSH connection and the number of commands running on it."""
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.channels = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def alive(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHPool(object):
+    def __init__(self, hostname: str, port: int, username: str, password: str, max_connections: int = 2,
+                 max_channels: int = 8, keepalive_seconds: float = 30, idle_seconds: float = 600,
+                 timeout_seconds: float = 30):
+        self.hostname, self.port, self.username, self.password = hostname, port, username, password
+        self.max_connections = max_connections
+        self.max_channels = max_channels
+        self.keepalive_seconds = keepalive_seconds
+        self.idle_seconds = idle_seconds
+        self.timeout_seconds = timeout_seconds
+        self.connections = list()
+        self.connecting = 0
+        self.condition = threading.Condition()
+        self.metrics = dict(commands=0, connections_opened=0, reused=0, reconnects=0, failures=0)
+        self.executor = ThreadPoolExecutor(max_connections * max_channels, thread_name_prefix='hpc')
+
+    @classmethod
+    def from_env(cls, config: dict = None) -> SSHPool:
+        """A pool for HPC_HOSTNAME, HPC_PORT, HPC_USERNAME and HPC_PASSWORD, with settings from the 'hpc' config section."""
+        return cls(os.getenv('HPC_HOSTNAME'), int(os.getenv('HPC_PORT', 22)), os.getenv('HPC_USERNAME'),
+                   os.getenv('HPC_PASSWORD'), **{**DEFAULTS, **(config or dict())})
+
+    def _connect(self) -> Connection:
+        print(f"Connect to {self.hostname} on port {self.port}")
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(hostname=self.hostname, port=self.port, username=self.username, password=self.password,
+                       timeout=self.timeout_seconds, banner_timeout=self.timeout_seconds,
+                       auth_timeout=self.timeout_seconds, allow_agent=False, look_for_keys=False)
+        client.get_transport().set_keepalive(int(self.keepalive_seconds))
+        return Connection(client)
+
+    def _prune(self):
+        """Drop dead and idle connections. Called with the condition held."""
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if connection.channels == 0 and (not connection.alive or now - connection.last_used > self.idle_seconds):
+                self.connections.remove(connection)
+                connection.client.close()
+
+    def _acquire(self) -> Connection:
+        with self.condition:
+            while True:
+                self._prune()
+                free = [c for c in self.connections if c.channels < self.max_channels and c.alive]
+                if free:
+                    connection = max(free, key=lambda c: c.channels)
+                    connection.channels += 1
+                    self.metrics['reused'] += 1
+                    return connection
+                if len(self.connections) + self.connecting < self.max_connections:
+                    self.connecting += 1
+                    break
+                self.condition.wait()
+        try:
+            connection = self._connect()
+        except CONNECTION_ERRORS:
+            with self.condition:
+                self.metrics['failures'] += 1
+            raise
+        finally:
+            with self.condition:
+                self.connecting -= 1
+                self.condition.notify_all()
+        with self.condition:
+            connection.channels = 1
+            self.connections.append(connection)
+            self.metrics['connections_opened'] += 1
+        return connection
+
+    def _release(self, connection: Connection, broken: bool = False):
+        with self.condition:
+            connection.channels -= 1
+            connection.last_used = time.monotonic()
+            if broken and connection in self.connections:
+                self.connections.remove(connection)
+                connection.client.close()
+            self.condition.notify_all()
+
+    def exec_command(self, command: str) -> tuple[list[str], list[str]]:
+        """Run a command and return its stdout and stderr lines. Blocks until the command has finished."""
+        for attempt in range(self.max_connections + 1):
+            connection = self._acquire()
+            broken = False
+            try:
+                try:
+                    channel = connection.client.get_transport().open_session(timeout=self.timeout_seconds)
+                except CONNECTION_ERRORS + (AttributeError, ):  # get_transport() is None once the connection is closed
+                    # The connection was lost while idle; nothing has been sent yet, so try a new one
+                    broken = True
+                    with self.condition:
+                        self.metrics['failures'] += 1
+                        self.metrics['reconnects'] += 1
+                    if attempt == self.max_connections:
+                        raise
+                    continue
+                try:
+                    channel.exec_command(command)
+                    stdout = channel.makefile('r').readlines()
+                    stderr = channel.makefile_stderr('r').readlines()
+                    channel.recv_exit_status()
+                except CONNECTION_ERRORS:
+                    broken = True
+                    with self.condition:
+                        self.metrics['failures'] += 1
+                    raise
+                finally:
+                    channel.close()
+                with self.condition:
+                    self.metrics['commands'] += 1
+                return stdout, stderr
+            finally:
+                # Other errors, such as undecodable output, leave the connection usable
+                self._release(connection, broken=broken)
+
+    async def run(self, command: str) -> tuple[list[str], list[str]]:
+        """exec_command without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.exec_command, command)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return dict(self.metrics, open_connections=len(self.connections),
+                        busy_channels=sum(c.channels for c in self.connections))
+
+    def close(self):
+        with self.condition:
+            for connection in self.connections:
+                connection.client.close()
+            self.connections = list()
@@ -1,30 +1,44 @@
 from __future__ import annotations
 
-from datetime import datetime
+import asyncio
+import json
 import os
 import pathlib
-import subprocess
-from pydantic.typing import all_literal_values
+import time
 import yaml
-from datetime import datetime
-from collections import Set
+from typing import List
 
-from fastapi import FastAPI, BackgroundTasks
-import pandas as pd
-from paramiko.client import SSHClient
-from paramiko import AutoAddPolicy
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from bson import ObjectId
 from pymongo import MongoClient
 
-import MSTrees
+import bifrost_campaigns
+import bifrost_status
+import hpc
+import metrics
+import neighbor_index
+import profile_store
+import species_data
+import tree_cache
+import tree_jobs
+import tree_resources
 
 
 from models import (
     BifrostAnalysisList,
     BifrostAnalysis,
+    BifrostCampaign,
     BifrostJob,
+    HPCConnectionStats,
     ComparativeAnalysis,
     NearestNeighbors,
     JobStatus,
+    SpeciesResidency,
+    TreeAnalysis,
+    TreeCacheStats,
 )
 
 app = FastAPI(
@@ -34,38 +48,111 @@ app = FastAPI(
     contact={'name': 'Finn Gruwier Larsen', 'email': 'figl@ssi.dk'},
 )
 
-data = dict()
-
 with open('./config.yaml') as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 mongo = MongoClient(os.getenv('MONGO_CONN'))
 db = mongo.get_database()
+tree_cache.create_indexes(db)
+bifrost_campaigns.create_indexes(db)
+metrics.create_indexes(db)
+hpc_pool = hpc.SSHPool.from_env(config.get('hpc'))
+status_cache = bifrost_status.StatusCache(hpc_pool.run, **{**bifrost_status.DEFAULTS, **(config.get('bifrost_status') or dict())})
 
-for k, v in config['species'].items():  # For each configured species
-    cgmlst_dir = pathlib.Path(os.getenv('CHEWIE_DATA'), v['cgmlst'])
-    print(f"cgmlst_dir: {cgmlst_dir}")
-    data[k] = dict()
+metrics_settings = {**metrics.DEFAULTS, **(config.get('metrics') or dict())}
+request_seconds = metrics.Histogram('analysis_control_request_seconds', 'Latency of API requests until the response starts',
+                                     ('method', 'route', 'status'))
 
-    start = datetime.now()
-    print(f"Start loading distance matrix for {k} at {start}")
-    distance_matrix_path = cgmlst_dir.joinpath('distance_matrix.tsv')
-    try:
-        data[k]['distance_matrix'] = pd.read_csv(distance_matrix_path, sep=' ', index_col=0, header=None)
-        finish = datetime.now()
-        print(f"Finished loading distance matrix for {k} in {finish - start}")
-    except FileNotFoundError:
-        print(f"Distance matrix file not found: {distance_matrix_path}")
-
-    start = datetime.now()
-    print(f"Start loading allele profiles for {k} at {start}")
+
+def route_template(scope) -> str:
+    """The path template of the route that serves a request, so sample names and job ids do not each get a series."""
+    partial = None
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path  # the path matches, but not the HTTP method
+    return partial or 'unmatched'
+
+
+@app.middleware('http')
+async def time_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
     try:
-        allele_profile_path = cgmlst_dir.joinpath('allele_profiles.tsv')
-        data[k]['allele_profiles'] = pd.read_csv(allele_profile_path, sep='\t', index_col=0, header=0)
-        finish = datetime.now()
-        print(f"Finished loading allele profiles for {k} in {finish - start}")
-    except FileNotFoundError:
-        print(f"Allele profile file file not found: {allele_profile_path}")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        request_seconds.observe(time.perf_counter() - start, request.method, route_template(request.scope), str(status))
+
+
+async def flush_request_metrics():
+    """Add the request counts of this worker to the database, where /metrics sums those of all workers."""
+    while True:
+        await asyncio.sleep(metrics_settings['flush_seconds'])
+        try:
+            await run_in_threadpool(request_seconds.flush, db)
+        except Exception as e:
+            print(f"Could not store request metrics: {e!r}")
+
+
+flushing = list()
+
+
+@app.on_event('startup')
+async def start_flushing_metrics():
+    flushing.append(asyncio.ensure_future(flush_request_metrics()))
+
+
+@app.on_event('shutdown')
+async def flush_metrics_at_exit():
+    await run_in_threadpool(request_seconds.flush, db)
+
+
+@app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+def prometheus_metrics() -> PlainTextResponse:
+    """
+    Request latencies, tree job stages and tree job counts of all workers in the Prometheus text format (see metrics).
+    """
+    return PlainTextResponse(metrics.exposition(request_seconds.lines(db), metrics.tree_lines(db)),
+                             media_type='text/plain; version=0.0.4')
+
+
+def loaded(species: str, kind: str, store):
+    if kind == 'allele_profiles':
+        n_evicted = tree_cache.evict_stale(db, species, store.version)
+        print(f"Evicted {n_evicted} cached trees of older allele profiles for {species}")
+
+
+species_settings = {**species_data.DEFAULTS, **(config.get('species_data') or dict())}
+data = species_data.SpeciesData(config['species'], os.getenv('CHEWIE_DATA'),
+                                memory_budget_mb=species_settings['memory_budget_mb'], on_load=loaded)
+
+
+async def species_store(species: str, kind: str):
+    """The store of a species, loaded in a thread on first use so the event loop is not blocked."""
+    return await run_in_threadpool(data.get, species, kind)
+
+
+preloading = list()
+
+
+@app.on_event('startup')
+async def preload_species():
+    """Load the configured species in the background, so the API serves requests meanwhile."""
+    preloading.extend(asyncio.ensure_future(species_store(species, kind)) for species in species_settings['preload']
+                      for kind in ('allele_profiles', 'distance_matrix'))
+
+
+@app.get('/comparative/cgmlst/data', response_model=List[SpeciesResidency])
+def species_residency() -> List[SpeciesResidency]:
+    """
+    Loaded cgMLST data per species, with its size and load timings.
+    """
+    return [SpeciesResidency(**residency) for residency in data.residency()]
+
 
 @app.get('/bifrost/list_analyses', response_model=BifrostAnalysisList)
 def list_hpc_analysis() -> BifrostAnalysisList:
@@ -81,49 +168,38 @@ def list_hpc_analysis() -> BifrostAnalysisList:
             version=version))
     return response
 
-def get_hpc_conn():
-    ssh_client = SSHClient()
-    ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-    hostname = os.getenv('HPC_HOSTNAME')
-    port = int(os.getenv('HPC_PORT'))
-    print(f"Connect to {hostname} on port {str(port)}")
-    username = os.getenv('HPC_USERNAME')
-    password = os.getenv('HPC_PASSWORD')
-    ssh_client.connect(
-        hostname=hostname,
-        port=port,
-        username=username,
-        password=password
-        )
-    return ssh_client
+def unknown_analysis(analyses: list[str]):
+    """The first analysis that is not in the config, or None."""
+    return next((analysis for analysis in analyses if analysis not in config['bifrost_analyses']), None)
+
+
+def bifrost_command(sequences: list[str], analyses: list[str]) -> str:
+    command_prefix = os.getenv('HPC_COMMAND_PREFIX')
+    script_dir = os.getenv('BIFROST_SCRIPT_DIR')
+    script_name = os.getenv('BIFROST_SCRIPT_NAME')
+    launch_script = pathlib.Path(script_dir, script_name)
+    raw_command = f"{launch_script} -s {' '.join(sequences)} -co {' '.join(analyses)}"
+    return f"{command_prefix} {raw_command}"
+
 
 @app.post('/bifrost/init', response_model=BifrostJob)
-def init_bifrost_job(job: BifrostJob = None) -> BifrostJob:
+async def init_bifrost_job(job: BifrostJob = None) -> BifrostJob:
     """
     Initiate a Bifrost job with one or more sequences and one or more Bifrost analyses.
     """
 
-    # For each analysis, make sure that analysis is present in config
-    for analysis in job.analyses:
-        try:
-            assert analysis in config['bifrost_analyses']
-            job.status = JobStatus.Accepted
-        except AssertionError:
-            job.status = JobStatus.Rejected
-            job.error = f"Could not find a Bifrost analysis with the identifier '{analysis}'."
-            return job
+    # Make sure that each analysis is present in config
+    analysis = unknown_analysis(job.analyses)
+    if analysis is not None:
+        job.status = JobStatus.Rejected
+        job.error = f"Could not find a Bifrost analysis with the identifier '{analysis}'."
+        return job
 
-    command_prefix = os.getenv('HPC_COMMAND_PREFIX')
-    script_dir = os.getenv('BIFROST_SCRIPT_DIR')
-    script_name = os.getenv('BIFROST_SCRIPT_NAME')
-    launch_script = pathlib.Path(script_dir, script_name)
-    raw_command = f"{launch_script} -s {' '.join(job.sequences)} -co {' '.join(job.analyses)}"
-    command = f"{command_prefix} {raw_command}"
+    command = bifrost_command(job.sequences, job.analyses)
     print(f"HPC command: {command}")
-    with get_hpc_conn() as  hpc:
-        stdin, stdout, stderr = hpc.exec_command(command)
-        job.process_out = str(stdout.readlines())
-        job.process_error = str(stderr.readlines())
+    stdout, stderr = await hpc_pool.run(command)
+    job.process_out = str(stdout)
+    job.process_error = str(stderr)
     if 'error' in job.process_out:
         job.status = JobStatus.Failed
     else:
@@ -131,42 +207,87 @@ def init_bifrost_job(job: BifrostJob = None) -> BifrostJob:
     return job
 
 
+campaign_tasks = set()
+
+
+def start_campaign(campaign_id):
+    settings = {**bifrost_campaigns.DEFAULTS, **(config.get('bifrost_campaigns') or dict())}
+    task = asyncio.ensure_future(bifrost_campaigns.submit(db, campaign_id, hpc_pool.run, bifrost_command,
+                                                          settings['concurrency'], settings['heartbeat_seconds']))
+    # The event loop only keeps weak references to tasks
+    campaign_tasks.add(task)
+    task.add_done_callback(campaign_tasks.discard)
+
+
+@app.on_event('startup')
+async def resume_campaigns():
+    settings = {**bifrost_campaigns.DEFAULTS, **(config.get('bifrost_campaigns') or dict())}
+    for campaign_id in await run_in_threadpool(bifrost_campaigns.interrupted, db, settings['stale_seconds']):
+        print(f"Resuming Bifrost campaign {campaign_id}")
+        start_campaign(campaign_id)
+
+
+@app.post('/bifrost/campaign', response_model=BifrostCampaign)
+async def init_bifrost_campaign(campaign: BifrostCampaign) -> BifrostCampaign:
+    """
+    Run one or more Bifrost analyses on many sequences.
+    The sequences are submitted in batches in the background; poll /bifrost/campaign with the returned job_id for the progress.
+    """
+    if not campaign.sequences or not campaign.analyses:
+        campaign.status = JobStatus.Rejected
+        campaign.error = "A campaign needs at least one sequence and one analysis."
+        return campaign
+    analysis = unknown_analysis(campaign.analyses)
+    if analysis is not None:
+        campaign.status = JobStatus.Rejected
+        campaign.error = f"Could not find a Bifrost analysis with the identifier '{analysis}'."
+        return campaign
+    if campaign.batch_size is not None and campaign.batch_size <= 0:
+        campaign.status = JobStatus.Rejected
+        campaign.error = f"The batch size must be positive, not {campaign.batch_size}."
+        return campaign
+    batch_size = campaign.batch_size or (config.get('bifrost_campaigns') or dict()).get('batch_size', bifrost_campaigns.DEFAULTS['batch_size'])
+    campaign_id = await run_in_threadpool(bifrost_campaigns.create, db, campaign.sequences, campaign.analyses, batch_size)
+    start_campaign(campaign_id)
+    return await run_in_threadpool(bifrost_campaigns.progress, db, str(campaign_id))
+
+
+@app.get('/bifrost/campaign', response_model=BifrostCampaign)
+def bifrost_campaign_progress(job_id: str) -> BifrostCampaign:
+    """
+    Number of batches of a Bifrost campaign in each state.
+    """
+    return bifrost_campaigns.progress(db, job_id)
+
+
 @app.get('/bifrost/status', response_model=BifrostJob)
-def status_bifrost(job_id: str) -> BifrostJob:
-    job = BifrostJob(job_id=job_id)
-    command = f"checkjob {job_id}"
-    with get_hpc_conn() as  hpc:
-        stdin, stdout, stderr = hpc.exec_command(command)
-        job.process_out = str(stdout.readlines())
-        job.process_error = str(stderr.readlines())
-    if 'error' in job.process_out or len(job.process_error) > 0:
-        job.status = JobStatus.Failed
-    else:
-        job.status = JobStatus.Accepted
-    return job
+async def status_bifrost(job_id: str) -> BifrostJob:
+    """
+    Status of a Bifrost job on the HPC, from the scheduler's checkjob (see bifrost_status).
+    """
+    return (await status_bifrost_bulk([job_id]))[0]
 
 
-def find_nearest_neighbors(input_sequence: str, matrix: pd.DataFrame, cutoff: int):
-    result = set()
-    row: pd.Series = matrix.loc[input_sequence , :]
-    # print("Row:")
-    # print(row)
-    # Run through the columns in the row and see if they are less than or equal to cutoff.
-    for item in row.iteritems():
-        print(f"Item within row: {item}")
-        idx = item[0]
-        distance = item[1]
-        # What is the name of the sample in ROW <index> (assuming that rows and columns use the same order)?
-        found_sequence: pd.Series = matrix.index[idx - 1]
-        print(f"Found sequence name: {found_sequence}")
-        if distance <= cutoff:
-            print(f"Distance {distance} is smaller than cutoff {cutoff}.")
-            if found_sequence == input_sequence:
-                print(f"However, {found_sequence} is our input sequence, so it's not a match!")
-            else:
-                print(f"{found_sequence} is not {input_sequence}, so this is in fact a match!")
-                result.add(found_sequence)
-    return result
+@app.post('/bifrost/status', response_model=List[BifrostJob])
+async def status_bifrost_bulk(job_ids: List[str]) -> List[BifrostJob]:
+    """
+    Status of several Bifrost jobs, fetched with one HPC command.
+    Statuses are cached for a few seconds, so polling clients share the fetches.
+    """
+    invalid = [job_id for job_id in job_ids if not bifrost_status.valid_job_id(job_id)]
+    valid = [job_id for job_id in dict.fromkeys(job_ids) if bifrost_status.valid_job_id(job_id)]
+    jobs = {job.job_id: job for job in await status_cache.get(valid)}
+    for job_id in invalid:
+        jobs[job_id] = BifrostJob(job_id=job_id, status=JobStatus.Rejected, error=f"Invalid job id '{job_id}'")
+    return [jobs[job_id] for job_id in job_ids]
+
+
+@app.get('/bifrost/connections', response_model=HPCConnectionStats)
+def hpc_connections() -> HPCConnectionStats:
+    """
+    Usage of the pooled SSH connections to the HPC.
+    """
+    return HPCConnectionStats(**hpc_pool.stats())
 
 
 @app.post('/comparative/cgmlst/nearest_neighbors', response_model=NearestNeighbors)
@@ -174,79 +295,134 @@ async def generate_nearest_neighbors(job: NearestNeighbors) -> NearestNeighbors:
     """
     Nearest neighbors from distance matrix.
     """
-    species = job.species.replace(' ', '_')
-    matrix = data[species]['distance_matrix']
-    result_seq_set = set()
-    for input_sequence in job.sequences:
-        print()
-        print(f"***** Now looking at this input sequence: {input_sequence}.")
-        result_sequences = find_nearest_neighbors(input_sequence, matrix, job.cutoff)
-        for s in result_sequences:
-            # If it's already in the set it will not be added
-            result_seq_set.add(str(s))
-        job.result = list(result_seq_set)
+    matrix = await species_store(job.species, 'distance_matrix')
+    index = await species_store(job.species, 'neighbor_index')
+    job.result = neighbor_index.find_nearest_neighbors(job.sequences, matrix, job.cutoff, index)
     return job
 
 
-def generate_tree(_id, species: str, profiles: list[pd.Series]):
-    # profile_str is a string in the format MSTrees.backend needs for input.
-    # First add header by looking it up directly from 'data'.
-    col_names: list = data[species]['allele_profiles'].columns.tolist()
-    profile_str = '\t'.join(col_names) + '\n'
-    for profile in profiles:
-        p_list = profile.to_list()
-        p_str = '\t'.join([str(v) for v in p_list])
-        profile_str = profile_str + p_str + '\n'
-    tree = MSTrees.backend(profile=profile_str)
-    return db.trees.find_one_and_update(
-        {'_id': _id}, {'$set': {'tree': tree, 'finished': datetime.now()}})
+tree_settings = tree_jobs.job_config(config)
+tree_estimator = tree_resources.Estimator.load(tree_settings['calibration'])
+
+
+def tree_job(doc: dict) -> TreeAnalysis:
+    """The TreeAnalysis for a tree document, with the tree as result once it has succeeded."""
+    # Trees stored before the job queue have no status
+    status = JobStatus(doc.get('status', JobStatus.Succeeded.value if 'tree' in doc else JobStatus.Running.value))
+    job = TreeAnalysis(job_id=str(doc['_id']), species=doc['species'], sequences=doc['elements'], status=status,
+                       method=doc.get('method', 'MSTreeV2'), priority=doc.get('priority', 0), error=doc.get('error'),
+                       started_at=doc.get('started'), finished_at=doc.get('finished'), result=doc.get('tree'),
+                       stages=doc.get('stages'))
+    if job.started_at is not None and job.finished_at is not None:
+        job.seconds = int((job.finished_at - job.started_at).total_seconds())
+    if doc.get('estimate'):
+        job.estimated_seconds = doc['estimate']['seconds']
+        job.estimated_memory_mb = doc['estimate']['memory'] / 2 ** 20
+    return job
 
 
-@app.post('/comparative/cgmlst/tree', response_model=ComparativeAnalysis)
-async def cgmlst_tree(job: ComparativeAnalysis, background_tasks: BackgroundTasks) -> ComparativeAnalysis:
+@app.post('/comparative/cgmlst/tree', response_model=TreeAnalysis)
+async def cgmlst_tree(job: TreeAnalysis) -> TreeAnalysis:
     """
     Generate minimum spanning tree for selected sequences based on cgMLST data.
     Trees are saved in MongoDB.
     'type' can be 'S' (samples) or 'P' (allele profiles).
     If type == 'S' we use sample names as 'elements'.
     If type == 'P' we use allele profile hash id's as 'elements'.
+    The tree is queued and built by the tree workers (see tree_jobs); poll /comparative/cgmlst/tree/status for the result.
+    A tree that was already requested for the same samples, method, allele profiles and distance source is returned from the cache (see tree_cache).
+    A tree estimated to need more memory than a tree may use is built with fewer processes or a smaller matrix (the returned method), or rejected (see tree_resources).
     """
-    job.started_at = datetime.now()
-    _id = db.trees.insert_one({
-            'initialized': job.started_at,
-            'type': 'S',
-            'elements': job.sequences,
-            'species': job.species.replace('_', ' ')
-        }).inserted_id
-    job.job_id = str(_id)
-    job.status = JobStatus.Accepted
-    all_allele_profiles: pd.DataFrame = data[job.species]['allele_profiles']
-    profiles: list[pd.Series] = [all_allele_profiles.loc[sequence_id] for sequence_id in job.sequences]
-    background_tasks.add_task(generate_tree, _id, job.species, profiles)
-    return job
+    store: profile_store.ProfileStore = await species_store(job.species, 'allele_profiles')
+    if store is None:
+        job.status = JobStatus.Rejected
+        job.error = f"No allele profiles loaded for {job.species}"
+        return job
+    if job.method not in tree_jobs.METHODS:
+        job.status = JobStatus.Rejected
+        job.error = f"Tree method must be one of {list(tree_jobs.METHODS)}, not {job.method}"
+        return job
+    unknown = [s for s in job.sequences if s not in store]
+    if unknown:
+        job.status = JobStatus.Rejected
+        job.error = f"{len(unknown)} sequences have no allele profile, e.g. {unknown[0]}"
+        return job
+    try:
+        method, n_proc, seconds, memory = tree_resources.admit(tree_estimator, job.method, len(set(job.sequences)),
+                                                               len(store.loci), tree_settings)
+    except ValueError as e:
+        job.status = JobStatus.Rejected
+        job.error = str(e)
+        return job
+    if method != job.method:
+        print(f"Tree of {len(job.sequences)} {job.species} sequences downscaled from {job.method} to {method} to fit in memory")
+    if n_proc != tree_settings['n_proc']:
+        print(f"Tree of {len(job.sequences)} {job.species} sequences built with {n_proc} processes to fit in memory")
+    source = await run_in_threadpool(tree_jobs.distance_source, data, job.species, job.sequences, method, tree_settings)
+    doc, outcome = tree_cache.get_or_enqueue(db, job.species, job.sequences, method, store.version, job.priority,
+                                             dict(seconds=seconds, memory=memory, n_proc=n_proc), source)
+    print(f"Tree cache {outcome} for job {doc['_id']}")
+    return tree_job(doc)
+
+
+@app.get('/comparative/cgmlst/tree/status', response_model=TreeAnalysis)
+def cgmlst_tree_status(job_id: str) -> TreeAnalysis:
+    """
+    Status of a tree job, with the tree as result once it has succeeded.
+    """
+    doc = db.trees.find_one({'_id': ObjectId(job_id)}) if ObjectId.is_valid(job_id) else None
+    if doc is None:
+        return TreeAnalysis(job_id=job_id, species='', status=JobStatus.Failed, error=f"No tree job with id {job_id}")
+    return tree_job(doc)
+
+
+@app.get('/comparative/cgmlst/tree/cache', response_model=List[TreeCacheStats])
+def cgmlst_tree_cache() -> List[TreeCacheStats]:
+    """
+    Hit, coalesced request and miss counters of the tree cache per species.
+    """
+    return [TreeCacheStats(**stats) for stats in tree_cache.stats(db)]
 
 
 @app.post('/comparative/cgmlst/profile_diffs', response_model=ComparativeAnalysis)
 async def profile_diffs(job: ComparativeAnalysis = None) -> ComparativeAnalysis:
     """
     Show differences between requested allele profiles.
+    The result has the loci where the profiles differ or an allele is missing, as {locus: {sequence: allele}}.
     """
-    df: pd.DataFrame = data[job.species]['allele_profiles']
-    filtered_df: pd.DataFrame = df.loc[job.sequences]
-    columns_to_show = list()
-    for label, content in filtered_df.items():
-        previous_value = None
-        for value in content:
-            if value == "#FILE":
-                continue
-            if value == "-":
-                columns_to_show.append(label)
-                break
-            if value == previous_value:
-                continue
-            columns_to_show.append(label)
-            break
-
-    result_df: pd.DataFrame = filtered_df[columns_to_show]
-    job.result = result_df.to_dict()
+    store: profile_store.ProfileStore = await species_store(job.species, 'allele_profiles')
+    if store is None:
+        job.status = JobStatus.Rejected
+        job.error = f"No allele profiles loaded for {job.species}"
+        return job
+    job.result = store.differences(job.sequences)
     return job
+
+
+@app.post('/comparative/cgmlst/profile_diffs/columnar')
+async def profile_diffs_columnar(job: ComparativeAnalysis, rows_per_chunk: int = 100):
+    """
+    Differences between requested allele profiles in a compact, streamed JSON format:
+    {"sequences": [...], "loci": [...], "alleles": [[...], ...], "codes": [[...], ...]}
+    with the variable loci as for profile_diffs. 'alleles' has the allele IDs of each locus ('-' first), and
+    'codes' has a row per sequence with, for each locus, the position of the sequence's allele in that list.
+    Without allele profiles for the species, the job is returned as for profile_diffs, with the error.
+    """
+    store: profile_store.ProfileStore = await species_store(job.species, 'allele_profiles')
+    if store is None:
+        job.status = JobStatus.Rejected
+        job.error = f"No allele profiles loaded for {job.species}"
+        return job
+    codes = store.profiles(job.sequences)
+    loci = profile_store.variable_loci(codes)
+    alleles, local_codes = store.compact(codes[:, loci], loci)
+
+    def chunks():
+        yield (f'{{"sequences": {json.dumps(job.sequences)}, "loci": {json.dumps(store.loci[loci].tolist())}, '
+               f'"alleles": {json.dumps(alleles)}, "codes": [')
+        for start in range(0, local_codes.shape[0], rows_per_chunk):
+            rows = local_codes[start:start + rows_per_chunk].tolist()
+            yield (', ' if start else '') + ', '.join(json.dumps(row) for row in rows)
+        yield ']}'
+
+    return StreamingResponse(chunks(), media_type='application/json')
@@ -0,0 +1,147 @@
+"""
+Prometheus metrics of the API and the tree workers, in the text exposition format.
+
+The API and the tree workers run in several processes, so every metric is
+summed in the database and GET /metrics, in whichever API worker serves it,
+reads them at every scrape. The API times every request in a histogram per
+HTTP method, route template and status code; each API worker keeps the counts
+of its requests and adds them to the db.request_metrics collection every
+'flush_seconds', and when it serves a scrape. Tree workers add the stages of
+each tree (see MSTrees.Stages) to the db.tree_stages collection, one document
+per tree method and stage with the counts of each histogram bucket:
+
+    analysis_control_request_seconds             histogram  method, route, status
+    analysis_control_tree_stage_seconds          histogram  method, stage
+    analysis_control_tree_stage_cpu_seconds      counter    method, stage
+    analysis_control_trees                       gauge      method, status
+
+The 'tree' stage is the whole job in the worker, from loading the species
+data to the Newick string. The peak resident memory of a stage is not
+exported: the worker's high-water mark covers all its earlier trees and the
+trees it builds at the same time.
+"""
+from __future__ import annotations
+
+import bisect
+import threading
+
+from pymongo import ASCENDING
+
+DEFAULTS = dict(
+    flush_seconds=10,  # how often each API worker adds its request counts to the database
+)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def create_indexes(db):
+    db.tree_stages.create_index([('method', ASCENDING), ('stage', ASCENDING)], unique=True)
+    db.request_metrics.create_index([('name', ASCENDING), ('labels', ASCENDING)], unique=True)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _header(name: str, help: str, kind: str) -> list[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+
+def histogram_lines(name: str, labels: dict, buckets, counts, total: float) -> list[str]:
+    """The samples of one histogram series; counts[i] is the number of observations in bucket i, the last in +Inf."""
+    lines, cumulative = list(), 0
+    for le, count in zip([*buckets, '+Inf'], counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {total}")
+    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return lines
+
+
+class Histogram(object):
+    """
+    A histogram with a series per combination of label values, summed over processes in db.request_metrics.
+    Observations are counted in this process until flush adds them to the database.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets=REQUEST_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = dict()  # label values: [counts per bucket, sum] since the last flush
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def flush(self, db):
+        """Add the observations since the last flush to the database; those not added are kept for the next."""
+        with self.lock:
+            pending, self.series = self.series, dict()
+        for values in list(pending):
+            counts, total = pending[values]
+            try:
+                db.request_metrics.update_one(
+                    {'name': self.name, 'labels': dict(zip(self.labels, values))},
+                    {'$inc': {**{f"buckets.{i}": count for i, count in enumerate(counts) if count}, 'sum': total}},
+                    upsert=True)
+            except Exception:
+                with self.lock:
+                    for kept, (kept_counts, kept_total) in pending.items():
+                        series = self.series.setdefault(kept, [[0] * (len(self.buckets) + 1), 0.])
+                        series[0] = [a + b for a, b in zip(series[0], kept_counts)]
+                        series[1] += kept_total
+                raise
+            del pending[values]
+
+    def lines(self, db) -> list[str]:
+        """The series of all processes, after adding those of this process."""
+        self.flush(db)
+        series = [(tuple(doc['labels'].get(label, '') for label in self.labels),
+                   [doc.get('buckets', dict()).get(str(i), 0) for i in range(len(self.buckets) + 1)], doc.get('sum', 0.))
+                  for doc in db.request_metrics.find({'name': self.name})]
+        lines = _header(self.name, self.help, 'histogram')
+        for values, counts, total in sorted(series):
+            lines.extend(histogram_lines(self.name, dict(zip(self.labels, values)), self.buckets, counts, total))
+        return lines
+
+
+def record_tree_stages(db, method: str, spans: list[dict]):
+    """Add the stages of a tree (MSTrees.Stages.spans) to the histograms in db.tree_stages."""
+    for span in spans:
+        db.tree_stages.update_one(
+            {'method': method, 'stage': span['stage']},
+            {'$inc': {f"buckets.{bisect.bisect_left(STAGE_BUCKETS, span['wall'])}": 1,
+                      'wall': span['wall'], 'cpu': span['cpu']}},
+            upsert=True)
+
+
+def tree_lines(db) -> list[str]:
+    """The tree stage and tree status metrics from the database."""
+    docs = sorted(db.tree_stages.find(), key=lambda doc: (doc['method'], doc['stage']))
+    lines = _header('analysis_control_tree_stage_seconds', 'Wall time of the stages of tree jobs', 'histogram')
+    for doc in docs:
+        counts = [doc.get('buckets', dict()).get(str(i), 0) for i in range(len(STAGE_BUCKETS) + 1)]
+        lines.extend(histogram_lines('analysis_control_tree_stage_seconds', dict(method=doc['method'], stage=doc['stage']),
+                                     STAGE_BUCKETS, counts, doc.get('wall', 0.)))
+    lines.extend(_header('analysis_control_tree_stage_cpu_seconds',
+                         'CPU time of the stages of tree jobs in the worker process', 'counter'))
+    lines.extend(f"analysis_control_tree_stage_cpu_seconds{_labels(dict(method=doc['method'], stage=doc['stage']))} "
+                 f"{doc.get('cpu', 0.)}" for doc in docs)
+    lines.extend(_header('analysis_control_trees', 'Tree jobs by method and status', 'gauge'))
+    # Trees stored before the job queue have no method or status
+    counts = db.trees.aggregate([{'$group': {
+        '_id': {'method': {'$ifNull': ['$method', 'MSTreeV2']}, 'status': {'$ifNull': ['$status', 'Unknown']}},
+        'count': {'$sum': 1}}}])
+    for doc in sorted(counts, key=lambda doc: (doc['_id']['method'], doc['_id']['status'])):
+        lines.append(f"analysis_control_trees{_labels(doc['_id'])} {doc['count']}")
+    return lines
+
+
+def exposition(*groups: list[str]) -> str:
+    return '\n'.join(line for lines in groups for line in lines) + '\n'
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from enum import Enum
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 
 from pydantic import BaseModel, Extra, Field, validator
@@ -42,11 +42,35 @@ class ComparativeAnalysis(Job):
     # Todo: add a validator that makes sure only sequences or allele_profiles is specified.
 
 
+class TreeStage(BaseModel):
+    stage: str
+    wall: float  # seconds
+    cpu: float  # seconds of the worker process
+    process_peak_rss: int  # bytes, high-water mark of the worker process since it started, not of the stage
+
+
+class TreeAnalysis(ComparativeAnalysis):
+    method: Optional[str] = 'MSTreeV2'  # MSTreeV2, MSTree or NJ
+    priority: Optional[int] = 0  # queued trees with higher priority are built first
+    stages: Optional[List[TreeStage]] = None  # of a finished tree, in the order they ran
+    estimated_seconds: Optional[float] = None
+    estimated_memory_mb: Optional[float] = None
+
+
 class NearestNeighbors(ComparativeAnalysis):
     cutoff: int
     result: Optional[List[str]] = None
 
 
+class TreeCacheStats(BaseModel):
+    species: str
+    hits: int = 0
+    coalesced: int = 0
+    misses: int = 0
+    evicted: int = 0
+    entries: int = 0
+
+
 class BifrostAnalysis(BaseModel):
     identifier: str
     version: Optional[str] = None
@@ -61,4 +85,33 @@ class BifrostJob(Job):
     analyses: Optional[List[str]] = None
     process_out: Optional[str] = None
     process_error: Optional[str] = None
-    job_id: Optional[str] = None
\ No newline at end of file
+    job_id: Optional[str] = None
+
+
+class BifrostCampaign(Job):
+    sequences: Optional[List[str]] = None
+    analyses: Optional[List[str]] = None
+    batch_size: Optional[int] = None
+    n_sequences: Optional[int] = None
+    n_batches: Optional[int] = None
+    batches: Optional[Dict[str, int]] = None  # number of batches in each state
+
+
+class HPCConnectionStats(BaseModel):
+    commands: int = 0
+    connections_opened: int = 0
+    reused: int = 0
+    reconnects: int = 0
+    failures: int = 0
+    open_connections: int = 0
+    busy_channels: int = 0
+
+
+class SpeciesResidency(BaseModel):
+    species: str
+    loaded: Dict[str, int] = dict()  # bytes of each loaded store
+    nbytes: int = 0
+    loads: int = 0
+    evictions: int = 0
+    load_seconds: Dict[str, float] = dict()  # duration of the last load of each store
+    last_used: Optional[datetime] = None
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Precomputed nearest neighbor index for small cgMLST cutoffs.
+
+For every sample the index stores the samples within 'max_radius' alleles,
+sorted by distance, in compressed sparse row layout:
+
+    neighbor_index.indptr.npy     int64, n + 1 row offsets
+    neighbor_index.neighbors.npy  uint32, neighbor positions in distance matrix order
+    neighbor_index.distances.npy  uint16, distance to each neighbor
+    neighbor_index.json           build metadata (radius, sample count, hash of the sample names, build time, size)
+
+A query for cutoff <= max_radius is a binary search in each requested row
+followed by a slice, so its cost depends on the number of neighbors found
+rather than the number of samples in the matrix.
+
+The positions are only valid for the matrix the index was built from, so the
+index is not loaded for a matrix whose sample names differ, for instance after
+samples were appended.
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+
+import distance_store
+
+PREFIX = 'neighbor_index'
+ARRAYS = ('indptr', 'neighbors', 'distances')
+
+
+class NeighborIndex(object):
+    def __init__(self, indptr: np.ndarray, neighbors: np.ndarray, distances: np.ndarray, meta: dict):
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.distances = distances
+        self.meta = meta
+        self.max_radius = meta['max_radius']
+
+    def __len__(self):
+        return self.indptr.size - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.neighbors.nbytes + self.distances.nbytes
+
+    def covers(self, cutoff: int) -> bool:
+        return cutoff <= self.max_radius
+
+    def query(self, positions, cutoff: int) -> np.ndarray:
+        """
+        Sorted, unique positions of all samples within 'cutoff' of any of the
+        samples at 'positions'. The samples themselves are not in their own rows.
+        """
+        if not self.covers(cutoff):
+            raise ValueError(f"Cutoff {cutoff} is larger than the index radius {self.max_radius}")
+        found = list()
+        for position in positions:
+            start, end = self.indptr[position], self.indptr[position + 1]
+            count = np.searchsorted(self.distances[start:end], cutoff, side='right')
+            found.append(self.neighbors[start:start + count])
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found)).astype(np.int64)
+
+
+def find_nearest_neighbors(input_sequences: list[str], matrix: distance_store.DistanceMatrix, cutoff: int,
+                           index: NeighborIndex = None) -> list[str]:
+    """
+    Samples within 'cutoff' alleles of any of the input sequences.
+    An input sequence is never reported as its own neighbor, but can be reported as a neighbor of another input sequence.
+    Uses the neighbor index when it covers the cutoff, otherwise scans the matrix rows.
+    """
+    if index is not None and index.covers(cutoff):
+        positions = [matrix.position(s) for s in input_sequences]
+        return matrix.names[index.query(positions, cutoff)].tolist()
+    return matrix.nearest_neighbors(input_sequences, cutoff).tolist()
+
+
+def index_paths(cgmlst_dir) -> dict:
+    cgmlst_dir = pathlib.Path(cgmlst_dir)
+    paths = {name: cgmlst_dir.joinpath(f"{PREFIX}.{name}.npy") for name in ARRAYS}
+    paths['meta'] = cgmlst_dir.joinpath(f"{PREFIX}.json")
+    return paths
+
+
+def names_hash(names) -> str:
+    """Hash of the sample names of a distance matrix, in matrix order."""
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(str(name).encode() + b'\n')
+    return digest.hexdigest()
+
+
+def build(matrix: distance_store.DistanceMatrix, max_radius: int, block_size: int = 256):
+    """Build the index in memory. Returns (indptr, neighbors, distances)."""
+    n_samples = len(matrix)
+    counts = np.zeros(n_samples, dtype=np.int64)
+    neighbors, distances = list(), list()
+    for start in range(0, n_samples, block_size):
+        block = matrix.values[start:start + block_size]
+        rows, cols = np.nonzero(block <= max_radius)
+        keep = cols != rows + start
+        rows, cols = rows[keep], cols[keep]
+        dists = block[rows, cols]
+        # Sort by row, then distance, then column, so each row is ordered by distance
+        order = np.lexsort((cols, dists, rows))
+        neighbors.append(cols[order].astype(np.uint32))
+        distances.append(dists[order].astype(np.uint16))
+        counts[start:start + block.shape[0]] = np.bincount(rows, minlength=block.shape[0])
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return indptr, np.concatenate(neighbors), np.concatenate(distances)
+
+
+def write(cgmlst_dir, max_radius: int) -> NeighborIndex:
+    """Build the index for the distance matrix in 'cgmlst_dir' and save it next to the matrix."""
+    start = datetime.now()
+    matrix = distance_store.load(cgmlst_dir)
+    arrays = dict(zip(ARRAYS, build(matrix, max_radius)))
+    paths = index_paths(cgmlst_dir)
+    meta = dict(
+        max_radius=max_radius,
+        n_samples=len(matrix),
+        names_hash=names_hash(matrix.names),
+        n_neighbors=int(arrays['neighbors'].size),
+        nbytes=int(sum(a.nbytes for a in arrays.values())),
+        build_seconds=(datetime.now() - start).total_seconds(),
+        built=datetime.now().isoformat(),
+    )
+    for name, array in arrays.items():
+        tmp_path = paths[name].with_name(paths[name].name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(tmp_path, paths[name])
+    # The metadata is written last, so an index is only picked up once complete
+    with open(paths['meta'], 'w') as file:
+        json.dump(meta, file, indent=2)
+    return NeighborIndex(*arrays.values(), meta)
+
+
+def load(cgmlst_dir, names=None) -> NeighborIndex:
+    """
+    Memory-map the index in 'cgmlst_dir'.
+    Raises FileNotFoundError if there is no index, and ValueError if it was built
+    for a distance matrix with other sample names than 'names', in matrix order.
+    """
+    paths = index_paths(cgmlst_dir)
+    with open(paths['meta']) as file:
+        meta = json.load(file)
+    if names is not None and meta.get('names_hash') != names_hash(names):
+        raise ValueError(f"Neighbor index in {cgmlst_dir} was built for another distance matrix "
+                         f"({meta['n_samples']} samples, the matrix has {len(names)}). "
+                         f"Run 'python neighbor_index.py {cgmlst_dir}' to rebuild it.")
+    arrays = [np.load(paths[name], mmap_mode='r') for name in ARRAYS]
+    return NeighborIndex(*arrays, meta)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a sorted nearest neighbor index from a distance matrix.')
+    parser.add_argument('cgmlst_dir', help='Directory with the distance matrix (binary store or distance_matrix.tsv)')
+    parser.add_argument('--max_radius', '-r', help='Largest cutoff the index can answer [DEFAULT: 20]', type=int, default=20)
+    args = parser.parse_args()
+    index = write(args.cgmlst_dir, args.max_radius)
+    print(f"Built neighbor index for {len(index)} samples with radius {index.max_radius}: "
+          f"{index.meta['n_neighbors']} neighbors, {index.meta['nbytes']} bytes in {index.meta['build_seconds']:.1f} seconds")
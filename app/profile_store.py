@@ -0,0 +1,283 @@
+"""
+Integer encoded, memory-mappable storage for cgMLST allele profiles.
+
+allele_profiles.tsv holds one row per sample and one column per locus, with
+allele IDs (numbers or hashes) as strings and '-' (or '0', 'N' or an empty
+field) for missing alleles. Each locus is dictionary encoded: every distinct
+allele ID of the locus gets a code from 1 upwards, and 0 means missing.
+The store consists of:
+
+    allele_profiles.codes.npy          n x L uint32 allele codes
+    allele_profiles.names              sample names, one per line
+    allele_profiles.loci               locus names, one per line
+    allele_profiles.alleles.npy        allele IDs of all loci as fixed width bytes
+    allele_profiles.allele_offsets.npy int64 start of each locus in the allele array
+    allele_profiles.json               sizes and a content hash used as data version
+
+Within a locus, position 0 of its block in the allele array is the missing
+marker, so code c of locus j is alleles[allele_offsets[j] + c].
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+TSV_NAME = 'allele_profiles.tsv'
+PREFIX = 'allele_profiles'
+MISSING_ALLELES = ('', '-', '0', 'N')
+MISSING = '-'
+
+
+class ProfileStore(object):
+    """
+    Allele profiles as an n x L matrix of per-locus allele codes (0 = missing),
+    with the lookup from codes back to the original allele IDs.
+    'codes', 'alleles' and 'allele_offsets' may be in-memory arrays or read-only memmaps.
+    """
+
+    def __init__(self, names, loci, codes: np.ndarray, alleles: np.ndarray, allele_offsets: np.ndarray, meta: dict):
+        if codes.shape != (len(names), len(loci)):
+            raise ValueError(f"Allele codes of shape {codes.shape} do not match {len(names)} samples and {len(loci)} loci")
+        self.names = np.asarray(names, dtype=object)
+        self.loci = np.asarray(loci, dtype=object)
+        self.codes = codes
+        self.alleles = alleles
+        self.allele_offsets = allele_offsets
+        self.meta = meta
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    @property
+    def version(self) -> str:
+        return self.meta['version']
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.alleles.nbytes + self.allele_offsets.nbytes
+
+    def positions(self, names) -> np.ndarray:
+        """Row numbers of the given samples. Raises KeyError for unknown samples."""
+        return np.array([self.index[name] for name in names], dtype=np.int64)
+
+    def profiles(self, names) -> np.ndarray:
+        """Allele codes of the given samples, one row per sample."""
+        return self.codes[self.positions(names)]
+
+    def decode(self, codes: np.ndarray, loci=None) -> np.ndarray:
+        """
+        Original allele IDs for a matrix of codes, with '-' for missing alleles.
+        'loci' are the column numbers of 'codes' in the store (default: all loci).
+        """
+        offsets = self.allele_offsets[:-1] if loci is None else self.allele_offsets[loci]
+        return self.alleles[offsets + codes].astype(str)
+
+    def to_frame(self, names) -> pd.DataFrame:
+        """The given samples' profiles with the original allele IDs, as read from allele_profiles.tsv."""
+        return pd.DataFrame(self.decode(self.profiles(names)), index=list(names), columns=self.loci)
+
+    def differences(self, names) -> dict:
+        """
+        The loci where the given samples have different alleles or a missing allele,
+        as {locus: {sample: allele ID}}, with numeric allele IDs as int (see allele_id).
+        """
+        codes = self.profiles(names)
+        loci = variable_loci(codes)
+        alleles = self.decode(codes[:, loci], loci)
+        return {locus: dict(zip(names, map(allele_id, column)))
+                for locus, column in zip(self.loci[loci].tolist(), alleles.T.tolist())}
+
+    def compact(self, codes: np.ndarray, loci) -> tuple[list[list[str]], np.ndarray]:
+        """
+        Codes numbered within the given rows only: for each locus, the allele IDs that
+        occur ('-' first, numeric IDs as int) and the codes as positions in that list, so 0
+        is still missing. 'loci' are the column numbers of 'codes' in the store.
+        """
+        local = np.empty(codes.shape, dtype=np.min_scalar_type(codes.shape[0]))
+        alleles = list()
+        for j, locus in enumerate(loci):
+            uniques, inverse = np.unique(codes[:, j], return_inverse=True)
+            if uniques[0] != 0:
+                uniques, inverse = np.concatenate([[0], uniques]), inverse + 1
+            local[:, j] = inverse
+            alleles.append([allele_id(allele) for allele in self.decode(uniques, [locus] * uniques.size).tolist()])
+        return alleles, local
+
+
+def allele_id(allele: str):
+    """
+    An allele ID as the API returned it when allele_profiles.tsv was read with
+    pandas' type inference: numbers as int, and hashes and '-' as str.
+    """
+    return int(allele) if allele.isascii() and allele.isdigit() else allele
+
+
+def variable_loci(codes: np.ndarray) -> np.ndarray:
+    """Column numbers of the loci where the rows have different alleles or a missing allele."""
+    if codes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    low, high = codes.min(axis=0), codes.max(axis=0)
+    return np.flatnonzero((low != high) | (low == 0))
+
+
+class _Encoder(object):
+    """Assigns codes to allele IDs locus by locus, in order of first appearance."""
+
+    def __init__(self, n_loci: int):
+        self.lookups = [{allele: 0 for allele in MISSING_ALLELES} for _ in range(n_loci)]
+
+    def encode(self, chunk: pd.DataFrame) -> np.ndarray:
+        codes = np.zeros(chunk.shape, dtype=np.uint32)
+        for j, (label, content) in enumerate(chunk.items()):
+            lookup = self.lookups[j]
+            inverse, uniques = pd.factorize(content.to_numpy())
+            unique_codes = np.array([lookup.setdefault(allele, len(lookup) - len(MISSING_ALLELES) + 1)
+                                     for allele in uniques], dtype=np.uint32)
+            codes[:, j] = unique_codes[inverse]
+        return codes
+
+    def alleles(self) -> tuple[np.ndarray, np.ndarray]:
+        blocks = [[MISSING] + [allele for allele, code in lookup.items() if code > 0] for lookup in self.lookups]
+        offsets = np.concatenate([[0], np.cumsum([len(block) for block in blocks])]).astype(np.int64)
+        return np.array([allele for block in blocks for allele in block], dtype=bytes), offsets
+
+
+def _read_chunks(tsv_path, chunksize: int):
+    return pd.read_csv(tsv_path, sep='\t', index_col=0, header=0, dtype=str, keep_default_na=False,
+                       chunksize=chunksize)
+
+
+def _version(names, codes: np.ndarray, alleles: np.ndarray, block_size: int = 10000) -> str:
+    digest = hashlib.sha1()
+    digest.update('\n'.join(names).encode())
+    for start in range(0, codes.shape[0], block_size):
+        digest.update(np.ascontiguousarray(codes[start:start + block_size]).tobytes())
+    digest.update(alleles.tobytes())
+    return digest.hexdigest()
+
+
+def read_tsv(tsv_path, chunksize: int = 1000) -> ProfileStore:
+    """Encode allele_profiles.tsv into an in-memory store."""
+    names, code_chunks, loci, encoder = list(), list(), None, None
+    for chunk in _read_chunks(tsv_path, chunksize):
+        if encoder is None:
+            loci = chunk.columns.tolist()
+            encoder = _Encoder(len(loci))
+        code_chunks.append(encoder.encode(chunk))
+        names.extend(chunk.index)
+    codes = np.vstack(code_chunks)
+    alleles, offsets = encoder.alleles()
+    meta = dict(n_samples=len(names), n_loci=len(loci), version=_version(names, codes, alleles))
+    return ProfileStore(names, loci, codes, alleles, offsets, meta)
+
+
+def store_paths(cgmlst_dir) -> dict:
+    cgmlst_dir = pathlib.Path(cgmlst_dir)
+    paths = {name: cgmlst_dir.joinpath(f"{PREFIX}.{name}.npy") for name in ('codes', 'alleles', 'allele_offsets')}
+    paths['names'] = cgmlst_dir.joinpath(f"{PREFIX}.names")
+    paths['loci'] = cgmlst_dir.joinpath(f"{PREFIX}.loci")
+    paths['meta'] = cgmlst_dir.joinpath(f"{PREFIX}.json")
+    return paths
+
+
+def _read_lines(path) -> list[str]:
+    with open(path) as file:
+        return [line.rstrip('\n') for line in file]
+
+
+def _write_lines(path, lines):
+    with open(path, 'w') as file:
+        for line in lines:
+            file.write(f"{line}\n")
+
+
+def convert(tsv_path, out_dir=None, chunksize: int = 1000) -> ProfileStore:
+    """
+    Encode allele_profiles.tsv into the binary store.
+    Only one chunk of rows is held as strings at a time. The codes are written
+    to a temporary file and all files are renamed into place when complete.
+    """
+    tsv_path = pathlib.Path(tsv_path)
+    out_dir = tsv_path.parent if out_dir is None else pathlib.Path(out_dir)
+    paths = store_paths(out_dir)
+    tmp_paths = {name: path.with_name(path.name + '.tmp') for name, path in paths.items()}
+
+    with open(tsv_path) as file:
+        n_samples = sum(1 for line in file if line.strip()) - 1
+    names, loci, encoder, codes = list(), None, None, None
+    try:
+        for chunk in _read_chunks(tsv_path, chunksize):
+            if encoder is None:
+                loci = chunk.columns.tolist()
+                encoder = _Encoder(len(loci))
+                codes = np.lib.format.open_memmap(tmp_paths['codes'], mode='w+', dtype=np.uint32,
+                                                  shape=(n_samples, len(loci)))
+            codes[len(names):len(names) + chunk.shape[0]] = encoder.encode(chunk)
+            names.extend(chunk.index)
+        if len(names) != n_samples:
+            raise ValueError(f"Read {len(names)} of {n_samples} samples from {tsv_path}")
+        codes.flush()
+        alleles, offsets = encoder.alleles()
+        meta = dict(n_samples=n_samples, n_loci=len(loci), version=_version(names, codes, alleles),
+                    converted=datetime.now().isoformat())
+        del codes
+        for name, array in (('alleles', alleles), ('allele_offsets', offsets)):
+            with open(tmp_paths[name], 'wb') as file:
+                np.save(file, array)
+        _write_lines(tmp_paths['names'], names)
+        _write_lines(tmp_paths['loci'], loci)
+        with open(tmp_paths['meta'], 'w') as file:
+            json.dump(meta, file, indent=2)
+        # The metadata is renamed last, so a store is only picked up once complete
+        for name in ('codes', 'alleles', 'allele_offsets', 'names', 'loci', 'meta'):
+            os.replace(tmp_paths[name], paths[name])
+    finally:
+        for path in tmp_paths.values():
+            if path.exists():
+                os.unlink(path)
+    return load(out_dir)
+
+
+def load(cgmlst_dir) -> ProfileStore:
+    """
+    Load the allele profiles for a cgMLST directory.
+    Uses the memory-mapped binary store when present and falls back to
+    encoding allele_profiles.tsv in memory.
+    Raises FileNotFoundError if neither exists.
+    """
+    paths = store_paths(cgmlst_dir)
+    if paths['meta'].exists():
+        with open(paths['meta']) as file:
+            meta = json.load(file)
+        return ProfileStore(
+            _read_lines(paths['names']),
+            _read_lines(paths['loci']),
+            np.load(paths['codes'], mmap_mode='r'),
+            np.load(paths['alleles'], mmap_mode='r'),
+            np.load(paths['allele_offsets']),
+            meta)
+    tsv_path = pathlib.Path(cgmlst_dir, TSV_NAME)
+    print(f"No binary allele profiles in {cgmlst_dir}, encoding {tsv_path}. "
+          f"Run 'python profile_store.py {tsv_path}' to convert it.")
+    return read_tsv(tsv_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode allele_profiles.tsv into a memory-mappable binary store.')
+    parser.add_argument('tsv', help='Path to allele_profiles.tsv')
+    parser.add_argument('--out_dir', '-o', help='Output directory [DEFAULT: same directory as the input]', default=None)
+    args = parser.parse_args()
+    start = datetime.now()
+    store = convert(args.tsv, args.out_dir)
+    print(f"Converted {len(store)} samples with {len(store.loci)} loci ({store.nbytes} bytes) in {datetime.now() - start}")
@@ -0,0 +1,151 @@
+"""
+cgMLST data of the configured species, loaded on first use.
+
+Each species has up to three stores in its cgMLST directory:
+
+    distance_matrix   distance_store.load
+    allele_profiles   profile_store.load
+    neighbor_index    neighbor_index.load, checked against the distance matrix
+
+A store is loaded the first time it is requested, not when the process starts.
+Each species has a lock, so concurrent requests for a species that is still
+loading wait for that one load, while other species load in parallel. A store
+is loaded again when its files on disk change, and a missing store is tried
+again once its files appear.
+
+When the loaded stores of all species take more than 'memory_budget_mb', the
+stores of the least recently used species are dropped until they fit again.
+The species being requested is never dropped. Memory-mapped stores count with
+their full size, although only the pages that are read take up memory.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import datetime
+import pathlib
+import threading
+import time
+
+import distance_store
+import neighbor_index
+import profile_store
+
+DEFAULTS = dict(
+    memory_budget_mb=0,  # 0 for no limit
+    preload=[],          # species loaded in the background at startup
+)
+
+KINDS = ('distance_matrix', 'allele_profiles', 'neighbor_index')
+
+
+class SpeciesData(object):
+    """
+    Stores of the species in 'species' (the species section of the config).
+    'on_load' is called with the species, the kind and the store after each load.
+    """
+
+    def __init__(self, species: dict, chewie_data, memory_budget_mb: float = 0, on_load=None):
+        self.dirs = {name: pathlib.Path(chewie_data, v['cgmlst']) for name, v in species.items()}
+        self.memory_budget = memory_budget_mb * 2 ** 20
+        self.on_load = on_load
+        # Reentrant, as the neighbor index loads the distance matrix of the same species
+        self.locks = {name: threading.RLock() for name in self.dirs}
+        self.lock = threading.Lock()  # guards 'recent'
+        self.stores = {name: dict() for name in self.dirs}  # species: {kind: (file stamp, store or None)}
+        self.recent = OrderedDict()  # loaded species, least recently used first
+        self.metrics = {name: dict(loads=0, evictions=0, load_seconds=dict(), last_used=None) for name in self.dirs}
+
+    def cgmlst_dir(self, species: str) -> pathlib.Path:
+        species = species.replace(' ', '_')
+        if species not in self.dirs:
+            raise KeyError(f"Species {species} is not configured")
+        return self.dirs[species]
+
+    def _paths(self, species: str, kind: str) -> list:
+        cgmlst_dir = self.dirs[species]
+        if kind == 'distance_matrix':
+            return [*distance_store.store_paths(cgmlst_dir), cgmlst_dir.joinpath(distance_store.TSV_NAME)]
+        if kind == 'allele_profiles':
+            return [profile_store.store_paths(cgmlst_dir)['meta'], cgmlst_dir.joinpath(profile_store.TSV_NAME)]
+        if kind == 'neighbor_index':
+            return [neighbor_index.index_paths(cgmlst_dir)['meta'], *self._paths(species, 'distance_matrix')]
+        raise ValueError(f"Kind must be one of {KINDS}, not {kind}")
+
+    def _stamp(self, species: str, kind: str) -> tuple:
+        return tuple(path.stat().st_mtime_ns if path.exists() else None for path in self._paths(species, kind))
+
+    def _load(self, species: str, kind: str):
+        cgmlst_dir = self.dirs[species]
+        start = time.perf_counter()
+        try:
+            if kind == 'distance_matrix':
+                store = distance_store.load(cgmlst_dir)
+            elif kind == 'allele_profiles':
+                store = profile_store.load(cgmlst_dir)
+            else:
+                matrix = self.get(species, 'distance_matrix')
+                store = None if matrix is None else neighbor_index.load(cgmlst_dir, matrix.names)
+        except FileNotFoundError:
+            print(f"No {kind.replace('_', ' ')} found in {cgmlst_dir}")
+            return None
+        except ValueError as e:
+            print(e)
+            return None
+        seconds = time.perf_counter() - start
+        self.metrics[species]['loads'] += 1
+        self.metrics[species]['load_seconds'][kind] = seconds
+        print(f"Loaded {kind.replace('_', ' ')} for {species} in {seconds:.2f} seconds")
+        if store is not None and self.on_load is not None:
+            self.on_load(species, kind, store)
+        return store
+
+    def get(self, species: str, kind: str):
+        """The store of a species, loaded if needed, or None if the species has no such store."""
+        self.cgmlst_dir(species)  # raises KeyError for species that are not configured
+        species = species.replace(' ', '_')
+        with self.locks[species]:
+            stamp = self._stamp(species, kind)
+            if kind not in self.stores[species] or self.stores[species][kind][0] != stamp:
+                self.stores[species][kind] = (stamp, self._load(species, kind))
+            store = self.stores[species][kind][1]
+        with self.lock:
+            self.recent[species] = True
+            self.recent.move_to_end(species)
+            self.metrics[species]['last_used'] = datetime.now()
+        self._evict(keep=species)
+        return store
+
+    @staticmethod
+    def _nbytes(stores: dict) -> int:
+        return sum(store.nbytes for stamp, store in stores.values() if store is not None)
+
+    def _evict(self, keep: str):
+        """Drop the stores of the least recently used species while all stores take more than the budget."""
+        if not self.memory_budget:
+            return
+        with self.lock:
+            total = sum(self._nbytes(stores) for stores in self.stores.values())
+            for species in list(self.recent):
+                if total <= self.memory_budget:
+                    break
+                # Skip the requested species and species that are loading
+                if species == keep or not self.locks[species].acquire(blocking=False):
+                    continue
+                try:
+                    total -= self._nbytes(self.stores[species])
+                    self.stores[species] = dict()
+                    del self.recent[species]
+                    self.metrics[species]['evictions'] += 1
+                finally:
+                    self.locks[species].release()
+                print(f"Dropped the data of {species} to stay within {self.memory_budget / 2 ** 20:.0f} MB")
+
+    def residency(self) -> list[dict]:
+        """Loaded stores, their size, and load timings per species."""
+        residency = list()
+        for species in self.dirs:
+            stores = dict(self.stores[species])
+            loaded = {kind: store.nbytes for kind, (stamp, store) in stores.items() if store is not None}
+            residency.append(dict(species=species, loaded=loaded, nbytes=sum(loaded.values()),
+                                  **self.metrics[species]))
+        return residency
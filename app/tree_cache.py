@@ -0,0 +1,103 @@
+"""
+Content-addressed cache of finished trees in the db.trees collection.
+
+A tree document built through the cache carries a 'cache_key': the SHA-1 of
+the species, the sorted sample names, the tree method, its matrix type, the
+version of the allele profile store (see profile_store) and the source of the
+distances, the profiles or the distance matrix store (see tree_jobs). A unique
+index on 'cache_key' means that at most one document holds a key, so a request
+for a tree that is already built, queued or running is answered with that
+document:
+
+    Succeeded          hit: the tree is returned at once
+    Queued, Running    coalesced: the request gets the same job_id
+    no document        miss: a new job is queued (see tree_jobs)
+
+Failed jobs and trees built from another profile version or distance source
+than their key says give up their key, so the next request builds them again.
+When a new profile version is loaded, the keys of the old version are evicted.
+The trees stay in the collection; they are only no longer served from the
+cache.
+
+Hits, coalesced requests and misses are counted per species in db.tree_cache.
+"""
+from __future__ import annotations
+
+import hashlib
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from models import JobStatus
+import tree_jobs
+
+
+def create_indexes(db):
+    db.trees.create_index([('cache_key', ASCENDING)], unique=True,
+                          partialFilterExpression={'cache_key': {'$exists': True}})
+    db.trees.create_index([('species', ASCENDING), ('profile_version', ASCENDING)])
+
+
+def cache_key(species: str, sequences: list[str], method: str, profile_version: str,
+              distance_source: str = 'profiles') -> str:
+    digest = hashlib.sha1()
+    for part in (species.replace('_', ' '), method, tree_jobs.METHODS[method]['matrix_type'], profile_version,
+                 distance_source):
+        digest.update(part.encode() + b'\0')
+    digest.update('\n'.join(sorted(sequences)).encode())
+    return digest.hexdigest()
+
+
+def _count(db, species: str, counter: str):
+    db.tree_cache.update_one({'_id': species.replace('_', ' ')}, {'$inc': {counter: 1}}, upsert=True)
+
+
+def get_or_enqueue(db, species: str, sequences: list[str], method: str, profile_version: str, priority: int = 0,
+                   estimate: dict = None, distance_source: str = 'profiles'):
+    """
+    The tree document for these samples and method, queued as a new job if there is none.
+    Returns the document and whether it was a 'hit', 'coalesced' or 'miss'.
+    """
+    key = cache_key(species, sequences, method, profile_version, distance_source)
+    new_doc = tree_jobs.new_job(species, sorted(sequences), method, profile_version, priority, estimate,
+                                distance_source)
+    new_doc['_id'] = ObjectId()
+    for attempt in range(2):
+        try:
+            doc = db.trees.find_one_and_update(
+                {'cache_key': key}, {'$setOnInsert': new_doc}, upsert=True, return_document=ReturnDocument.BEFORE)
+            break
+        except DuplicateKeyError:
+            # Another request inserted the key between our lookup and insert; the retry finds it
+            if attempt:
+                raise
+    if doc is None:
+        outcome, doc = 'miss', dict(new_doc, cache_key=key)
+    elif doc['status'] == JobStatus.Succeeded.value:
+        outcome = 'hit'
+    else:
+        outcome = 'coalesced'
+        if priority > doc.get('priority', 0):
+            db.trees.update_one({'_id': doc['_id'], 'status': JobStatus.Queued.value}, {'$set': {'priority': priority}})
+    _count(db, species, outcome)
+    return doc, outcome
+
+
+def evict_stale(db, species: str, profile_version: str) -> int:
+    """Evict the cached trees of a species that were built from another profile version."""
+    result = db.trees.update_many(
+        {'species': species.replace('_', ' '), 'cache_key': {'$exists': True},
+         'profile_version': {'$ne': profile_version}},
+        {'$unset': {'cache_key': ''}})
+    if result.modified_count:
+        db.tree_cache.update_one({'_id': species.replace('_', ' ')},
+                                 {'$inc': {'evicted': result.modified_count}}, upsert=True)
+    return result.modified_count
+
+
+def stats(db) -> list[dict]:
+    return [dict(species=doc['_id'], hits=doc.get('hit', 0), coalesced=doc.get('coalesced', 0),
+                 misses=doc.get('miss', 0), evicted=doc.get('evicted', 0),
+                 entries=db.trees.count_documents({'species': doc['_id'], 'cache_key': {'$exists': True}}))
+            for doc in db.tree_cache.find()]
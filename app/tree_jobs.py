@@ -0,0 +1,379 @@
+"""
+Persistent queue for tree jobs, kept in the db.trees collection.
+
+The API only inserts a tree document with status 'Queued'. Separate worker
+processes (started with 'python tree_jobs.py') claim queued documents one at
+a time, build the tree and store it on the document:
+
+    Queued -> Running -> Succeeded
+                      -> Failed
+
+A worker claims the queued job with the highest priority, oldest first, in a
+single find_one_and_update, so two workers never get the same job. Each worker
+process builds 'trees_per_worker' trees at the same time in threads, which
+share the loaded species data, and each tree is built with 'n_proc' processes.
+Every tree has its own parameters and scratch directory (see
+MSTrees.TreeEngine). Trees with a symmetric
+distance matrix (MSTree, NJ) of samples that are all in the species' binary
+distance matrix store take the distances from the store instead of comparing
+the allele profiles. This 'distance_source' is decided when the job is queued
+and recorded on it, as it is part of the job's cache key (see tree_cache).
+
+The wall time, CPU time and peak resident memory of each stage of a tree
+(see MSTrees.Stages) are stored on its document as 'stages', whether it
+succeeded or failed, and added to the tree stage metrics (see metrics).
+
+Jobs carry the time and memory estimated when they were admitted, and the
+number of processes to build them with (see tree_resources). Before it builds a claimed job, a worker reserves the job's
+estimate, times 'memory_margin', on its host in db.tree_hosts, with a single
+find_one_and_update that only succeeds while the reservations of all trees on
+the host leave room for it (see host_memory), so workers and their threads
+cannot overcommit the host between them. A job that does not fit is deferred:
+it goes back in the queue and is not claimed again for 'defer_seconds', so
+smaller jobs can run meanwhile. After 'max_deferrals' the job fails. The
+reservation is released when the tree is finished, and the supervisor releases
+the reservations of jobs its workers no longer run.
+
+While a job runs its worker updates the job's heartbeat. The supervisor puts
+jobs whose heartbeat has stopped (the worker was killed or the host restarted)
+back in the queue, and fails them after 'max_attempts' tries.
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+import os
+import socket
+import threading
+import time
+
+from bson import ObjectId
+import psutil
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument
+import yaml
+
+import distance_store
+import metrics
+import MSTrees
+from models import JobStatus
+import species_data
+
+DEFAULTS = dict(
+    workers=2,            # worker processes
+    trees_per_worker=1,   # trees built at the same time by each worker process
+    n_proc=4,             # processes per tree
+    scratch_dir=None,     # temporary files of the external tree programs [DEFAULT: the system temporary directory]
+    poll_seconds=1.0,     # wait between claims when the queue is empty
+    heartbeat_seconds=10,
+    stale_seconds=120,    # a running job without heartbeat for this long is requeued
+    max_attempts=3,
+    use_distance_matrix=True,  # symmetric trees take their distances from the distance matrix store
+    calibration=None,     # time and memory models written by 'python tests/manual/calibrate_trees.py' [DEFAULT: built-in estimates]
+    tree_memory_mb=0,     # memory one tree may use; 0 for the host's memory divided by workers * trees_per_worker
+    memory_margin=1.25,   # estimated memory is multiplied by this before it is compared
+    defer_seconds=30,     # a job that does not fit in the available memory is claimed again after this
+    max_deferrals=60,
+)
+
+# MSTrees parameters of each tree method
+METHODS = {
+    'MSTreeV2': dict(method='MSTreeV2', matrix_type='asymmetric'),
+    'MSTree': dict(method='MSTree', matrix_type='symmetric', heuristic='eBurst', branch_recraft=False),
+    'NJ': dict(method='NJ', matrix_type='symmetric', branch_recraft=False),
+}
+
+
+def job_config(config: dict) -> dict:
+    """The 'tree_jobs' section of the application config with defaults filled in."""
+    return {**DEFAULTS, **(config.get('tree_jobs') or dict())}
+
+
+def create_indexes(db):
+    db.trees.create_index([('status', ASCENDING), ('priority', DESCENDING), ('initialized', ASCENDING)])
+    db.trees.create_index([('status', ASCENDING), ('heartbeat', ASCENDING)])
+
+
+def distance_source(data: species_data.SpeciesData, species: str, sequences: list[str], method: str,
+                    settings: dict) -> str:
+    """'store' if a tree takes its distances from the species' binary distance matrix store, otherwise 'profiles'."""
+    if not settings['use_distance_matrix'] or METHODS[method]['matrix_type'] != 'symmetric':
+        return 'profiles'
+    # Without a binary store the TSV would be parsed, which is slower than building the tree
+    matrix_path, names_path = distance_store.store_paths(data.cgmlst_dir(species))
+    matrix = data.get(species, 'distance_matrix') if names_path.exists() else None
+    return 'store' if matrix is not None and all(name in matrix for name in sequences) else 'profiles'
+
+
+def new_job(species: str, sequences: list[str], method: str = 'MSTreeV2', profile_version: str = None,
+            priority: int = 0, estimate: dict = None, distance_source: str = 'profiles') -> dict:
+    """
+    A queued tree document. 'estimate' has the estimated 'seconds' and 'memory' in bytes of the tree,
+    and the 'n_proc' it is built with.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Tree method must be one of {list(METHODS)}, not {method}")
+    return {
+        'estimate': estimate,
+        'initialized': datetime.now(),
+        'type': 'S',
+        'elements': sequences,
+        'species': species.replace('_', ' '),
+        'method': method,
+        'profile_version': profile_version,
+        'distance_source': distance_source,
+        'status': JobStatus.Queued.value,
+        'priority': priority,
+        'attempts': 0,
+    }
+
+
+def claim(db, worker: str):
+    """Atomically take the next queued job, or None if the queue is empty."""
+    now = datetime.now()
+    return db.trees.find_one_and_update(
+        {'status': JobStatus.Queued.value,
+         '$or': [{'not_before': {'$exists': False}}, {'not_before': {'$lte': now}}]},
+        {'$set': {'status': JobStatus.Running.value, 'started': now, 'heartbeat': now, 'worker': worker},
+         '$inc': {'attempts': 1}},
+        sort=[('priority', DESCENDING), ('initialized', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def finish(db, _id, worker: str, tree: str, stages: list[dict] = None):
+    """Store the tree. Does nothing if the job was requeued and taken by another worker meanwhile."""
+    return db.trees.find_one_and_update(
+        {'_id': _id, 'worker': worker, 'status': JobStatus.Running.value},
+        {'$set': {'status': JobStatus.Succeeded.value, 'tree': tree, 'finished': datetime.now(),
+                  'stages': stages or list()},
+         '$unset': {'heartbeat': ''}})
+
+
+def fail(db, _id, worker: str, error: str, stages: list[dict] = None):
+    return db.trees.find_one_and_update(
+        {'_id': _id, 'worker': worker, 'status': JobStatus.Running.value},
+        {'$set': {'status': JobStatus.Failed.value, 'error': error, 'finished': datetime.now(),
+                  'stages': stages or list()},
+         '$unset': {'heartbeat': '', 'cache_key': ''}})
+
+
+def defer(db, _id, worker: str, seconds: float):
+    """Put a claimed job back in the queue, to be claimed again after 'seconds'. The claim does not count as an attempt."""
+    return db.trees.find_one_and_update(
+        {'_id': _id, 'worker': worker, 'status': JobStatus.Running.value},
+        {'$set': {'status': JobStatus.Queued.value, 'not_before': datetime.now() + timedelta(seconds=seconds)},
+         '$inc': {'attempts': -1, 'deferrals': 1},
+         '$unset': {'heartbeat': '', 'worker': '', 'started': ''}})
+
+
+def host_memory(settings: dict) -> float:
+    """Bytes the trees of one host may reserve together: 'tree_memory_mb' for each tree built at a time, or the host's memory."""
+    n_trees = settings['workers'] * settings['trees_per_worker']
+    if settings['tree_memory_mb']:
+        return settings['tree_memory_mb'] * 2 ** 20 * n_trees
+    return psutil.virtual_memory().total
+
+
+def reserved_memory(job: dict, margin: float) -> int:
+    return int((job.get('estimate') or dict()).get('memory', 0) * margin)
+
+
+def init_host(db, host: str):
+    db.tree_hosts.update_one({'_id': host}, {'$setOnInsert': {'reserved': 0, 'jobs': dict()}}, upsert=True)
+
+
+def reserve(db, host: str, job: dict, worker: str, capacity: float, margin: float) -> bool:
+    """Atomically reserve the memory of a claimed job on the host, if the host's reservations leave room for it."""
+    memory = reserved_memory(job, margin)
+    key = f"jobs.{job['_id']}"
+    return db.tree_hosts.find_one_and_update(
+        {'_id': host, key: {'$exists': False}, 'reserved': {'$lte': capacity - memory}},
+        {'$inc': {'reserved': memory}, '$set': {key: dict(worker=worker, memory=memory)}}) is not None
+
+
+def release(db, host: str, _id, worker: str, memory: int):
+    """Release the reservation of a job, if the worker still holds it."""
+    db.tree_hosts.update_one({'_id': host, f"jobs.{_id}.worker": worker},
+                             {'$inc': {'reserved': -memory}, '$unset': {f"jobs.{_id}": ''}})
+
+
+def release_stale(db, host: str) -> int:
+    """Release the reservations of jobs that are no longer run by the worker that reserved them."""
+    doc = db.tree_hosts.find_one({'_id': host}) or dict()
+    released = 0
+    for _id, reservation in (doc.get('jobs') or dict()).items():
+        if db.trees.find_one({'_id': ObjectId(_id), 'status': JobStatus.Running.value,
+                              'worker': reservation['worker']}, {'_id': 1}) is None:
+            release(db, host, _id, reservation['worker'], reservation['memory'])
+            released += 1
+    return released
+
+
+def requeue_stale(db, stale_seconds: float, max_attempts: int) -> int:
+    """Requeue (or fail, after max_attempts) running jobs whose heartbeat is older than stale_seconds."""
+    limit = datetime.now() - timedelta(seconds=stale_seconds)
+    stale = {'status': JobStatus.Running.value, 'heartbeat': {'$lt': limit}}
+    failed = db.trees.update_many(
+        {**stale, 'attempts': {'$gte': max_attempts}},
+        {'$set': {'status': JobStatus.Failed.value, 'finished': datetime.now(),
+                  'error': f"Worker stopped responding {max_attempts} times"},
+         '$unset': {'heartbeat': '', 'worker': '', 'cache_key': ''}})
+    requeued = db.trees.update_many(
+        stale,
+        {'$set': {'status': JobStatus.Queued.value}, '$unset': {'heartbeat': '', 'worker': ''}})
+    return failed.modified_count + requeued.modified_count
+
+
+class Heartbeat(threading.Thread):
+    """Updates a running job's heartbeat until stopped."""
+
+    def __init__(self, db, _id, worker: str, seconds: float):
+        super().__init__(daemon=True)
+        self.db, self._id, self.worker, self.seconds = db, _id, worker, seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.seconds):
+            self.db.trees.update_one({'_id': self._id, 'worker': self.worker},
+                                     {'$set': {'heartbeat': datetime.now()}})
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(db, job: dict, worker: str, data: species_data.SpeciesData, engine: MSTrees.TreeEngine, settings: dict):
+    """Build the tree of a claimed job and store it, or store the error."""
+    heartbeat = Heartbeat(db, job['_id'], worker, settings['heartbeat_seconds'])
+    heartbeat.start()
+    stages = MSTrees.Stages()
+    method_name = job.get('method', 'MSTreeV2')
+    try:
+        with stages('tree'):
+            with stages('load_profiles'):
+                store = data.get(job['species'], 'allele_profiles')
+                if store is None:
+                    raise FileNotFoundError(f"No allele profiles for {job['species']}")
+                profiles = store.profiles(job['elements'])
+            if job.get('profile_version') not in (None, store.version):
+                # The store was replaced after the job was queued, so the tree does not belong under its cache key
+                db.trees.update_one({'_id': job['_id']}, {'$set': {'profile_version': store.version},
+                                                         '$unset': {'cache_key': ''}})
+            method = METHODS[method_name]
+            dist = None
+            # Jobs queued before the source was recorded take the store whenever it has their samples
+            source = job.get('distance_source')
+            if source != 'profiles':
+                with stages('load_distances'):
+                    if distance_source(data, job['species'], job['elements'], method_name, settings) == 'store':
+                        dist = data.get(job['species'], 'distance_matrix').sub_matrix(job['elements'])
+                    elif source == 'store':
+                        # The store was replaced or disabled after the job was queued, so the tree does not belong under its cache key
+                        db.trees.update_one({'_id': job['_id']}, {'$set': {'distance_source': 'profiles'},
+                                                                 '$unset': {'cache_key': ''}})
+            n_proc = (job.get('estimate') or dict()).get('n_proc') or settings['n_proc']
+            tree = engine.tree(job['elements'], profiles, dist=dist, stages=stages, n_proc=n_proc, **method)
+    except Exception as e:
+        heartbeat.stop()
+        print(f"Tree job {job['_id']} failed: {e!r}")
+        metrics.record_tree_stages(db, method_name, stages.spans)
+        return fail(db, job['_id'], worker, repr(e), stages.spans)
+    heartbeat.stop()
+    metrics.record_tree_stages(db, method_name, stages.spans)
+    return finish(db, job['_id'], worker, tree, stages.spans)
+
+
+def build_trees(db, worker: str, data: species_data.SpeciesData, engine: MSTrees.TreeEngine, settings: dict):
+    """Claim and run jobs until killed."""
+    print(f"Tree worker {worker} started")
+    host, capacity = socket.gethostname(), host_memory(settings)
+    while True:
+        job = claim(db, worker)
+        if job is None:
+            time.sleep(settings['poll_seconds'])
+            continue
+        memory = reserved_memory(job, settings['memory_margin'])
+        if not reserve(db, host, job, worker, capacity, settings['memory_margin']):
+            if memory > capacity:
+                fail(db, job['_id'], worker, f"Needs {memory / 2 ** 20:.0f} MB, more than the "
+                                             f"{capacity / 2 ** 20:.0f} MB for trees on {host}")
+            elif job.get('deferrals', 0) >= settings['max_deferrals']:
+                fail(db, job['_id'], worker, f"Not enough memory available for {memory / 2 ** 20:.0f} MB "
+                                             f"after {job['deferrals']} tries")
+            else:
+                print(f"Tree worker {worker} deferred job {job['_id']}: not enough memory available")
+                defer(db, job['_id'], worker, settings['defer_seconds'])
+                time.sleep(settings['poll_seconds'])
+            continue
+        start = datetime.now()
+        print(f"Tree worker {worker} building job {job['_id']} with {len(job['elements'])} samples")
+        try:
+            run_job(db, job, worker, data, engine, settings)
+        finally:
+            release(db, host, job['_id'], worker, memory)
+        print(f"Tree worker {worker} finished job {job['_id']} in {datetime.now() - start}")
+
+
+def work(config: dict, worker: str):
+    """Worker process: build 'trees_per_worker' trees at a time, and exit if one of the threads stops."""
+    settings = job_config(config)
+    db = MongoClient(os.getenv('MONGO_CONN')).get_database()
+    species_settings = {**species_data.DEFAULTS, **(config.get('species_data') or dict())}
+    data = species_data.SpeciesData(config['species'], os.getenv('CHEWIE_DATA'),
+                                    memory_budget_mb=species_settings['memory_budget_mb'])
+    engine = MSTrees.TreeEngine(scratch_dir=settings['scratch_dir'], n_proc=settings['n_proc'])
+    if settings['trees_per_worker'] == 1:
+        return build_trees(db, worker, data, engine, settings)
+    threads = [threading.Thread(target=build_trees, args=(db, f"{worker}.{i}", data, engine, settings), daemon=True)
+               for i in range(settings['trees_per_worker'])]
+    for thread in threads:
+        thread.start()
+    while all(thread.is_alive() for thread in threads):
+        time.sleep(settings['poll_seconds'])
+    # The supervisor restarts the worker, and requeues the jobs of the other threads once their heartbeat stops
+    raise SystemExit(1)
+
+
+def supervise(config: dict):
+    """Start the worker processes, restart the ones that die and requeue their jobs."""
+    settings = job_config(config)
+    db = MongoClient(os.getenv('MONGO_CONN')).get_database()
+    create_indexes(db)
+    metrics.create_indexes(db)
+    # Workers are not daemonic, since MSTrees starts its own process pool in them.
+    context = get_context('spawn')
+    host = socket.gethostname()
+    init_host(db, host)
+    workers = [None] * settings['workers']
+    while True:
+        for i, process in enumerate(workers):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    print(f"Tree worker {process.name} exited with code {process.exitcode}, restarting")
+                name = f"{host}-{os.getpid()}-{i}"
+                workers[i] = context.Process(target=work, args=(config, name), name=name)
+                workers[i].start()
+        n_requeued = requeue_stale(db, settings['stale_seconds'], settings['max_attempts'])
+        if n_requeued:
+            print(f"Requeued or failed {n_requeued} tree jobs without heartbeat")
+        n_released = release_stale(db, host)
+        if n_released:
+            print(f"Released the memory of {n_released} tree jobs no longer running on {host}")
+        time.sleep(settings['heartbeat_seconds'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the worker processes that build queued trees.')
+    parser.add_argument('--config', '-c', help='Application config [DEFAULT: ./config.yaml]', default='./config.yaml')
+    parser.add_argument('--workers', '-w', help='Number of worker processes [DEFAULT: tree_jobs.workers in the config, or 2]',
+                        type=int, default=None)
+    parser.add_argument('--trees_per_worker', '-t', type=int, default=None,
+                        help='Trees built at the same time by each worker [DEFAULT: tree_jobs.trees_per_worker in the config, or 1]')
+    args = parser.parse_args()
+    with open(args.config) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    if args.workers is not None:
+        config.setdefault('tree_jobs', dict())['workers'] = args.workers
+    if args.trees_per_worker is not None:
+        config.setdefault('tree_jobs', dict())['trees_per_worker'] = args.trees_per_worker
+    supervise(config)
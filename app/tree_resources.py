@@ -0,0 +1,132 @@
+"""
+Time and memory estimates of trees on this host, and admission of tree jobs.
+
+The estimates come from models fitted on this host by the calibration command,
+which builds trees of synthetic clonal profiles at several sizes, each in a
+new process, and measures their wall time and the growth of the peak resident
+memory of the process and its distance pool:
+
+    python tests/manual/calibrate_trees.py --out tree_calibration.json [--sizes 100,250,500,1000,2000] [--loci 1000,3000]
+
+For each tree method the time and memory are fitted as non-negative sums of
+the terms in TIME_TERMS and MEMORY_TERMS, of the number of profiles n, loci L
+and processes p. Set 'calibration' under 'tree_jobs' in the config to the
+written file. Without one, the coefficients of MSTrees.estimate_Consumption,
+fitted on other machines, are used.
+
+A tree request is admitted if its estimated memory, times 'memory_margin',
+fits in 'tree_memory_mb' (by default the host's memory divided by the
+'workers' * 'trees_per_worker' trees built at a time). Otherwise it is
+estimated again with fewer processes than 'n_proc', as every process of the
+distance pool holds its own copy of the allele presences, then downscaled to
+a method with a smaller matrix (MSTreeV2, with an asymmetric matrix, to
+MSTree), or rejected. The job records the number of processes it is built
+with. A worker defers a claimed job while the memory reserved by the trees on
+its host leaves no room for its estimate (see tree_jobs).
+"""
+from __future__ import annotations
+
+import json
+import platform
+
+import numpy as np
+
+import MSTrees
+import tree_jobs
+
+TIME_TERMS = {
+    'const': lambda n, L, p: 1.,
+    'n2': lambda n, L, p: n * n,
+    'n2L_per_proc': lambda n, L, p: n * n * L / p,
+    'n3': lambda n, L, p: n ** 3,
+}
+MEMORY_TERMS = {
+    'const': lambda n, L, p: 1.,
+    'nL': lambda n, L, p: n * L,
+    'nL_procs': lambda n, L, p: n * L * p,
+    'n2': lambda n, L, p: n * n,
+}
+
+# Methods to fall back to, in order, when a tree does not fit in memory
+DOWNSCALE = {
+    'MSTreeV2': ['MSTree'],
+}
+
+
+def _design(terms: dict, samples: list[dict]) -> np.ndarray:
+    return np.array([[term(s['n_profile'], s['n_loci'], s['n_proc']) for term in terms.values()] for s in samples],
+                    dtype=float)
+
+
+def fit(terms: dict, samples: list[dict], key: str) -> dict:
+    """Least squares coefficients of 'terms' for samples[key], refitted without the terms that come out negative."""
+    X, y = _design(terms, samples), np.array([s[key] for s in samples], dtype=float)
+    # Scale the columns, as the terms differ by many orders of magnitude
+    scale = np.abs(X).max(axis=0)
+    scale[scale == 0] = 1.
+    active = np.arange(X.shape[1])
+    while True:
+        coef = np.zeros(X.shape[1])
+        coef[active] = np.linalg.lstsq(X[:, active] / scale[active], y, rcond=None)[0] / scale[active]
+        if (coef >= 0).all():
+            return dict(zip(terms, coef.tolist()))
+        active = active[coef[active] > 0]
+
+
+class Estimator(object):
+    """Time and memory of trees from a calibration, or from MSTrees.estimate_Consumption without one."""
+
+    def __init__(self, calibration: dict = None):
+        self.models = (calibration or dict()).get('models', dict())
+
+    @classmethod
+    def load(cls, path=None) -> Estimator:
+        if path is None:
+            return cls()
+        try:
+            with open(path) as file:
+                return cls(json.load(file))
+        except FileNotFoundError:
+            print(f"No tree calibration found at {path}, using the default estimates. "
+                  f"Run 'python tests/manual/calibrate_trees.py --out {path}' to calibrate on this host.")
+            return cls()
+
+    def estimate(self, method: str, n_profile: int, n_loci: int, n_proc: int) -> tuple[float, float]:
+        """Seconds and bytes of a tree."""
+        if method in self.models:
+            model = self.models[method]
+            return tuple(sum(coef * terms[term](n_profile, n_loci, n_proc) for term, coef in model[key].items())
+                         for terms, key in ((TIME_TERMS, 'seconds'), (MEMORY_TERMS, 'memory')))
+        params = tree_jobs.METHODS[method]
+        return MSTrees.estimate_Consumption(platform.system(), 'MSTree' if method == 'MSTreeV2' else params['method'],
+                                            params['matrix_type'], n_proc, n_loci, n_profile)
+
+
+def memory_budget(settings: dict) -> float:
+    """Bytes one tree may use: 'tree_memory_mb', or the host's memory shared by all trees built at a time."""
+    return tree_jobs.host_memory(settings) / (settings['workers'] * settings['trees_per_worker'])
+
+
+def fewer_procs(n_proc: int) -> list[int]:
+    """'n_proc' and the numbers of processes to retry with, halving down to 1."""
+    n_procs = [max(int(n_proc), 1)]
+    while n_procs[-1] > 1:
+        n_procs.append(n_procs[-1] // 2)
+    return n_procs
+
+
+def admit(estimator: Estimator, method: str, n_profile: int, n_loci: int,
+          settings: dict) -> tuple[str, int, float, float]:
+    """
+    The method and number of processes to build a tree with, reduced if needed, and its estimated seconds and bytes.
+    Fewer processes are tried before a smaller method. Raises ValueError if nothing fits in the memory budget.
+    """
+    budget = memory_budget(settings)
+    for candidate in [method, *DOWNSCALE.get(method, list())]:
+        for n_proc in fewer_procs(settings['n_proc']):
+            seconds, memory = estimator.estimate(candidate, n_profile, n_loci, n_proc)
+            if memory * settings['memory_margin'] <= budget:
+                return candidate, n_proc, seconds, memory
+    raise ValueError(f"A {candidate} tree of {n_profile} profiles needs about {memory / 2 ** 20:.0f} MB, "
+                     f"more than the {budget / 2 ** 20:.0f} MB a tree may use")
+
@@ -0,0 +1,125 @@
+"""
+Throughput of the compiled MSTrees distance kernels against the previous NumPy code.
+
+Run from the repository root:
+    python tests/manual/bench_distance.py [--sizes 500x1000,2000x3000]
+
+Prints pairwise comparisons per second for each matrix type and (n, L) size,
+and checks that both implementations give identical matrices.
+Both run in one process and thread; MSTrees.distance_matrix.get_columns runs
+the kernels in parallel over column ranges in a process pool.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+import MSTrees  # noqa: E402
+
+
+# The NumPy implementations the kernels replaced, kept here as reference.
+def numpy_symmetric(profiles, handle_missing='pair_delete'):
+    presences = (profiles > 0)
+    distances = np.zeros(shape=[profiles.shape[0], profiles.shape[0]])
+    for id in range(profiles.shape[0]):
+        profile, presence = profiles[id], presences[id]
+        comparable = (presences[:id] * presence)
+        if handle_missing == 'pair_delete':
+            diffs = np.sum((profiles[:id] != profile) & comparable, axis=1) * float(presence.size) / np.sum(comparable, axis=1)
+        else:
+            diffs = np.sum((profiles[:id] != profile) & comparable, axis=1)
+        distances[:id, id] = diffs
+        distances[id, :id] = diffs
+    return distances
+
+
+def numpy_asymmetric(profiles, handle_missing='pair_delete'):
+    presences = (profiles > 0)
+    distances = np.zeros(shape=[profiles.shape[0], profiles.shape[0]])
+    for id in range(profiles.shape[0]):
+        profile, presence = profiles[id], presences[id]
+        diffs = np.sum(((profiles != profile) & presence), axis=1)
+        if handle_missing != 'absolute_distance':
+            diffs = diffs * float(presence.size) / np.sum(presence)
+        distances[:, id] = diffs
+    return distances
+
+
+def numpy_asymmetric_wgMLST(profiles, handle_missing='pair_delete'):
+    presences = (profiles > 0)
+    pp = np.sum(presences, 0).astype(float)
+    pp = pp * (pp - 1) / (presences.shape[0] * (presences.shape[0] - 1))
+    distances = np.zeros(shape=[profiles.shape[0], profiles.shape[0]])
+    for id in range(profiles.shape[0]):
+        profile, presence = profiles[id], presences[id]
+        diffs = np.sum(((profiles != profile) & (presences * presence)) + (presences < presence) * pp, axis=1) * float(presence.size) / np.sum(presence)
+        distances[:, id] = diffs
+    return distances
+
+
+def numpy_blockwise(profiles, handle_missing=0.01):
+    distances = np.zeros(shape=[profiles.shape[0], profiles.shape[0]])
+    for id in range(profiles.shape[0]):
+        profile = profiles[id]
+        diffs = np.hstack([np.zeros([profiles.shape[0], 1], dtype=int), profiles - profile, np.zeros([profiles.shape[0], 1], dtype=int)])
+        d1 = np.sum((diffs[:, 1:] != diffs[:, :-1]) & (diffs[:, 1:] != 0), 1)
+        d2 = np.sum(diffs != 0, 1) - d1
+        distances[:, id] = d1 + d2 * handle_missing
+    return distances
+
+
+CASES = [
+    ('symmetric', 'pair_delete', numpy_symmetric),
+    ('symmetric_packed', 'pair_delete', numpy_symmetric),
+    ('asymmetric', 'pair_delete', numpy_asymmetric),
+    ('asymmetric_wgMLST', 'pair_delete', numpy_asymmetric_wgMLST),
+    ('blockwise', 0.01, numpy_blockwise),
+]
+
+
+def synthetic_profiles(n_profile, n_loci, missing=0.02, seed=0):
+    """Clonal profiles: a few founders with point mutations and missing loci."""
+    rng = np.random.default_rng(seed)
+    founders = rng.integers(1, 20, size=(max(2, n_profile // 20), n_loci))
+    profiles = founders[rng.integers(0, founders.shape[0], n_profile)]
+    mutations = rng.random(profiles.shape) < 0.01
+    profiles[mutations] = rng.integers(20, 200, mutations.sum())
+    profiles[rng.random(profiles.shape) < missing] = 0
+    return profiles.astype(np.int64)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='500x1000,2000x3000', help='Comma separated n_profile x n_loci sizes')
+    args = parser.parse_args()
+
+    print(f"{'matrix':<18} {'n':>6} {'L':>6} {'numpy pairs/s':>14} {'kernel pairs/s':>15} {'speedup':>8}  identical")
+    for size in args.sizes.split(','):
+        n_profile, n_loci = (int(v) for v in size.split('x'))
+        profiles = synthetic_profiles(n_profile, n_loci)
+        for func, handle_missing, reference in CASES:
+            # the packed kernel gets the profiles in the narrow type get_columns gives it
+            kernel_profiles = MSTrees.narrow_profiles(profiles) if func == 'symmetric_packed' else profiles
+            getattr(MSTrees.distance_matrix, func)(kernel_profiles[:10], handle_missing)  # compile outside the timing
+            kernel_res, kernel_time = timed(getattr(MSTrees.distance_matrix, func), kernel_profiles, handle_missing)
+            if func.startswith('symmetric'):
+                kernel_res[kernel_res.T > kernel_res] = kernel_res.T[kernel_res.T > kernel_res]
+            with np.errstate(all='ignore'):
+                numpy_res, numpy_time = timed(reference, profiles, handle_missing)
+            # the symmetric matrix is computed as a triangle
+            pairs = n_profile * (n_profile - 1) / 2 if func.startswith('symmetric') else n_profile * n_profile
+            print(f"{func:<18} {n_profile:>6} {n_loci:>6} {pairs / numpy_time:>14.0f} {pairs / kernel_time:>15.0f} "
+                  f"{numpy_time / kernel_time:>7.1f}x  {np.array_equal(kernel_res, numpy_res, equal_nan=True)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Regression and timing of the in-process minimum arborescence in MSTrees against
+GrapeTree's edmonds binary, which methods._asymmetric used to shell out to.
+
+Run from the repository root:
+    python tests/manual/bench_edmonds.py [--sizes 200,1000,3000] [--n_loci 2000] [--repeats 3]
+
+For each size the weighted MSTreeV2 distances of synthetic profiles are solved
+both ways. The total weights must be equal. The trees themselves can only
+differ where several arborescences have the same minimum weight; the number
+of such edges is reported.
+"""
+import argparse
+import os
+import platform
+import sys
+import tempfile
+import time
+from subprocess import Popen, PIPE
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import MSTrees  # noqa: E402
+from bench_distance import synthetic_profiles  # noqa: E402
+
+
+def weighted_distances(profiles):
+    """wdist as methods._asymmetric builds it, before the shortcuts are taken out."""
+    dist = MSTrees.distance_matrix.get_distance('asymmetric', profiles, 'pair_delete')
+    weight = MSTrees.distance_matrix.harmonic(dist, [1] * profiles.shape[0])
+    wdist = np.round(dist, 0) + weight.reshape([weight.size, -1])
+    np.fill_diagonal(wdist, 0.0)
+    return wdist
+
+
+def binary_arborescence(wdist):
+    """The previous implementation: write wdist as text and run the edmonds binary."""
+    with tempfile.NamedTemporaryFile('w', suffix='.wdist.list', delete=False) as fout:
+        for d in wdist:
+            fout.write('{0}\n'.format('\t'.join([str(dd) for dd in (d + 1.)])))
+    try:
+        mstree = Popen([MSTrees.params['edmonds_' + platform.system()], fout.name], stdout=PIPE).communicate()[0]
+    finally:
+        os.unlink(fout.name)
+    mstree = np.array([br.strip().split() for br in mstree.decode('utf8').strip().split('\n')], dtype=float).astype(int)
+    return mstree[:, :2]
+
+
+def own_arborescence(wdist):
+    """MSTrees._minimum_arborescence, which takes the weights with a row and column for its root and overwrites them."""
+    weights = np.empty((wdist.shape[0] + 1, wdist.shape[0] + 1))
+    weights[:-1, :-1] = wdist
+    return MSTrees._minimum_arborescence(weights)
+
+
+def best_time(func, wdist, repeats):
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        res = func(wdist)
+        times.append(time.perf_counter() - start)
+    return res, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='200,1000,3000', help='Comma separated numbers of profiles')
+    parser.add_argument('--n_loci', type=int, default=2000, help='Loci per profile [DEFAULT: 2000]')
+    parser.add_argument('--repeats', type=int, default=3, help='Timing repeats, the best is reported [DEFAULT: 3]')
+    args = parser.parse_args()
+
+    own_arborescence(np.ones((3, 3)))  # compile outside the timing
+    print(f"{'n':>6} {'binary s':>9} {'in-process s':>13} {'speedup':>8} {'same weight':>12} {'tied edges':>11}")
+    for seed, n_profile in enumerate(int(n) for n in args.sizes.split(',')):
+        wdist = weighted_distances(synthetic_profiles(n_profile, args.n_loci, seed=seed))
+        expected, binary_time = best_time(binary_arborescence, wdist, args.repeats)
+        found, own_time = best_time(own_arborescence, wdist, args.repeats)
+        same_weight = np.isclose(wdist[tuple(expected.T)].sum(), wdist[tuple(found.T)].sum(), rtol=0, atol=1e-6)
+        tied = len(set(map(tuple, expected.tolist())) - set(map(tuple, found.tolist())))
+        print(f"{n_profile:>6} {binary_time:>9.3f} {own_time:>13.3f} {binary_time / own_time:>7.1f}x {str(same_weight):>12} {tied:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Time of the profile_diffs result for many samples: the previous per-value loop
+over the decoded DataFrame, the vectorized variable loci on allele codes, and
+the columnar format of /comparative/cgmlst/profile_diffs/columnar.
+
+Run from the repository root:
+    python tests/manual/bench_profile_diffs.py [--sizes 500x3000,2000x3000] [--missing 0.0002]
+
+Each result is serialized to JSON as the endpoint would send it. The previous
+loop never updated previous_value and so returned almost every locus; the
+vectorized result is checked against that loop with the comparison fixed.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import profile_store  # noqa: E402
+from bench_distance import synthetic_profiles  # noqa: E402
+
+
+def synthetic_store(n_profile, n_loci, missing):
+    codes = synthetic_profiles(n_profile, n_loci, missing).astype(np.uint32)
+    loci = [f"locus{j}" for j in range(n_loci)]
+    n_alleles = codes.max(axis=0) + 1
+    offsets = np.concatenate([[0], np.cumsum(n_alleles)]).astype(np.int64)
+    alleles = np.array([b'-' if code == 0 else str(code * 7 + j).encode()
+                        for j in range(n_loci) for code in range(n_alleles[j])])
+    names = [f"sample{i}" for i in range(n_profile)]
+    return profile_store.ProfileStore(names, loci, codes, alleles, offsets, dict(version='bench'))
+
+
+def previous(store, names, fixed=False):
+    """The previous endpoint body; with 'fixed', previous_value is updated as intended."""
+    filtered_df = store.to_frame(names)
+    columns_to_show = list()
+    for label, content in filtered_df.items():
+        previous_value = None
+        for value in content:
+            if value == "#FILE":
+                continue
+            if value == "-":
+                columns_to_show.append(label)
+                break
+            if value == previous_value or (fixed and previous_value is None):
+                previous_value = value if fixed else previous_value
+                continue
+            columns_to_show.append(label)
+            break
+    return json.dumps(filtered_df[columns_to_show].to_dict())
+
+
+def vectorized(store, names):
+    codes = store.profiles(names)
+    loci = profile_store.variable_loci(codes)
+    alleles = store.decode(codes[:, loci], loci)
+    return json.dumps({locus: dict(zip(names, column)) for locus, column in zip(store.loci[loci].tolist(), alleles.T.tolist())})
+
+
+def columnar(store, names, rows_per_chunk=100):
+    codes = store.profiles(names)
+    loci = profile_store.variable_loci(codes)
+    alleles, local_codes = store.compact(codes[:, loci], loci)
+    chunks = [f'{{"sequences": {json.dumps(names)}, "loci": {json.dumps(store.loci[loci].tolist())}, '
+              f'"alleles": {json.dumps(alleles)}, "codes": [']
+    for start in range(0, local_codes.shape[0], rows_per_chunk):
+        chunks.append((', ' if start else '') + ', '.join(json.dumps(row) for row in local_codes[start:start + rows_per_chunk].tolist()))
+    chunks.append(']}')
+    return ''.join(chunks)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='500x3000,2000x3000', help='Comma separated n_samples x n_loci sizes')
+    parser.add_argument('--missing', type=float, default=0.0002, help='Fraction of missing alleles [DEFAULT: 0.0002]')
+    args = parser.parse_args()
+
+    print(f"{'n':>6} {'L':>6} {'previous s':>11} {'vectorized s':>13} {'columnar s':>11} "
+          f"{'previous MB':>12} {'vectorized MB':>14} {'columnar MB':>12} {'loci':>12}  same as fixed loop")
+    for size in args.sizes.split(','):
+        n_profile, n_loci = (int(v) for v in size.split('x'))
+        store = synthetic_store(n_profile, n_loci, args.missing)
+        names = store.names.tolist()
+        old, old_time = timed(previous, store, names)
+        new, new_time = timed(vectorized, store, names)
+        compact, compact_time = timed(columnar, store, names)
+        decoded = json.loads(compact)
+        same = json.loads(new) == json.loads(previous(store, names, fixed=True)) and decoded['loci'] == list(json.loads(new))
+        print(f"{n_profile:>6} {n_loci:>6} {old_time:>11.2f} {new_time:>13.2f} {compact_time:>11.2f} "
+              f"{len(old) / 1e6:>12.1f} {len(new) / 1e6:>14.1f} {len(compact) / 1e6:>12.1f} "
+              f"{len(json.loads(old)):>5} -> {len(decoded['loci']):>4}  {same}")
+
+
+if __name__ == '__main__':
+    main()
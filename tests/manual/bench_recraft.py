@@ -0,0 +1,165 @@
+"""
+Per-stage timing of MSTreeV2, comparing methods._branch_recraft with the
+previous implementation, which re-sorted the remaining branches and tested
+candidates one at a time.
+
+Run from the repository root:
+    python tests/manual/bench_recraft.py [--sizes 1000,4000] [--n_loci 1000]
+
+The trees built with both implementations must be byte-identical.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from numba import jit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+import MSTrees  # noqa: E402
+
+
+@jit(nopython=True)
+def old_contemporary(a,b,c, n_loci) :
+    a[0], a[1] = max(min(a[0], n_loci-0.5), 0.5), max(min(a[1], n_loci-0.5), 0.5);
+    b, c = max(min(b, n_loci-0.5), 0.5), max(min(c, n_loci-0.5), 0.5)
+    if b >= a[0] + c and b >= a[1] + c :
+        return False
+    elif b == c :
+        return True
+    s11, s12 = np.sqrt(1-a[0]/n_loci), (2*n_loci - b - c)/2/np.sqrt(n_loci*(n_loci-a[0]))
+    v = 1-((n_loci-a[1])*(n_loci-c)/n_loci+(n_loci-b))/2/n_loci
+    s21, s22 = 1+a[1]*v/(b-2*n_loci*v), 1+c*v/(b-2*n_loci*v)
+
+    p1 = a[0]*np.log(1-s11*s11) + (n_loci-a[0])*np.log(s11*s11) + (b+c)*np.log(1-s11*s12) + (2*n_loci-b-c)*np.log(s11*s12)
+    p2 = a[1]*np.log(1-s21) + (n_loci-a[1])*np.log(s21) + b*np.log(1-s21*s22) + (n_loci-b)*np.log(s21*s22) + c*np.log(1-s22) + (n_loci-c)*np.log(s22)
+    return p1 >= p2
+
+
+def old_branch_recraft(branches, dist, weights, n_loci) :
+
+    if n_loci is None :
+        n_loci = np.max(dist)
+
+    group_id, groups, childrens = {b:b for br in branches for b in br[:2]}, \
+        {b:[b] for br in branches for b in br[:2]}, \
+        {b:[] for br in branches for b in br[:2]}
+    branches = sorted(branches, key=lambda br:[dist[br[0], br[1]]] + sorted([weights[br[0]], weights[br[1]]]))
+    i = 0
+    while i < len(branches) :
+        src, tgt, brlen = branches[i]
+
+        sources, targets = groups[group_id[src]], groups[group_id[tgt]]
+        tried = {}
+        if len(sources) > 1 :
+            for w, d, s in sorted(zip(weights[sources], dist[sources, tgt], sources))[:3] :
+                if s == src : break
+                if d < 1.5*dist[src, tgt] :
+                    if old_contemporary([dist[s, src], dist[src, s]], d, dist[src, tgt], n_loci) :
+                        tried[src], src = s, s
+                        break
+            while src not in tried :
+                tried[src] = src
+                mid_nodes = sorted([[weights[s], dist[s,tgt], s] for s in childrens[src] if s not in tried and dist[s,tgt] < 2*dist[src, tgt]])
+                for w, d, s in mid_nodes :
+                    if d < dist[src, tgt] :
+                        if not old_contemporary([dist[src, s], dist[s, src]], dist[src, tgt], d, n_loci) :
+                            tried[src], src = s, s
+                            break
+                    elif w < weights[src] :
+                        if old_contemporary([dist[s, src], dist[src, s]], d, dist[src, tgt], n_loci) :
+                            tried[src], src = s, s
+                            break
+                    tried[s] = src
+        if len(targets) > 1 :
+            for w, d, t in sorted(zip(weights[targets], dist[src, targets], targets))[:3] :
+                if t == tgt : break
+                if d < 1.5*dist[src, tgt] :
+                    if old_contemporary([dist[t, tgt], dist[tgt, t]], d, dist[src, tgt], n_loci) :
+                        tried[tgt], tgt = t, t
+                        break
+            while tgt not in tried :
+                tried[tgt] = tgt
+                mid_nodes = sorted([[weights[t], dist[src,t], t] for t in childrens[tgt] if t not in tried and dist[src, t] < 2*dist[src, tgt]])
+                for w, d, s in mid_nodes :
+                    if d < dist[src, tgt] :
+                        if not old_contemporary([dist[tgt, t], dist[t, tgt]], dist[src, tgt], d, n_loci) :
+                            tried[tgt], tgt = t, t
+                            break
+                    elif w < weights[tgt] :
+                        if old_contemporary([dist[t, tgt], dist[tgt, t]], d, dist[src, tgt], n_loci) :
+                            tried[tgt], tgt = t, t
+                            break
+                    tried[t] = tgt
+        brlen = dist[src, tgt]
+        branches[i] = [src, tgt, brlen]
+        if i >= len(branches) - 1 or branches[i+1][2] >= brlen:
+            tid = group_id[tgt]
+            for t in targets :
+                group_id[t] = group_id[src]
+            groups[group_id[src]].extend(groups.pop(tid, []))
+            childrens[src].append(tgt)
+            childrens[tgt].append(src)
+            i += 1
+        else :
+            branches[i:] = sorted(branches[i:], key=lambda br:br[2])
+    return branches
+
+
+def evolved_profiles(n_profile, n_loci, mutations=3, missing=0.01, seed=0):
+    """Each profile descends from a random earlier one with a few new alleles, as in a clonal population."""
+    rng = np.random.default_rng(seed)
+    profiles = np.empty((n_profile, n_loci), dtype=np.int64)
+    profiles[0] = 1
+    next_allele = 2
+    for i in range(1, n_profile):
+        profiles[i] = profiles[rng.integers(0, i)]
+        loci = rng.integers(0, n_loci, rng.poisson(mutations) + 1)
+        profiles[i, loci] = np.arange(next_allele, next_allele + loci.size)
+        next_allele += loci.size
+    profiles[rng.random(profiles.shape) < missing] = 0
+    return profiles
+
+
+def run_stages(profiles, recraft):
+    """MSTrees.methods.MSTree for MSTreeV2, split into timed stages."""
+    names = np.array([f"s{i}" for i in range(profiles.shape[0])])
+    timings = dict()
+
+    def stage(name, func, *args):
+        start = time.perf_counter()
+        res = func(*args)
+        timings[name] = time.perf_counter() - start
+        return res
+
+    dist = stage('distance', MSTrees.distance_matrix.get_distance, 'asymmetric', profiles, 'pair_delete')
+    weight = stage('harmonic', MSTrees.distance_matrix.harmonic, dist, [1] * profiles.shape[0])
+    tree = stage('arborescence', MSTrees.methods._asymmetric, dist, weight)
+    tree = stage('branch_recraft', recraft, tree, dist, weight, profiles.shape[1])
+    tree = stage('symmetric_link', MSTrees.distance_matrix.symmetric_link, profiles, tree, 'pair_delete')
+    tree = stage('network2tree', MSTrees.methods._network2tree, tree, names)
+    return tree.write(format=1), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='1000,4000', help='Comma separated numbers of profiles')
+    parser.add_argument('--n_loci', type=int, default=1000, help='Loci per profile [DEFAULT: 1000]')
+    args = parser.parse_args()
+
+    warm_up = evolved_profiles(50, 50)
+    run_stages(warm_up, old_branch_recraft)
+    run_stages(warm_up, MSTrees.methods._branch_recraft)
+    for seed, n_profile in enumerate(int(n) for n in args.sizes.split(',')):
+        profiles = MSTrees.nonredundant(np.arange(n_profile).astype(str), evolved_profiles(n_profile, args.n_loci, seed=seed))[1]
+        old_tree, old_timings = run_stages(profiles, old_branch_recraft)
+        new_tree, new_timings = run_stages(profiles, MSTrees.methods._branch_recraft)
+        print(f"{profiles.shape[0]} profiles, identical trees: {old_tree == new_tree}")
+        print(f"    {'stage':<16} {'before s':>9} {'after s':>9} {'speedup':>8}")
+        for name in old_timings:
+            print(f"    {name:<16} {old_timings[name]:>9.3f} {new_timings[name]:>9.3f} {old_timings[name] / new_timings[name]:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
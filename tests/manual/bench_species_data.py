@@ -0,0 +1,98 @@
+"""
+Load species data on first use under a memory budget.
+
+Run from the repository root:
+    python tests/manual/bench_species_data.py [--species 8] [--samples 5000] [--loci 3000] [--budget_species 3] [--tsv]
+
+Writes binary allele profile and distance matrix stores of synthetic species
+to a temporary directory, then:
+
+1. times loading every species up front, as the API did at startup, against
+   creating the SpeciesData,
+2. requests one species from many threads at once and checks that each store
+   was loaded only once,
+3. requests the species in turn with a budget of 'budget_species' species and
+   checks that the loaded stores stay within the budget,
+
+and prints the residency reported by GET /comparative/cgmlst/data.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import distance_store  # noqa: E402
+import profile_store  # noqa: E402
+import species_data  # noqa: E402
+from bench_distance import synthetic_profiles  # noqa: E402
+
+
+def write_species(cgmlst_dir, n_samples, n_loci, seed, binary):
+    os.makedirs(cgmlst_dir)
+    names = [f"s{seed}_{i}" for i in range(n_samples)]
+    profiles = pd.DataFrame(synthetic_profiles(n_samples, n_loci, seed=seed).astype(str),
+                            index=pd.Index(names, name='FILE'), columns=[f"locus{j}" for j in range(n_loci)])
+    tsv_path = os.path.join(cgmlst_dir, profile_store.TSV_NAME)
+    profiles.to_csv(tsv_path, sep='\t')
+    distances = np.random.default_rng(seed).integers(0, n_loci, size=(n_samples, n_samples), dtype=np.uint16)
+    if binary:
+        profile_store.convert(tsv_path)
+        np.save(os.path.join(cgmlst_dir, distance_store.MATRIX_NAME), distances)
+        distance_store.write_names(os.path.join(cgmlst_dir, distance_store.NAMES_NAME), names)
+    else:
+        pd.DataFrame(distances, index=names).to_csv(os.path.join(cgmlst_dir, distance_store.TSV_NAME), sep=' ', header=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--species', type=int, default=8, help='Number of species [DEFAULT: 8]')
+    parser.add_argument('--samples', type=int, default=5000, help='Samples per species [DEFAULT: 5000]')
+    parser.add_argument('--loci', type=int, default=3000, help='Loci per profile [DEFAULT: 3000]')
+    parser.add_argument('--budget_species', type=int, default=3, help='Species that fit in the budget [DEFAULT: 3]')
+    parser.add_argument('--tsv', action='store_true', help='Only write the TSV files, which are parsed on load')
+    parser.add_argument('--threads', type=int, default=16, help='Concurrent requests for one species [DEFAULT: 16]')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as chewie_data:
+        species = {f"Species_{i}": dict(cgmlst=f"Species_{i}/output/cgmlst") for i in range(args.species)}
+        for i, v in enumerate(species.values()):
+            write_species(os.path.join(chewie_data, v['cgmlst']), args.samples, args.loci, seed=i, binary=not args.tsv)
+        kinds = ('allele_profiles', 'distance_matrix')
+
+        start = time.perf_counter()
+        eager = [profile_store.load(os.path.join(chewie_data, v['cgmlst'])) for v in species.values()]
+        eager += [distance_store.load(os.path.join(chewie_data, v['cgmlst'])) for v in species.values()]
+        eager_seconds = time.perf_counter() - start
+        species_nbytes = sum(store.nbytes for store in eager) / args.species
+        del eager
+        start = time.perf_counter()
+        data = species_data.SpeciesData(species, chewie_data, memory_budget_mb=args.budget_species * species_nbytes / 2 ** 20)
+        print(f"startup: loading all {args.species} species {eager_seconds:.2f} s, "
+              f"lazy {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        with ThreadPoolExecutor(args.threads) as executor:
+            stores = list(executor.map(lambda i: data.get('Species 0', kinds[i % 2]), range(args.threads)))
+        same = all(store is stores[i % 2] for i, store in enumerate(stores))
+        print(f"{args.threads} concurrent requests: {data.metrics['Species_0']['loads']} loads, same stores: {same}")
+
+        largest = 0
+        for name in list(species) * 2:
+            for kind in kinds:
+                data.get(name, kind)
+            largest = max(largest, sum(residency['nbytes'] for residency in data.residency()))
+        print(f"largest total {largest / 2 ** 20:.0f} MB, budget {data.memory_budget / 2 ** 20:.0f} MB, "
+              f"within budget: {largest <= data.memory_budget}")
+        for residency in data.residency():
+            print(f"{residency['species']}: {residency['nbytes'] / 2 ** 20:.0f} MB of {sorted(residency['loaded'])}, "
+                  f"{residency['loads']} loads, {residency['evictions']} evictions")
+
+
+if __name__ == '__main__':
+    main()
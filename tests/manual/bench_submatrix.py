@@ -0,0 +1,77 @@
+"""
+Time of the distances for a tree of k samples: taken as a block of the
+memory-mapped distance matrix store, or computed from the allele profiles as
+MSTrees did for every tree.
+
+Run from the repository root:
+    python tests/manual/bench_submatrix.py [--n_profile 20000] [--n_loci 3000] [--sizes 200,1000,3000]
+
+A store of n_profile synthetic samples is written to a temporary directory.
+For each k, random samples are taken and both ways are timed. The block must
+equal the rounded computed distances, and the MSTree (symmetric) trees built
+from the block and from exact distances are compared by total branch length.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from ete3 import Tree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import MSTrees  # noqa: E402
+import distance_store  # noqa: E402
+from bench_distance import synthetic_profiles  # noqa: E402
+
+
+def total_length(newick):
+    return sum(node.dist for node in Tree(newick, format=1).traverse())
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--n_profile', type=int, default=20000, help='Samples in the store [DEFAULT: 20000]')
+    parser.add_argument('--n_loci', type=int, default=3000, help='Loci per profile [DEFAULT: 3000]')
+    parser.add_argument('--sizes', default='200,1000,3000', help='Comma separated numbers of samples per tree')
+    parser.add_argument('--n_proc', type=int, default=4, help='Processes for the profile distances [DEFAULT: 4]')
+    args = parser.parse_args()
+
+    profiles = synthetic_profiles(args.n_profile, args.n_loci)
+    names = [f"s{i}" for i in range(args.n_profile)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        distances = np.rint(distance_store.new_distances(profiles, 0, n_proc=args.n_proc)).astype(np.uint16)
+        np.save(os.path.join(tmp_dir, distance_store.MATRIX_NAME), distances)
+        distance_store.write_names(os.path.join(tmp_dir, distance_store.NAMES_NAME), names)
+        del distances
+        print(f"Store of {args.n_profile} x {args.n_profile} written in {time.perf_counter() - start:.1f}s")
+        matrix = distance_store.load(tmp_dir)
+
+        MSTrees.distance_matrix.get_distance('symmetric', profiles[:10], 'pair_delete')  # compile outside the timing
+        rng = np.random.default_rng(0)
+        tree_args = dict(method='MSTree', matrix_type='symmetric', heuristic='eBurst', branch_recraft=False,
+                         n_proc=args.n_proc)
+        print(f"{'k':>6} {'profiles s':>11} {'block s':>8} {'speedup':>8} {'block equal':>12} {'tree length':>22}")
+        for k in (int(k) for k in args.sizes.split(',')):
+            positions = np.sort(rng.choice(args.n_profile, k, replace=False))
+            sample_names = [names[p] for p in positions]
+            computed, profile_time = timed(MSTrees.distance_matrix.get_distance, 'symmetric', profiles[positions], 'pair_delete')
+            block, block_time = timed(matrix.sub_matrix, sample_names)
+            exact_tree = MSTrees.backend_matrix(sample_names, profiles[positions], dist=computed, **tree_args)
+            block_tree = MSTrees.backend_matrix(sample_names, profiles[positions], dist=block, **tree_args)
+            print(f"{k:>6} {profile_time:>11.3f} {block_time:>8.3f} {profile_time / block_time:>7.1f}x "
+                  f"{str(np.array_equal(block, np.rint(computed))):>12} "
+                  f"{total_length(exact_tree):>10.0f} {total_length(block_tree):>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Benchmark of loading, queries and trees on synthetic cgMLST data, written as JSON
+so that results of different commits can be compared.
+
+Run from the repository root:
+    python tests/manual/bench_suite.py [--sizes 2000x3000] [--tree_sizes 100,500,1000]
+                                       [--methods MSTreeV2,MSTree,NJ,distance] [--out bench.json]
+    python tests/manual/bench_suite.py ... --compare bench_before.json [--tolerance 0.2]
+
+For each size (samples x loci) a species is generated with synthetic.py, with
+the options for missing alleles and clonal structure, and the suite times:
+
+  load     the first request for each store through species_data, as the API
+           loads a species, from the TSV files and from the binary stores, and
+           the conversion into the binary stores
+  queries  find_nearest_neighbors for single samples with cutoffs inside and
+           outside the neighbor index, and profile differences of random
+           samples (ProfileStore.differences, serialized to JSON)
+  trees    every tree method on random samples, stage by stage (MSTrees.Stages),
+           each in a new process so that its peak resident memory is its own
+
+Latencies are reported as mean, p50, p95 and max seconds over the repeats.
+With --compare, every number that is in both files is compared and the ones
+that changed by more than the tolerance are printed.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+from multiprocessing import get_context
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numba
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import MSTrees  # noqa: E402
+import neighbor_index  # noqa: E402
+import profile_store  # noqa: E402
+import species_data  # noqa: E402
+import synthetic  # noqa: E402
+
+METHODS = {
+    'MSTreeV2': dict(method='MSTreeV2'),
+    'MSTree': dict(method='MSTree', matrix_type='symmetric', heuristic='eBurst', branch_recraft=False),
+    'NJ': dict(method='NJ'),
+    'RapidNJ': dict(method='RapidNJ'),
+    'distance': dict(method='distance'),
+}
+SPECIES = 'Synthetic'
+
+
+def latency(func, repeats):
+    times = list()
+    for i in range(repeats):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return dict(mean=float(times.mean()), p50=float(np.percentile(times, 50)), p95=float(np.percentile(times, 95)),
+                max=float(times.max()))
+
+
+def commit():
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    try:
+        return dict(commit=git('rev-parse', 'HEAD'), dirty=bool(git('status', '--porcelain', '--untracked-files=no')))
+    except OSError:
+        return dict(commit=None, dirty=None)
+
+
+def timed_first_requests(chewie_data, kinds):
+    data = species_data.SpeciesData({SPECIES: dict(cgmlst=SPECIES)}, chewie_data)
+    timings = dict()
+    for kind in kinds:
+        start = time.perf_counter()
+        data.get(SPECIES, kind)
+        timings[kind] = time.perf_counter() - start
+    return timings, data
+
+
+def bench_load(chewie_data, args):
+    cgmlst_dir = os.path.join(chewie_data, SPECIES)
+    res = dict(generate=synthetic.write(cgmlst_dir, args.n_samples, args.n_loci, args.missing, args.clusters,
+                                        args.mutations, args.divergence, args.seed, binary=False, n_proc=args.n_proc))
+    res['tsv'] = timed_first_requests(chewie_data, ('allele_profiles', 'distance_matrix'))[0]
+    start = time.perf_counter()
+    profile_store.convert(os.path.join(cgmlst_dir, profile_store.TSV_NAME))
+    res['convert_profiles'] = time.perf_counter() - start
+    start = time.perf_counter()
+    synthetic.distance_store.convert(os.path.join(cgmlst_dir, synthetic.distance_store.TSV_NAME))
+    res['convert_distances'] = time.perf_counter() - start
+    start = time.perf_counter()
+    neighbor_index.write(cgmlst_dir, args.max_radius)
+    res['build_neighbor_index'] = time.perf_counter() - start
+    res['binary'], data = timed_first_requests(chewie_data, ('allele_profiles', 'distance_matrix', 'neighbor_index'))
+    res['peak_rss'] = MSTrees.peak_rss()
+    return res, data
+
+
+def bench_queries(data, args, rng):
+    matrix = data.get(SPECIES, 'distance_matrix')
+    index = data.get(SPECIES, 'neighbor_index')
+    store = data.get(SPECIES, 'allele_profiles')
+    queries = rng.choice(matrix.names, args.repeats * 3).tolist()
+    res = dict(nearest_neighbors=dict(), profile_diffs=dict())
+    for cutoff in (5, args.max_radius, args.max_radius * 3):
+        res['nearest_neighbors'][f"index_{cutoff}" if index.covers(cutoff) else f"scan_{cutoff}"] = latency(
+            lambda i: neighbor_index.find_nearest_neighbors([queries[i]], matrix, cutoff, index), args.repeats)
+        if index.covers(cutoff):
+            res['nearest_neighbors'][f"scan_{cutoff}"] = latency(
+                lambda i: neighbor_index.find_nearest_neighbors([queries[i]], matrix, cutoff), args.repeats)
+    for k in args.tree_sizes:
+        samples = [rng.choice(store.names, min(k, len(store)), replace=False).tolist() for _ in range(args.repeats)]
+        res['profile_diffs'][str(k)] = latency(lambda i: json.dumps(store.differences(samples[i])), args.repeats)
+    return res
+
+
+def timed_tree(names, profiles, method, n_proc):
+    """Runs in a new process: one tree, after a small tree of the same method to compile outside the timing."""
+    engine = MSTrees.TreeEngine(n_proc=n_proc, **METHODS[method])
+    engine.tree(names[:20], profiles[:20])
+    baseline_rss = MSTrees.peak_rss()
+    stages = MSTrees.Stages()
+    wall, cpu = time.perf_counter(), time.process_time()
+    engine.tree(names, profiles, stages=stages)
+    res = dict(wall=time.perf_counter() - wall, cpu=time.process_time() - cpu, baseline_rss=baseline_rss,
+               peak_rss=MSTrees.peak_rss(),
+               stages={span.pop('stage'): span for span in stages.spans})
+    MSTrees.close_pool()
+    return res
+
+
+def bench_trees(data, args, rng):
+    store = data.get(SPECIES, 'allele_profiles')
+    res = dict()
+    for k in args.tree_sizes:
+        names = rng.choice(store.names, min(k, len(store)), replace=False).tolist()
+        profiles = store.profiles(names)
+        for method in args.methods:
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                res[f"{method}/{k}"] = executor.submit(timed_tree, names, profiles, method, args.n_proc).result()
+            print(f"  {method} {k}: {res[f'{method}/{k}']['wall']:.2f} s")
+    return res
+
+
+def flatten(tree, prefix=''):
+    if isinstance(tree, dict):
+        return {key: value for k, v in tree.items() for key, value in flatten(v, f"{prefix}{k}.").items()}
+    if isinstance(tree, (int, float)) and not isinstance(tree, bool):
+        return {prefix[:-1]: tree}
+    return dict()
+
+
+def compare(old, new, tolerance):
+    old, new = flatten(old['results']), flatten(new['results'])
+    changed = [(key, old[key], new[key]) for key in sorted(old.keys() & new.keys())
+               if old[key] > 0 and abs(new[key] / old[key] - 1) > tolerance]
+    print(f"{len(changed)} of {len(old.keys() & new.keys())} numbers changed by more than {tolerance:.0%}:")
+    for key, before, after in changed:
+        print(f"  {key:<70} {before:>12.4g} -> {after:>12.4g}  {after / before:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='2000x3000', help='Comma separated samples x loci [DEFAULT: 2000x3000]')
+    parser.add_argument('--tree_sizes', default='100,500,1000', help='Comma separated samples per tree and profile diff')
+    parser.add_argument('--methods', default='MSTreeV2,MSTree,NJ,distance', help=f"Comma separated, of {', '.join(METHODS)}")
+    parser.add_argument('--missing', type=float, default=0.01, help='Mean fraction of missing alleles [DEFAULT: 0.01]')
+    parser.add_argument('--clusters', type=int, default=20, help='Number of clonal clusters [DEFAULT: 20]')
+    parser.add_argument('--mutations', type=float, default=2, help='Mean new alleles per sample [DEFAULT: 2]')
+    parser.add_argument('--divergence', type=float, default=0.3, help='Fraction of loci where clusters differ [DEFAULT: 0.3]')
+    parser.add_argument('--max_radius', type=int, default=20, help='Neighbor index radius [DEFAULT: 20]')
+    parser.add_argument('--repeats', type=int, default=20, help='Repeats of each query [DEFAULT: 20]')
+    parser.add_argument('--n_proc', type=int, default=4, help='Processes per tree and for the distances [DEFAULT: 4]')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed [DEFAULT: 0]')
+    parser.add_argument('--out', default='bench.json', help='JSON results [DEFAULT: bench.json]')
+    parser.add_argument('--compare', help='Earlier JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative change that is reported [DEFAULT: 0.2]')
+    args = parser.parse_args()
+    args.tree_sizes = [int(k) for k in args.tree_sizes.split(',')]
+    args.methods = args.methods.split(',')
+
+    report = dict(created=datetime.now().isoformat(), **commit(),
+                  host=dict(platform=platform.platform(), python=platform.python_version(), numpy=np.__version__,
+                            numba=numba.__version__, cpus=os.cpu_count()),
+                  args={k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'tolerance')},
+                  results=dict())
+    for size in args.sizes.split(','):
+        args.n_samples, args.n_loci = (int(v) for v in size.split('x'))
+        print(f"{size}")
+        rng = np.random.default_rng(args.seed)
+        with tempfile.TemporaryDirectory() as chewie_data:
+            load, data = bench_load(chewie_data, args)
+            report['results'][size] = dict(load=load, queries=bench_queries(data, args, rng),
+                                           trees=bench_trees(data, args, rng))
+    for attr in ('n_samples', 'n_loci'):
+        report['args'].pop(attr, None)
+    with open(args.out, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
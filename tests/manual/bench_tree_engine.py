@@ -0,0 +1,71 @@
+"""
+Build trees at the same time in threads with one MSTrees.TreeEngine, and check
+that they equal the same trees built one at a time.
+
+Run from the repository root:
+    python tests/manual/bench_tree_engine.py [--trees 16] [--threads 4] [--n_profile 300] [--n_loci 1000] [--n_proc 1]
+
+The trees alternate between MSTreeV2, MSTree and NJ (FastME, which writes its
+input and output to the scratch directory) on different random samples. The
+script prints the trees per second built one at a time and in threads, whether
+all trees are equal, and whether the scratch directory was left empty. Trees
+only build faster in threads with enough cores: the compiled tree code and the
+external programs run outside the GIL, and with n_proc > 1 the distances are
+computed in the shared process pool.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import MSTrees  # noqa: E402
+from bench_distance import synthetic_profiles  # noqa: E402
+
+METHODS = (dict(method='MSTreeV2'), dict(method='MSTree', matrix_type='symmetric'), dict(method='NJ'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--trees', type=int, default=16, help='Number of trees [DEFAULT: 16]')
+    parser.add_argument('--threads', type=int, default=4, help='Trees built at the same time [DEFAULT: 4]')
+    parser.add_argument('--n_profile', type=int, default=300, help='Samples per tree [DEFAULT: 300]')
+    parser.add_argument('--n_loci', type=int, default=1000, help='Loci per profile [DEFAULT: 1000]')
+    parser.add_argument('--n_proc', type=int, default=1, help='Processes per tree [DEFAULT: 1]')
+    args = parser.parse_args()
+
+    profiles = synthetic_profiles(args.n_profile * 4, args.n_loci)
+    rng = np.random.default_rng(0)
+    jobs = list()
+    for i in range(args.trees):
+        positions = rng.choice(profiles.shape[0], args.n_profile, replace=False)
+        jobs.append(([f"s{p}" for p in positions], profiles[positions], METHODS[i % len(METHODS)]))
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        engine = MSTrees.TreeEngine(scratch_dir=scratch_dir, n_proc=args.n_proc)
+        engine.tree(*jobs[0][:2], **jobs[0][2])  # compile and start the pool outside the timing
+
+        start = time.perf_counter()
+        serial = [engine.tree(names, job_profiles, **method) for names, job_profiles, method in jobs]
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as executor:
+            threaded = list(executor.map(lambda job: engine.tree(job[0], job[1], **job[2]), jobs))
+        threaded_time = time.perf_counter() - start
+        left = os.listdir(scratch_dir)
+
+    print(f"one at a time: {args.trees / serial_time:.2f} trees/s, "
+          f"{args.threads} threads: {args.trees / threaded_time:.2f} trees/s ({serial_time / threaded_time:.2f}x) "
+          f"on {len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()} cores")
+    print(f"trees equal: {serial == threaded}, scratch directory empty: {not left}")
+    MSTrees.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Simulate many clients polling Bifrost job statuses through the batched status cache.
+
+Run from the repository root:
+    python tests/manual/bifrost_status.py [--clients 50] [--jobs 20] [--seconds 30]
+
+A fake scheduler answers the batched checkjob command with Moab style output
+after a delay, and moves the jobs from Idle to Running to Completed. Each
+client polls the status of its jobs every poll interval. The script prints
+how many HPC commands were run, against the clients x jobs x polls that
+polling checkjob per job used to take, and checks the parsed statuses.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+import bifrost_status  # noqa: E402
+from models import JobStatus  # noqa: E402
+
+CHECKJOB = {
+    'Idle': ['job {0}\n', '\n', 'AName: bifrost_{0}\n', 'State: Idle \n', 'Creds:  user:bifrost  group:ssi\n'],
+    'Running': ['job {0}\n', '\n', 'AName: bifrost_{0}\n', 'State: Running \n', 'Creds:  user:bifrost  group:ssi\n'],
+    'Completed': ['job {0}\n', '\n', 'AName: bifrost_{0}\n', 'State: Completed \n',
+                  'Completion Code: {1}  Time: Mon Oct 12 10:00:00\n'],
+    'Missing': ["ERROR:  cannot locate job '{0}'\n"],
+}
+
+
+class FakeScheduler(object):
+    def __init__(self, job_ids, seconds, delay=0.2):
+        self.delay = delay
+        self.commands = 0
+        start = time.monotonic()
+        # each job starts and completes at a random time within the run; every tenth job fails
+        self.jobs = {job_id: (start + random.uniform(0, seconds / 2), start + random.uniform(seconds / 2, seconds),
+                              int(i % 10 == 0)) for i, job_id in enumerate(job_ids)}
+
+    def state(self, job_id):
+        if job_id not in self.jobs:
+            return 'Missing', None
+        starts, completes, code = self.jobs[job_id]
+        now = time.monotonic()
+        return ('Idle' if now < starts else 'Running' if now < completes else 'Completed'), code
+
+    async def run(self, command):
+        self.commands += 1
+        await asyncio.sleep(self.delay)
+        job_ids = command.split(' in ')[1].split(';')[0].split()
+        stdout = list()
+        for job_id in job_ids:
+            state, code = self.state(job_id)
+            stdout.append(f"{bifrost_status.MARKER}{job_id}\n")
+            stdout.extend(line.format(job_id, code) for line in CHECKJOB[state])
+        return stdout, []
+
+
+EXPECTED = {'Idle': JobStatus.Queued, 'Running': JobStatus.Running, 'Missing': JobStatus.Failed}
+
+
+async def client(cache, scheduler, job_ids, poll_seconds, until, mismatches):
+    while time.monotonic() < until:
+        for job in await cache.get(job_ids):
+            state, code = scheduler.state(job.job_id)
+            expected = (JobStatus.Succeeded if code == 0 else JobStatus.Failed) if state == 'Completed' else EXPECTED[state]
+            # a status may be up to one TTL old
+            if job.status != expected and job.status not in (JobStatus.Queued, JobStatus.Running):
+                mismatches.append((job.job_id, job.status, expected))
+        await asyncio.sleep(poll_seconds * random.uniform(0.8, 1.2))
+
+
+async def simulate(args):
+    job_ids = [str(1000 + i) for i in range(args.clients * args.jobs // 2)] + ['999']
+    scheduler = FakeScheduler(job_ids, args.seconds)
+    cache = bifrost_status.StatusCache(scheduler.run, ttl_seconds=args.ttl, finished_ttl_seconds=300)
+    until = time.monotonic() + args.seconds
+    mismatches = list()
+    # every job is followed by two clients
+    await asyncio.gather(*[client(cache, scheduler, random.sample(job_ids, args.jobs), args.poll, until, mismatches)
+                           for _ in range(args.clients)])
+    return cache, scheduler, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50, help='Polling clients [DEFAULT: 50]')
+    parser.add_argument('--jobs', type=int, default=20, help='Jobs per client [DEFAULT: 20]')
+    parser.add_argument('--seconds', type=float, default=30, help='Length of the simulation [DEFAULT: 30]')
+    parser.add_argument('--poll', type=float, default=3, help='Poll interval of the clients [DEFAULT: 3]')
+    parser.add_argument('--ttl', type=float, default=10, help='Status TTL [DEFAULT: 10]')
+    args = parser.parse_args()
+    random.seed(0)
+
+    cache, scheduler, mismatches = asyncio.run(simulate(args))
+    polled = cache.metrics['requests'] * args.jobs
+    print(f"{cache.metrics['requests']} requests for {polled} job statuses")
+    print(f"HPC commands: {scheduler.commands} batched, against {polled} with one checkjob per job status")
+    print(f"requests answered from the cache without waiting: {cache.metrics['cached']}")
+    print(f"statuses that do not match the scheduler: {len(mismatches)}")
+    parsed = bifrost_status.parse_batch([f"{bifrost_status.MARKER}1\n"] + [line.format(1, 0) for line in CHECKJOB['Completed']] +
+                                        [f"{bifrost_status.MARKER}2\n"] + [line.format(2, 1) for line in CHECKJOB['Completed']] +
+                                        [f"{bifrost_status.MARKER}3\n"] + [line.format(3, 0) for line in CHECKJOB['Missing']])
+    print({job_id: (job.status.value, job.error) for job_id, job in parsed.items()})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Calibration of the tree time and memory models (see tree_resources) on this host.
+
+Run from the repository root, on the host the tree workers run on:
+    python tests/manual/calibrate_trees.py --out tree_calibration.json [--config config.yaml]
+                                           [--sizes 100,250,500,1000,2000] [--loci 1000,3000] [--n_proc 1,4]
+
+Builds trees of synthetic clonal profiles (synthetic.clonal_profiles) of every
+tree method at several sizes, each in a new process, and measures their wall
+time and the growth of the peak resident memory of the process and of the
+workers of its distance pool. Memory shared with the pool is counted in each
+process that maps it, so the memory measured errs on the high side. The time
+and memory of each method are then fitted with tree_resources.fit. Set
+'calibration' under 'tree_jobs' in the config to the written file.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+from multiprocessing import get_context
+import os
+import platform
+import sys
+import time
+
+import psutil
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(__file__))
+import MSTrees  # noqa: E402
+import tree_jobs  # noqa: E402
+import tree_resources  # noqa: E402
+from synthetic import clonal_profiles  # noqa: E402
+
+
+def pool_peak_rss(n_proc):
+    """Sum of the peak resident memory of the distance pool's workers, in bytes (0 without /proc)."""
+    pool = MSTrees._pools.get(n_proc)
+    total = 0
+    for process in (pool._pool if pool is not None else list()):
+        try:
+            with open(f"/proc/{process.pid}/status") as file:
+                total += next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmHWM:'))
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+def measure(method, n_profile, n_loci, n_proc):
+    """Runs in a new process: the wall time and peak memory growth of one tree, after a small one to compile."""
+    profiles = clonal_profiles(n_profile, n_loci, seed=n_profile)
+    names = [f"s{i}" for i in range(n_profile)]
+    engine = MSTrees.TreeEngine(n_proc=n_proc, **tree_jobs.METHODS[method])
+    engine.tree(names[:20], profiles[:20])
+    baseline = MSTrees.peak_rss() + pool_peak_rss(n_proc)
+    start = time.perf_counter()
+    engine.tree(names, profiles)
+    seconds = time.perf_counter() - start
+    memory = MSTrees.peak_rss() + pool_peak_rss(n_proc) - baseline
+    MSTrees.close_pool()
+    return dict(method=method, n_profile=n_profile, n_loci=n_loci, n_proc=n_proc, seconds=seconds, memory=memory)
+
+
+def calibrate(methods, sizes, loci, n_procs):
+    samples = list()
+    context = get_context('spawn')
+    for method in methods:
+        for n_loci in loci:
+            for n_proc in n_procs:
+                for n_profile in sizes:
+                    with ProcessPoolExecutor(1, mp_context=context) as executor:
+                        sample = executor.submit(measure, method, n_profile, n_loci, n_proc).result()
+                    print(f"{method} {n_profile} x {n_loci} with {n_proc} processes: "
+                          f"{sample['seconds']:.2f} seconds, {sample['memory'] / 2 ** 20:.0f} MB")
+                    samples.append(sample)
+    models = dict()
+    for method in methods:
+        method_samples = [s for s in samples if s['method'] == method]
+        models[method] = dict(seconds=tree_resources.fit(tree_resources.TIME_TERMS, method_samples, 'seconds'),
+                              memory=tree_resources.fit(tree_resources.MEMORY_TERMS, method_samples, 'memory'))
+    return dict(created=datetime.now().isoformat(), host=platform.node(), cpus=os.cpu_count(),
+                total_memory=psutil.virtual_memory().total, models=models, samples=samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--out', '-o', help='Calibration file [DEFAULT: ./tree_calibration.json]', default='./tree_calibration.json')
+    parser.add_argument('--config', '-c', help='Application config, for n_proc [DEFAULT: ./config.yaml]', default='./config.yaml')
+    parser.add_argument('--methods', help='Comma separated tree methods [DEFAULT: all]', default=','.join(tree_jobs.METHODS))
+    parser.add_argument('--sizes', help='Comma separated numbers of profiles [DEFAULT: 100,250,500,1000,2000]',
+                        default='100,250,500,1000,2000')
+    parser.add_argument('--loci', help='Comma separated numbers of loci [DEFAULT: 1000,3000]', default='1000,3000')
+    parser.add_argument('--n_proc', help='Comma separated numbers of processes [DEFAULT: 1 and tree_jobs.n_proc]')
+    args = parser.parse_args()
+    if args.n_proc is None:
+        config = dict()
+        if os.path.exists(args.config):
+            with open(args.config) as file:
+                config = yaml.load(file, Loader=yaml.FullLoader)
+        n_procs = sorted({1, tree_jobs.job_config(config)['n_proc']})
+    else:
+        n_procs = [int(p) for p in args.n_proc.split(',')]
+    calibration = calibrate(args.methods.split(','), [int(n) for n in args.sizes.split(',')],
+                            [int(L) for L in args.loci.split(',')], n_procs)
+    with open(args.out, 'w') as file:
+        json.dump(calibration, file, indent=2)
+    print(f"Wrote the models of {len(calibration['models'])} tree methods to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Exercise the pooled HPC SSH connections against a local stand-in SSH server.
+
+Run from the repository root:
+    python tests/manual/ssh_pool.py [--commands 50] [--concurrency 10]
+
+The stand-in server is a paramiko server on localhost that accepts one user
+and password and runs each exec request with the local shell. The script:
+
+1. times commands that each open a new connection, as get_hpc_conn did,
+2. runs the same commands concurrently through SSHPool.run from an event loop
+   and checks that the loop stays responsive,
+3. drops all server-side connections and checks that the pool reconnects,
+
+and prints the pool metrics after each step.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+import hpc  # noqa: E402
+
+USERNAME, PASSWORD = 'bifrost', 'secret'
+
+
+class StandInServer(paramiko.ServerInterface):
+    def __init__(self):
+        self.channels = dict()
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.execute, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    @staticmethod
+    def execute(channel, command):
+        time.sleep(0.01)  # let the transport send the reply to the exec request before the channel closes
+        process = subprocess.run(command, shell=True, capture_output=True)
+        channel.sendall(process.stdout)
+        channel.sendall_stderr(process.stderr)
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+def serve(listener, host_key, transports):
+    while True:
+        try:
+            client, _ = listener.accept()
+        except OSError:
+            return
+        transport = paramiko.Transport(client)
+        transport.add_server_key(host_key)
+        transport.start_server(server=StandInServer())
+        transports.append(transport)
+
+
+def fresh_connection(port, command):
+    """What every Bifrost request did before the pool."""
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname='localhost', port=port, username=USERNAME, password=PASSWORD,
+                   allow_agent=False, look_for_keys=False)
+    with client:
+        stdin, stdout, stderr = client.exec_command(command)
+        return stdout.readlines(), stderr.readlines()
+
+
+async def pooled(pool, command, n_commands, concurrency):
+    """Runs the commands through the pool and measures the largest event loop stall meanwhile."""
+    semaphore = asyncio.Semaphore(concurrency)
+    stall = 0.
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stall = max(stall, time.perf_counter() - start - 0.01)
+
+    async def one(i):
+        async with semaphore:
+            return await pool.run(f"{command} {i}")
+
+    tick = asyncio.ensure_future(ticker())
+    results = await asyncio.gather(*[one(i) for i in range(n_commands)])
+    done = True
+    await tick
+    return results, stall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--commands', type=int, default=50, help='Number of commands [DEFAULT: 50]')
+    parser.add_argument('--concurrency', type=int, default=10, help='Commands in flight at a time [DEFAULT: 10]')
+    args = parser.parse_args()
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)  # the server logs every client disconnect
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('localhost', 0))
+    listener.listen(100)
+    port = listener.getsockname()[1]
+    transports = list()
+    threading.Thread(target=serve, args=(listener, paramiko.RSAKey.generate(2048), transports), daemon=True).start()
+    command = 'echo checkjob'
+
+    start = time.perf_counter()
+    for i in range(args.commands):
+        fresh_connection(port, f"{command} {i}")
+    fresh_time = time.perf_counter() - start
+    print(f"new connection per command: {args.commands / fresh_time:.1f} commands/s")
+
+    pool = hpc.SSHPool('localhost', port, USERNAME, PASSWORD, max_connections=2, max_channels=8)
+    start = time.perf_counter()
+    results, stall = asyncio.run(pooled(pool, command, args.commands, args.concurrency))
+    pool_time = time.perf_counter() - start
+    correct = all(stdout == [f"checkjob {i}\n"] and stderr == [] for i, (stdout, stderr) in enumerate(results))
+    print(f"pooled: {args.commands / pool_time:.1f} commands/s, {fresh_time / pool_time:.1f}x, "
+          f"largest event loop stall {stall * 1000:.1f} ms, output correct: {correct}")
+    print(pool.stats())
+
+    # The pool still holds the connections as open, so the first commands find them broken and retry
+    for transport in transports:
+        transport.close()
+    results, stall = asyncio.run(pooled(pool, command, args.commands, args.concurrency))
+    correct = all(stdout == [f"checkjob {i}\n"] for i, (stdout, stderr) in enumerate(results))
+    print(f"after the server dropped all connections, output correct: {correct}")
+    print(pool.stats())
+    stdout, stderr = pool.exec_command('echo out; echo err >&2; exit 3')
+    print(f"stdout {stdout} stderr {stderr}")
+    pool.close()
+    listener.close()
+
+
+if __name__ == '__main__':
+    main()
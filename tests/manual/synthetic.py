@@ -0,0 +1,139 @@
+"""
+Synthetic cgMLST data in the layout of a species' cgMLST directory.
+
+Run from the repository root:
+    python tests/manual/synthetic.py OUT_DIR [--samples 2000] [--loci 3000] [--missing 0.01]
+                                     [--clusters 20] [--mutations 2] [--divergence 0.3] [--binary]
+
+Writes allele_profiles.tsv and distance_matrix.tsv to OUT_DIR, and with
+--binary also the binary profile and distance matrix stores and a neighbor
+index. The profiles have a clonal structure:
+
+- 'clusters' founders, each differing from a common root at a 'divergence'
+  fraction of the loci, with uneven numbers of samples per cluster,
+- every sample copies an earlier sample of its cluster (or the founder) and
+  gets a Poisson('mutations') number of new alleles,
+- each sample misses a fraction of its alleles drawn around 'missing', as
+  assemblies of varying quality do.
+
+The same arguments and seed give the same files.
+"""
+import argparse
+import os
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'app'))
+import distance_store  # noqa: E402
+import neighbor_index  # noqa: E402
+import profile_store  # noqa: E402
+
+
+def clonal_profiles(n_samples, n_loci, missing=0.01, clusters=20, mutations=2., divergence=0.3, seed=0):
+    """Allele numbers per locus (0 = missing) of clonal samples, one row per sample."""
+    rng = np.random.default_rng(seed)
+    next_allele = np.full(n_loci, 2, dtype=np.int64)  # the root has allele 1 at every locus
+
+    def new_alleles(loci):
+        # a locus can mutate more than once in a draw, so number the repeats too
+        loci = np.sort(loci)
+        repeat = np.arange(loci.size) - np.searchsorted(loci, loci)
+        alleles = next_allele[loci] + repeat
+        np.add.at(next_allele, loci, 1)
+        return loci, alleles
+
+    founders = np.ones((clusters, n_loci), dtype=np.int64)
+    for founder in founders:
+        loci, alleles = new_alleles(np.flatnonzero(rng.random(n_loci) < divergence))
+        founder[loci] = alleles
+    cluster_of = rng.choice(clusters, size=n_samples, p=rng.dirichlet(np.full(clusters, 0.5)))
+
+    profiles = np.empty((n_samples, n_loci), dtype=np.int64)
+    members = [list() for _ in range(clusters)]
+    for i, cluster in enumerate(cluster_of):
+        parents = members[cluster]
+        parent = rng.integers(0, len(parents) + 1)
+        profiles[i] = founders[cluster] if parent == len(parents) else profiles[parents[parent]]
+        loci, alleles = new_alleles(rng.integers(0, n_loci, rng.poisson(mutations)))
+        profiles[i, loci] = alleles
+        parents.append(i)
+
+    sample_missing = np.minimum(rng.exponential(missing, size=(n_samples, 1)), 0.5) if missing > 0 else 0.
+    profiles[rng.random(profiles.shape) < sample_missing] = 0
+    return profiles
+
+
+def sample_names(n_samples):
+    return [f"SYN{i:07d}" for i in range(n_samples)]
+
+
+def write_profiles(path, names, profiles):
+    with open(path, 'w') as file:
+        file.write('#FILE\t' + '\t'.join(f"locus{j:05d}" for j in range(profiles.shape[1])) + '\n')
+        for name, row in zip(names, profiles.astype(str)):
+            row[row == '0'] = profile_store.MISSING
+            file.write(name + '\t' + '\t'.join(row) + '\n')
+
+
+def write_distances(path, names, profiles, n_proc=4, block_size=1000):
+    """The symmetric pair_delete distances, rounded, as the space separated distance_matrix.tsv."""
+    distances = np.rint(distance_store.new_distances(profiles, 0, n_proc=n_proc)).astype(np.int64)
+    with open(path, 'w') as file:
+        for start in range(0, len(names), block_size):
+            for name, row in zip(names[start:start + block_size], distances[start:start + block_size].astype(str)):
+                file.write(name + ' ' + ' '.join(row) + '\n')
+    return distances
+
+
+def write(out_dir, n_samples, n_loci, missing=0.01, clusters=20, mutations=2., divergence=0.3, seed=0,
+          binary=False, max_radius=20, n_proc=4) -> dict:
+    """Write the data of one species to 'out_dir' and return the time of each step in seconds."""
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    timings = dict()
+    start = time.perf_counter()
+    profiles = clonal_profiles(n_samples, n_loci, missing, clusters, mutations, divergence, seed)
+    names = sample_names(n_samples)
+    timings['generate'] = time.perf_counter() - start
+    start = time.perf_counter()
+    write_profiles(out_dir.joinpath(profile_store.TSV_NAME), names, profiles)
+    timings['write_profiles'] = time.perf_counter() - start
+    start = time.perf_counter()
+    write_distances(out_dir.joinpath(distance_store.TSV_NAME), names, profiles, n_proc)
+    timings['write_distances'] = time.perf_counter() - start
+    if binary:
+        start = time.perf_counter()
+        profile_store.convert(out_dir.joinpath(profile_store.TSV_NAME))
+        timings['convert_profiles'] = time.perf_counter() - start
+        start = time.perf_counter()
+        distance_store.convert(out_dir.joinpath(distance_store.TSV_NAME))
+        timings['convert_distances'] = time.perf_counter() - start
+        start = time.perf_counter()
+        neighbor_index.write(out_dir, max_radius)
+        timings['build_neighbor_index'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('out_dir', help='Output directory, e.g. $CHEWIE_DATA/Synthetic/output/cgmlst')
+    parser.add_argument('--samples', type=int, default=2000, help='Number of samples [DEFAULT: 2000]')
+    parser.add_argument('--loci', type=int, default=3000, help='Loci per profile [DEFAULT: 3000]')
+    parser.add_argument('--missing', type=float, default=0.01, help='Mean fraction of missing alleles [DEFAULT: 0.01]')
+    parser.add_argument('--clusters', type=int, default=20, help='Number of clonal clusters [DEFAULT: 20]')
+    parser.add_argument('--mutations', type=float, default=2, help='Mean new alleles per sample [DEFAULT: 2]')
+    parser.add_argument('--divergence', type=float, default=0.3, help='Fraction of loci where clusters differ from the root [DEFAULT: 0.3]')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed [DEFAULT: 0]')
+    parser.add_argument('--binary', action='store_true', help='Also write the binary stores and a neighbor index')
+    parser.add_argument('--n_proc', type=int, default=4, help='Processes for the distances [DEFAULT: 4]')
+    args = parser.parse_args()
+    timings = write(args.out_dir, args.samples, args.loci, args.missing, args.clusters, args.mutations,
+                    args.divergence, args.seed, args.binary, n_proc=args.n_proc)
+    print(', '.join(f"{step} {seconds:.1f} s" for step, seconds in timings.items()))
+
+
+if __name__ == '__main__':
+    main()
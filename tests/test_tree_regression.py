@@ -0,0 +1,61 @@
+"""
+Regression of the trees of MSTrees against baseline files in tests/fixtures/trees.
+
+The baselines were written by MSTrees before the spanning tree, the MSTreeV2
+arborescence and the branch recraft were moved in process, when they came from
+networkx, GrapeTree's edmonds binary and the list-sorting recraft. Every tree
+must stay byte-identical to them, with one process and with a process pool.
+
+The corpora are allele profiles in the layout of allele_profiles.tsv, with 0
+for a missing allele:
+
+    ties    16 samples x 10 loci of two alleles each, with identical profiles,
+            so most distances are tied
+    random  40 samples x 30 loci of random alleles, a quarter of them missing
+    clonal  60 samples x 200 loci of clonal profiles (tests/manual/synthetic.py)
+            with missing alleles
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import csv
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+import MSTrees  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'trees')
+CORPORA = ('ties', 'random', 'clonal')
+# MSTreeV2 covers _minimum_arborescence and _branch_recraft, MSTree (eBurst, as the tree jobs build it)
+# _minimum_spanning_tree, and MSTree_recraft both the spanning tree and the recraft on symmetric distances
+METHODS = {
+    'MSTreeV2': dict(method='MSTreeV2'),
+    'MSTree': dict(method='MSTree', matrix_type='symmetric', heuristic='eBurst', branch_recraft=False),
+    'MSTree_recraft': dict(method='MSTree', matrix_type='symmetric', heuristic='harmonic', branch_recraft=True),
+    'distance': dict(method='distance'),
+}
+
+
+def read_corpus(corpus):
+    with open(os.path.join(FIXTURES, f"{corpus}.tsv")) as file:
+        rows = list(csv.reader(file, delimiter='\t'))[1:]
+    return [row[0] for row in rows], np.array([row[1:] for row in rows], dtype=np.int64)
+
+
+def baseline(corpus, method):
+    extension = 'phylip' if method == 'distance' else 'nwk'
+    with open(os.path.join(FIXTURES, f"{corpus}.{method}.{extension}")) as file:
+        return file.read().rstrip('\n')
+
+
+@pytest.mark.parametrize('n_proc', (1, 3))
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('corpus', CORPORA)
+def test_tree_matches_baseline(corpus, method, n_proc):
+    names, profiles = read_corpus(corpus)
+    tree = MSTrees.TreeEngine(n_proc=n_proc, **METHODS[method]).tree(names, profiles)
+    assert tree == baseline(corpus, method)